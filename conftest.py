@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Shared test environment. main reads its configuration at import time, so these
+must be in place before whichever test module happens to import it first.
+"""
+
+import os
+
+import pytest
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test_bot_token_12345")
+os.environ.setdefault("OPENROUTER_API_KEY", "test_openai_key_12345")
+os.environ.setdefault("ADMIN_ID", "0")
+
+
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="also run the wall-clock budget tests")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "benchmark: asserts a wall-clock budget; skipped unless --benchmark")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="wall-clock budget; run with --benchmark")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def restore_main(monkeypatch):
+    """loadtest.point_main_at() rewires module globals; put them back afterwards"""
+    import stripe
+    import main
+
+    for name in ("OPENROUTER_API_KEY", "OPENROUTER_URL", "PIAPI_API_KEY", "PIAPI_BASE_URL",
+                 "STRIPE_SECRET_KEY", "STRIPE_WEBHOOK_SECRET", "STRIPE_SUCCESS_URL", "STRIPE_CANCEL_URL"):
+        monkeypatch.setattr(main, name, getattr(main, name))
+    monkeypatch.setattr(stripe, "api_key", stripe.api_key)
+    monkeypatch.setattr(stripe, "api_base", stripe.api_base)
+    monkeypatch.setattr(main, "PIAPI_DEDUPE_TTL", 0)
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test for MusicAI PRO.
+
+Starts local stand-ins for the Telegram Bot API, OpenRouter, PIAPI and Stripe,
+points main at them and drives simulated users through the whole flow:
+
+    start -> genre -> mood -> text -> generate -> pay (checkout + Stripe webhook)
+
+Updates go through the real handlers via Application.process_update and the
+webhook through the real FastAPI app, so the numbers include DB round trips,
+translation lookups and Bot API calls. A scratch Postgres database is required
+(DATABASE_URL or --database-url); simulated users get ids from --user-base up.
+
+    python loadtest.py --users 200 --concurrency 50 --out baseline.json
+    python loadtest.py --users 200 --concurrency 50 --compare baseline.json
+
+Upstream profiles (milliseconds / fractions):
+
+    --latency openrouter=1500,piapi=3000 --jitter 0.2 --errors piapi=0.02
+
+Results carry the git commit and the full configuration; --compare exits with
+status 1 when p99 latency, throughput or DB statements per update regress by
+more than --tolerance.
+"""
+
+import os
+import sys
+import json
+import hmac
+import math
+import time
+import random
+import asyncio
+import hashlib
+import logging
+import argparse
+import itertools
+import subprocess
+from collections import Counter, defaultdict
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional
+
+import httpx
+import stripe
+from aiohttp import web
+from telegram import Update
+
+import main
+
+BOT_TOKEN = "123456:LOADTEST"
+WEBHOOK_SECRET = "whsec_loadtest"
+
+DEFAULT_LATENCY_MS = {"telegram": 30, "openrouter": 1500, "piapi": 3000, "stripe": 300}
+
+STEPS = ("start", "genre", "mood", "text", "pick", "generate", "pay", "pay_webhook")
+
+
+# -------------------------
+# Local upstream stand-ins
+# -------------------------
+@dataclass
+class UpstreamProfile:
+    latency: float = 0.0     # seconds
+    jitter: float = 0.0      # standard deviation as a fraction of latency
+    error_rate: float = 0.0  # fraction of requests answered with a 5xx
+
+
+def parse_profiles(latency: str = "", errors: str = "", jitter: float = 0.0) -> Dict[str, UpstreamProfile]:
+    """Build per-upstream profiles from "name=value,..." option strings"""
+    def parse(spec: str) -> Dict[str, float]:
+        out = {}
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            name, _, value = item.partition("=")
+            if name not in DEFAULT_LATENCY_MS:
+                raise ValueError(f"Unknown upstream '{name}', expected one of {sorted(DEFAULT_LATENCY_MS)}")
+            out[name] = float(value)
+        return out
+
+    latencies = {**DEFAULT_LATENCY_MS, **parse(latency)}
+    error_rates = parse(errors)
+    return {
+        name: UpstreamProfile(latencies[name] / 1000, jitter, error_rates.get(name, 0.0))
+        for name in DEFAULT_LATENCY_MS
+    }
+
+
+class FakeUpstreams:
+    """One aiohttp server playing Telegram, OpenRouter, PIAPI and Stripe"""
+
+    def __init__(self, profiles: Optional[Dict[str, UpstreamProfile]] = None, seed: Optional[int] = None):
+        self.profiles = profiles or {}
+        self.rng = random.Random(seed)
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.error_replies = 0  # user-visible "❌" messages sent by the bot
+        self.base_url = ""
+        self._ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.telegram)
+        self.app.router.add_post("/openrouter/chat/completions", self.openrouter)
+        self.app.router.add_post("/piapi" + main.PIAPI_GENERATE_PATH, self.piapi)
+        self.app.router.add_post("/stripe/v1/checkout/sessions", self.stripe_checkout)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}"
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _simulate(self, name: str) -> bool:
+        """Apply the latency profile; True when this request should fail"""
+        profile = self.profiles.get(name) or UpstreamProfile()
+        self.requests[name] += 1
+        if profile.latency:
+            await asyncio.sleep(max(0.0, self.rng.gauss(profile.latency, profile.latency * profile.jitter)))
+        if profile.error_rate and self.rng.random() < profile.error_rate:
+            self.errors[name] += 1
+            return True
+        return False
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        if await self._simulate("telegram"):
+            return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+
+        if method == "getMe":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "MusicAI", "username": "musicai_loadtest_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendAudio"):
+            text = str(form.get("text", ""))
+            if text.startswith("❌"):
+                self.error_replies += 1
+            message_id = next(self._ids)
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(form.get("chat_id", 0) or 0), "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "MusicAI"},
+                "text": text,
+            }
+            if method == "sendAudio":
+                result["audio"] = {"file_id": f"AUDIO{message_id}", "file_unique_id": f"U{message_id}", "duration": 120}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def openrouter(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if await self._simulate("openrouter"):
+            return web.Response(status=503, text="upstream overloaded")
+        n = next(self._ids)
+        # Unique lyrics per call, otherwise generation dedupe collapses the PIAPI load
+        content = f"[Verse 1]\nLoad test line {n}\nSung by {body.get('model')}\n\n[Chorus]\nLa la la {n}\n"
+        return web.json_response({"id": f"gen-{n}", "choices": [{"message": {"role": "assistant", "content": content}}]})
+
+    async def piapi(self, request: web.Request) -> web.Response:
+        await request.json()
+        if await self._simulate("piapi"):
+            return web.Response(status=500, text="generation failed")
+        n = next(self._ids)
+        return web.json_response({"code": 200, "data": [{"audio_url": f"{self.base_url}/audio/{n}.mp3"}]})
+
+    async def stripe_checkout(self, request: web.Request) -> web.Response:
+        await request.post()
+        if await self._simulate("stripe"):
+            return web.json_response({"error": {"type": "api_error", "message": "stand-in failure"}}, status=500)
+        n = next(self._ids)
+        return web.json_response({
+            "id": f"cs_test_{n}",
+            "object": "checkout.session",
+            "url": f"https://checkout.stripe.test/c/{n}",
+        })
+
+
+def point_main_at(base_url: str):
+    """Redirect every upstream used by main to the stand-ins"""
+    main.OPENROUTER_API_KEY = main.OPENROUTER_API_KEY or "sk-loadtest"
+    main.OPENROUTER_URL = f"{base_url}/openrouter/chat/completions"
+    main.PIAPI_API_KEY = main.PIAPI_API_KEY or "piapi-loadtest"
+    main.PIAPI_BASE_URL = f"{base_url}/piapi"
+    main.STRIPE_SECRET_KEY = "sk_test_loadtest"
+    main.STRIPE_WEBHOOK_SECRET = WEBHOOK_SECRET
+    main.STRIPE_SUCCESS_URL = main.STRIPE_CANCEL_URL = "https://t.me/musicai_loadtest_bot"
+    stripe.api_key = main.STRIPE_SECRET_KEY
+    stripe.api_base = f"{base_url}/stripe"
+
+
+def sign_stripe_payload(payload: bytes, secret: str = WEBHOOK_SECRET, timestamp: Optional[int] = None) -> str:
+    """Stripe-Signature header value for a webhook payload"""
+    ts = int(timestamp or time.time())
+    digest = hmac.new(secret.encode(), f"{ts}.".encode() + payload, hashlib.sha256).hexdigest()
+    return f"t={ts},v1={digest}"
+
+
+# -------------------------
+# Update construction
+# -------------------------
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {"id": user_id, "is_bot": False, "first_name": "Load", "language_code": "en"}
+
+
+def message_update(user_id: int, text: str) -> Dict[str, Any]:
+    update_id = next(_update_ids)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": _user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+def callback_update(user_id: int, data: str) -> Dict[str, Any]:
+    update_id = next(_update_ids)
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "MusicAI"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def checkout_completed_event(user_id: int, pack_id: str = "pack_1") -> bytes:
+    n = next(_update_ids)
+    return json.dumps({
+        "id": f"evt_loadtest_{n}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_loadtest_{n}",
+            "object": "checkout.session",
+            "amount_total": int(main.PACKS[pack_id]["price"] * 100),
+            "metadata": {"user_id": str(user_id), "pack": pack_id},
+        }},
+    }).encode()
+
+
+# -------------------------
+# Reporting
+# -------------------------
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def summarize(samples: Dict[str, List[float]], statements: Dict[str, List[int]],
+              failures: Counter, duration: float, flows: int, order: Optional[List[str]] = None) -> Dict[str, Any]:
+    steps = {}
+    total = 0
+    for step in order or STEPS:
+        values = samples.get(step)
+        if not values:
+            continue
+        total += len(values)
+        counts = statements.get(step) or [0]
+        steps[step] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "mean_ms": round(sum(values) / len(values) * 1000, 2),
+            "db_statements_per_update": round(sum(counts) / len(counts), 2),
+            "errors": failures.get(step, 0),
+        }
+    return {
+        "duration_s": round(duration, 3),
+        "updates": total,
+        "throughput_updates_per_s": round(total / duration, 2) if duration else 0.0,
+        "flows_per_s": round(flows / duration, 2) if duration else 0.0,
+        "steps": steps,
+    }
+
+
+def compare_results(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[str]:
+    """Regressions of current against baseline beyond the relative tolerance"""
+    regressions = []
+    base_tp, cur_tp = baseline.get("throughput_updates_per_s", 0), current.get("throughput_updates_per_s", 0)
+    if base_tp and cur_tp < base_tp * (1 - tolerance):
+        regressions.append(f"throughput {base_tp} -> {cur_tp} updates/s")
+    for step, base in baseline.get("steps", {}).items():
+        cur = current.get("steps", {}).get(step)
+        if not cur:
+            continue
+        if base["p99_ms"] and cur["p99_ms"] > base["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{step} p99 {base['p99_ms']} -> {cur['p99_ms']} ms")
+        if cur["db_statements_per_update"] > base["db_statements_per_update"] + 0.01:
+            regressions.append(
+                f"{step} DB statements/update {base['db_statements_per_update']} -> {cur['db_statements_per_update']}"
+            )
+    return regressions
+
+
+def print_report(result: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None):
+    print(f"\ncommit {result['commit']}  {result['updates']} updates in {result['duration_s']}s  "
+          f"{result['throughput_updates_per_s']} updates/s  {result['flows_per_s']} flows/s")
+    print(f"{'step':<12}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'mean ms':>10}{'db/upd':>8}{'errors':>8}")
+    for step, row in result["steps"].items():
+        line = (f"{step:<12}{row['count']:>7}{row['p50_ms']:>10}{row['p99_ms']:>10}"
+                f"{row['mean_ms']:>10}{row['db_statements_per_update']:>8}{row['errors']:>8}")
+        base = (baseline or {}).get("steps", {}).get(step)
+        if base and base["p99_ms"]:
+            line += f"   p99 {(row['p99_ms'] / base['p99_ms'] - 1) * 100:+.1f}%"
+        print(line)
+    print(f"upstream requests {dict(result['upstream_requests'])}  errors {dict(result['upstream_errors'])}  "
+          f"error replies {result['error_replies']}")
+
+
+# -------------------------
+# Driver
+# -------------------------
+class Harness:
+    """Bot wired to the stand-ins, with per-step latency and DB statement accounting"""
+
+    def __init__(self, profiles: Dict[str, UpstreamProfile], seed: Optional[int], database_url: str):
+        self.database_url = database_url
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.statements: Dict[str, List[int]] = defaultdict(list)
+        self.failures: Counter = Counter()
+        self.roots: Dict[int, Any] = {}
+        self.fakes = FakeUpstreams(profiles, seed=seed)
+        self.application = None
+        self.http: Optional[httpx.AsyncClient] = None
+
+    def _capture_root(self, root):
+        self.roots[root.attrs.get("update.id")] = root
+        self._finish_trace(root)
+
+    async def setup(self):
+        base_url = await self.fakes.start()
+        point_main_at(base_url)
+        main.DATABASE_URL = self.database_url
+        await asyncio.to_thread(main.open_db_pool)
+        await asyncio.to_thread(main.init_db)
+        # Users and checkouts from an earlier run against another database
+        for namespace in ("lang", "checkout"):
+            await asyncio.to_thread(main.CACHE.invalidate, namespace)
+        main.LANG_LOCAL.invalidate("lang")
+
+        # Keep each update's root span so DB statements can be attributed per step
+        self._finish_trace = main.finish_trace
+        main.finish_trace = self._capture_root
+
+        self.application = main.build_telegram_app(BOT_TOKEN, base_url=base_url)
+        await self.application.initialize()
+        main.telegram_app = self.application
+        self.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://musicai")
+
+    async def teardown(self):
+        main.finish_trace = self._finish_trace
+        if self.http:
+            await self.http.aclose()
+        await main.PAYMENT_NOTIFIER.close()
+        if self.application:
+            await self.application.shutdown()
+        await main.close_http_session()
+        await asyncio.to_thread(main.close_db_pool)
+        await self.fakes.stop()
+
+    def error_count(self) -> float:
+        return sum(sample.value for metric in main.ERRORS.collect() for sample in metric.samples)
+
+    async def telegram_step(self, step: str, payload: Dict[str, Any]):
+        update = Update.de_json(payload, self.application.bot)
+        started = time.perf_counter()
+        await self.application.process_update(update)
+        self.samples[step].append(time.perf_counter() - started)
+        root = self.roots.pop(payload["update_id"], None)
+        if root is not None:
+            self.statements[step].append(root.attrs.get("db.statements", 0))
+            if root.error:
+                self.failures[step] += 1
+
+    async def webhook_step(self, step: str, payload: bytes):
+        root = main.Span(step, os.urandom(16).hex(), os.urandom(8).hex())
+        token = main._current_span.set(root)
+        started = time.perf_counter()
+        try:
+            resp = await self.http.post(
+                "/stripe/webhook", content=payload,
+                headers={"Stripe-Signature": sign_stripe_payload(payload), "Content-Type": "application/json"},
+            )
+            if resp.status_code != 200:
+                self.failures[step] += 1
+        finally:
+            main._current_span.reset(token)
+        self.samples[step].append(time.perf_counter() - started)
+        self.statements[step].append(root.attrs.get("db.statements", 0))
+
+    def report(self, duration: float, flows: int, errors: float, config: Dict[str, Any],
+               order: Optional[List[str]] = None) -> Dict[str, Any]:
+        return {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "config": {
+                **config,
+                "perf_profile": main.perf_profile(),
+                "profiles": {name: asdict(p) for name, p in self.fakes.profiles.items()},
+            },
+            **summarize(self.samples, self.statements, self.failures, duration, flows, order),
+            "upstream_requests": dict(self.fakes.requests),
+            "upstream_errors": dict(self.fakes.errors),
+            "error_replies": self.fakes.error_replies,
+            "errors_counted": int(errors),
+        }
+
+
+class LoadTest(Harness):
+    def __init__(self, args: argparse.Namespace):
+        super().__init__(parse_profiles(args.latency, args.errors, args.jitter), args.seed, args.database_url)
+        self.args = args
+
+    async def user_flow(self, user_id: int):
+        await asyncio.to_thread(main.add_balance, user_id, 1)  # enough credit for one song
+        await self.telegram_step("start", message_update(user_id, "/start"))
+        await self.telegram_step("genre", callback_update(user_id, "genre:Pop"))
+        await self.telegram_step("mood", callback_update(user_id, "mood:Happy"))
+        await self.telegram_step("text", message_update(user_id, "A song about load testing on a Friday"))
+        if main.LYRICS_VARIANTS > 1:
+            await self.telegram_step("pick", callback_update(user_id, "pick:0"))
+        await self.telegram_step("generate", callback_update(user_id, f"generate:{user_id}"))
+        await self.telegram_step("pay", callback_update(user_id, "buypack:pack_1"))
+        await self.webhook_step("pay_webhook", checkout_completed_event(user_id))
+
+    async def run(self) -> Dict[str, Any]:
+        await self.setup()
+        try:
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+
+            async def limited(user_id: int):
+                async with semaphore:
+                    await self.user_flow(user_id)
+
+            errors_before = self.error_count()
+            started = time.perf_counter()
+            await asyncio.gather(*(limited(self.args.user_base + i) for i in range(self.args.users)))
+            duration = time.perf_counter() - started
+            errors = self.error_count() - errors_before
+        finally:
+            await self.teardown()
+
+        config = {"users": self.args.users, "concurrency": self.args.concurrency, "seed": self.args.seed}
+        return self.report(duration, self.args.users, errors, config)
+
+
+def add_common_args(parser: argparse.ArgumentParser):
+    """Options shared with replay.py"""
+    parser.add_argument("--concurrency", type=int, default=20, help="flows/updates in flight at the same time")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL", ""), help="scratch Postgres database")
+    parser.add_argument("--latency", default="", help="per-upstream latency in ms, e.g. openrouter=1500,piapi=3000")
+    parser.add_argument("--errors", default="", help="per-upstream error rate, e.g. piapi=0.02")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency standard deviation as a fraction")
+    parser.add_argument("--seed", type=int, default=1, help="RNG seed for latency/error draws")
+    parser.add_argument("--out", default="", help="write results JSON here")
+    parser.add_argument("--compare", default="", help="baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed relative regression")
+    parser.add_argument("--verbose", action="store_true", help="keep bot INFO logging")
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="End-to-end load test against local upstream stand-ins")
+    parser.add_argument("--users", type=int, default=100, help="simulated users, one full flow each")
+    parser.add_argument("--user-base", type=int, default=9_000_000_000, help="first simulated user id")
+    add_common_args(parser)
+    return parser
+
+
+def finish_run(result: Dict[str, Any], args: argparse.Namespace) -> int:
+    """Print the report, write --out and check --compare; exit status 1 on regressions"""
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"results written to {args.out}")
+
+    if baseline:
+        regressions = compare_results(baseline, result, args.tolerance)
+        if regressions:
+            print(f"\nREGRESSIONS vs {baseline.get('commit')}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nno regressions vs {baseline.get('commit')} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if not args.database_url:
+        print("A scratch Postgres database is required: set DATABASE_URL or pass --database-url", file=sys.stderr)
+        return 2
+    if not args.verbose:
+        logging.getLogger("main").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    main.install_event_loop()
+    result = asyncio.run(LoadTest(args).run())
+
+    return finish_run(result, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,17 +1,56 @@
 import os
+import sys
+import gzip
+import hmac
 import json
+import time
+import copy
+import datetime
+import hashlib
 import asyncio
+import atexit
 import logging
-from typing import Dict, Any, Optional
+import logging.handlers
+import random
+import functools
+import threading
+import socket
+import traceback
+from abc import ABC, abstractmethod
+import urllib.request
+import queue as queue_mod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from collections import Counter as CounterDict, OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Dict, Any, AsyncIterator, Optional, List, Tuple
 
 import aiohttp
-import stripe
+import prometheus_client
 import psycopg
+from psycopg import sql
 from psycopg.rows import dict_row
+from prometheus_client import Counter, Histogram
+
+try:
+    import psycopg_pool
+except ImportError:  # optional: without it every DB helper opens its own connection
+    psycopg_pool = None
+
+try:
+    import orjson
+except ImportError:  # optional: PERF_PROFILE=fast falls back to stdlib json
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:  # optional: PERF_PROFILE=fast falls back to the default event loop
+    uvloop = None
 
 from dotenv import load_dotenv
 
-from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi import FastAPI, Request, Header, HTTPException, Response, Depends
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 
 from telegram import (
     Update,
@@ -19,11 +58,14 @@ from telegram import (
     InlineKeyboardMarkup,
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -36,12 +78,106 @@ load_dotenv()
 # -------------------------
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "").strip()
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions").strip()
+# Comma-separated pool of lyrics models, in order of preference
+OPENROUTER_MODELS = [m.strip() for m in os.getenv("OPENROUTER_MODELS", "openai/gpt-3.5-turbo").split(",") if m.strip()]
+# Hedged requests: fire the next model if the first hasn't answered within its p90
+OPENROUTER_HEDGE = os.getenv("OPENROUTER_HEDGE", "").strip().lower() in ("1", "true", "yes")
+# Hedge delay (seconds) used until a model has latency samples
+OPENROUTER_HEDGE_DELAY = float(os.getenv("OPENROUTER_HEDGE_DELAY", "8"))
+# Voice-note topics: "openai" streams them to an OpenAI-compatible /audio/transcriptions
+# endpoint, "local" is an offline stand-in (tests, load tests); unset disables voice input
+TRANSCRIBE_API_KEY = os.getenv("TRANSCRIBE_API_KEY", os.getenv("OPENAI_API_KEY", "")).strip()
+TRANSCRIBE_BACKEND = os.getenv("TRANSCRIBE_BACKEND", "openai" if TRANSCRIBE_API_KEY else "").strip().lower()
+TRANSCRIBE_URL = os.getenv("TRANSCRIBE_URL", "https://api.openai.com/v1/audio/transcriptions").strip()
+TRANSCRIBE_MODEL = os.getenv("TRANSCRIBE_MODEL", "whisper-1").strip()
+# Transcriptions running at once; further voice notes wait for a slot
+TRANSCRIBE_CONCURRENCY = max(1, int(os.getenv("TRANSCRIBE_CONCURRENCY", "4")))
+# Longer voice notes are refused before anything is downloaded
+VOICE_MAX_SECONDS = int(os.getenv("VOICE_MAX_SECONDS", "120"))
+# Number of lyric variants generated concurrently per topic (1 = single answer)
+LYRICS_VARIANTS = min(5, max(1, int(os.getenv("LYRICS_VARIANTS", "1"))))
 
 PIAPI_API_KEY = os.getenv("PIAPI_API_KEY", "").strip()
 PIAPI_BASE_URL = os.getenv("PIAPI_BASE_URL", "").strip().rstrip("/")
 PIAPI_GENERATE_PATH = os.getenv("PIAPI_GENERATE_PATH", "/suno/music").strip()
+# Fetches an existing task's result, so a resumed generation is not submitted (and billed) again
+PIAPI_TASK_PATH = os.getenv("PIAPI_TASK_PATH", "/task/{task_id}").strip()
+# Identical generations (same lyrics, tags, title, instrumental flag) reuse a result for this many seconds
+PIAPI_DEDUPE_TTL = float(os.getenv("PIAPI_DEDUPE_TTL", "900"))
+# Upstream cost of one PIAPI task in USD, used to report dedupe savings
+PIAPI_TASK_COST = float(os.getenv("PIAPI_TASK_COST", "0.10"))
 
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# "fast": uvloop, orjson for upstream/API JSON, pipelined and prepared DB statements (each where available)
+PERF_PROFILE = os.getenv("PERF_PROFILE", "default").strip().lower()
+# Seconds to let in-flight updates and generations finish on SIGTERM before checkpointing them
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "25"))
+# An instance resuming an interrupted generation holds it this long; after that (it crashed
+# mid-resume) the next instance to start takes it over
+GENERATION_LEASE_SECONDS = float(os.getenv("GENERATION_LEASE_SECONDS", "900"))
+INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}"
+# /readyz fails while more Telegram updates than this are waiting
+READY_MAX_QUEUE = int(os.getenv("READY_MAX_QUEUE", "100"))
+# Migration DDL gives up instead of queueing behind long transactions on a hot table,
+# which would block every query that lines up behind it
+MIGRATION_LOCK_TIMEOUT = os.getenv("MIGRATION_LOCK_TIMEOUT", "5s").strip()
+MIGRATION_LOCK_POLL = 0.5  # seconds between attempts while another instance migrates
+# Retries of a migration whose lock_timeout fired, waiting MIGRATION_RETRY_DELAY seconds, doubling each time
+MIGRATION_LOCK_RETRIES = int(os.getenv("MIGRATION_LOCK_RETRIES", "4"))
+MIGRATION_RETRY_DELAY = 1.0
+# Rows per transaction in migration backfills
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", "5000"))
+# Cache for hot lookups (user language, checkout URLs, voice transcripts): "local" is a per-process LRU,
+# "postgres" is shared by all workers through the UNLOGGED kv_cache table and is required with
+# more than one worker: a write or invalidation in the local backend only reaches its own process
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local").strip().lower()
+# Worker processes serving the app; uvicorn --workers and gunicorn both read it
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", "10000"))  # entries kept by the local backend
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))    # seconds, for entries stored without their own TTL
+CACHE_SWEEP_INTERVAL = 60  # seconds between deletes of expired kv_cache rows
+# Language is written through by set_lang, so it can live long
+LANG_CACHE_TTL = float(os.getenv("LANG_CACHE_TTL", "3600"))
+# Seconds a per-process copy of a value another worker may change is kept: languages and
+# checkout URLs in the local backend, and the language tier in front of the postgres backend
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", "15"))
+# Repeated taps on a pack reuse the open Stripe session (they stay payable for 24h)
+CHECKOUT_CACHE_TTL = float(os.getenv("CHECKOUT_CACHE_TTL", "1800"))
+# A file_unique_id always names the same audio, so its transcript can live long
+TRANSCRIPT_CACHE_TTL = float(os.getenv("TRANSCRIPT_CACHE_TTL", "86400"))
+
+# JSON list of pre-generated demo clips, see load_demo_library()
+DEMO_LIBRARY_PATH = os.getenv("DEMO_LIBRARY_PATH", "demo_clips.json").strip()
+
+# Per-update tracing: "file" appends OTLP JSON lines to TRACE_FILE, "otlp" posts to TRACE_OTLP_ENDPOINT
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "").strip().lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl").strip()
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces").strip()
+# Fraction of normal updates exported; slow updates are always exported
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.1"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "2000"))
+# Sampling stack profiler for slow updates; profiles land in TRACE_PROFILE_DIR
+TRACE_PROFILE = os.getenv("TRACE_PROFILE", "").strip().lower() in ("1", "true", "yes")
+TRACE_PROFILE_INTERVAL_MS = float(os.getenv("TRACE_PROFILE_INTERVAL_MS", "10"))
+TRACE_PROFILE_DIR = os.getenv("TRACE_PROFILE_DIR", "profiles").strip()
+
+# Record incoming updates and Stripe webhooks (PII scrubbed, gzip NDJSON) for replay.py
+CAPTURE_FILE = os.getenv("CAPTURE_FILE", "").strip()
+# Secret key for pseudonymising user ids and file ids in captures. Unset: a random key per
+# process, never written anywhere (a known key would let anyone brute-force the ~10-digit ids
+# back). Set it to keep pseudonyms stable across restarts, and keep it out of the capture.
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "").strip() or os.urandom(32).hex()
+# Admin broadcasts: Telegram allows ~30 messages/s per bot, stay below it
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", os.getenv("ADMIN_ID", "")).split(",") if x.strip().isdigit()}
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = max(1, int(os.getenv("BROADCAST_WORKERS", "8")))
+# Recipients fetched per cursor round trip and statuses written per batch
+BROADCAST_BATCH = max(1, int(os.getenv("BROADCAST_BATCH", "500")))
+# Bearer token for the /admin HTTP endpoints (exports, stats); unset disables them
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "").strip()
 
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY", "").strip()
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET", "").strip()
@@ -51,17 +187,694 @@ BOT_USERNAME = os.getenv("BOT_USERNAME", "").strip()
 STRIPE_SUCCESS_URL = os.getenv("STRIPE_SUCCESS_URL", f"https://t.me/{BOT_USERNAME}" if BOT_USERNAME else "").strip()
 STRIPE_CANCEL_URL = os.getenv("STRIPE_CANCEL_URL", f"https://t.me/{BOT_USERNAME}" if BOT_USERNAME else "").strip()
 
+# Logging: "json" writes one JSON object per line with the update's correlation ids
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+# Records waiting for the writer thread; beyond this they are dropped rather than block the loop
+LOG_QUEUE_SIZE = max(1, int(os.getenv("LOG_QUEUE_SIZE", "10000")))
+# Per-logger sampling of records below WARNING, e.g. "main.updates=0.1,httpx=0.01"
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "").strip()
+
 # -------------------------
 # Logging
 # -------------------------
-logging.basicConfig(level=logging.INFO)
+def parse_sampling(spec: str) -> Dict[str, float]:
+    rates: Dict[str, float] = {}
+    for part in spec.split(","):
+        name, _, rate = part.partition("=")
+        if name.strip() and rate.strip():
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+def log_context() -> Dict[str, Any]:
+    """Correlation ids of the update being handled on this task, if any"""
+    span = _current_span.get()
+    if span is None:
+        return {}
+    root = span.root or span
+    ctx = {"trace_id": root.trace_id, "update_id": root.attrs.get("update.id")}
+    if "user.id" in root.attrs:
+        ctx["user_id"] = root.attrs["user.id"]
+    return ctx
+
+class SamplingFilter(logging.Filter):
+    """Keep a fraction of sub-WARNING records per logger; the most specific configured prefix wins"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._resolved: Dict[str, float] = {}
+
+    def rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            rate, probe = 1.0, name
+            while probe:
+                if probe in self.rates:
+                    rate = self.rates[probe]
+                    break
+                probe = probe.rpartition(".")[0]
+            self._resolved[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a QueueListener thread instead of writing on the caller's thread.
+    Only the %-interpolation and correlation ids are resolved here; JSON encoding,
+    tracebacks and stream I/O happen on the writer. A full queue drops the record.
+    """
+
+    def __init__(self, q: "queue_mod.Queue[logging.LogRecord]"):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        record.context = log_context()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue_mod.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        doc = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        doc.update(getattr(record, "context", None) or {})
+        if record.exc_info:
+            doc["exc"] = self.formatException(record.exc_info)
+        return json.dumps(doc, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """logging.basicConfig's layout, with the trace id appended inside an update"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        trace_id = (getattr(record, "context", None) or {}).get("trace_id")
+        return f"{line} trace={trace_id}" if trace_id else line
+
+LOG_HANDLER: Optional[AsyncQueueHandler] = None
+LOG_LISTENER: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging():
+    """Like logging.basicConfig: leaves an already configured root logger alone"""
+    global LOG_HANDLER, LOG_LISTENER
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    if root.handlers:
+        return
+    writer = logging.StreamHandler()
+    writer.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter(logging.BASIC_FORMAT))
+    LOG_HANDLER = AsyncQueueHandler(queue_mod.Queue(LOG_QUEUE_SIZE))
+    rates = parse_sampling(LOG_SAMPLING)
+    if rates:
+        LOG_HANDLER.addFilter(SamplingFilter(rates))
+    LOG_LISTENER = logging.handlers.QueueListener(LOG_HANDLER.queue, writer)
+    LOG_LISTENER.start()
+    root.addHandler(LOG_HANDLER)
+    atexit.register(LOG_LISTENER.stop)
+
+def flush_logs(timeout: float = 2.0):
+    """Wait (bounded) for queued records to be written"""
+    if LOG_HANDLER is None:
+        return
+    deadline = time.monotonic() + timeout
+    while LOG_HANDLER.queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+setup_logging()
 log = logging.getLogger(__name__)
+# Per-update chatter; sample it with LOG_SAMPLING="main.updates=..." under load
+update_log = logging.getLogger(f"{__name__}.updates")
+
+# -------------------------
+# Performance profile
+# -------------------------
+FAST_PROFILE = PERF_PROFILE == "fast"
+FAST_JSON = FAST_PROFILE and orjson is not None
+FAST_LOOP = FAST_PROFILE and uvloop is not None
+DB_PIPELINE = FAST_PROFILE and psycopg.Pipeline.is_supported()
+
+def json_dumps(obj: Any) -> str:
+    if FAST_JSON:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+def json_loads(data: Any) -> Any:
+    return orjson.loads(data) if FAST_JSON else json.loads(data)
+
+def install_event_loop():
+    """Make asyncio.run() use uvloop in the fast profile (uvicorn gets loop= separately)"""
+    if FAST_LOOP:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+def perf_profile() -> Dict[str, Any]:
+    """What the profile actually resolved to; "fast" silently degrades per missing package"""
+    return {
+        "profile": PERF_PROFILE,
+        "json": "orjson" if FAST_JSON else "json",
+        "loop": "uvloop" if FAST_LOOP else "asyncio",
+        "db_pipeline": DB_PIPELINE,
+        "db_prepare": FAST_PROFILE and DB_POOL is not None,
+    }
+
+# -------------------------
+# Metrics (Prometheus text format, served at /metrics)
+# -------------------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+prometheus_client.disable_created_metrics()  # *_created series only add scrape volume here
+
+class Gauge(prometheus_client.Gauge):
+    """Gauge whose set_function takes the label values; a failing function (e.g. a pool that
+    is already closed) reports NaN instead of failing the whole scrape"""
+
+    def set_function(self, fn, *values: str):
+        """Evaluate fn at scrape time instead of tracking the value"""
+        def sample() -> float:
+            try:
+                return fn()
+            except Exception:
+                return float("nan")
+        prometheus_client.Gauge.set_function(self.labels(*values) if values else self, sample)
+
+def render_metrics(registry: prometheus_client.CollectorRegistry = prometheus_client.REGISTRY) -> str:
+    return prometheus_client.generate_latest(registry).decode("utf-8")
+
+DB_SECONDS = Histogram("musicai_db_seconds", "Latency of DB helpers", ("op",), buckets=LATENCY_BUCKETS)
+UPSTREAM_SECONDS = Histogram("musicai_upstream_seconds", "Latency of upstream API calls", ("service", "op"), buckets=LATENCY_BUCKETS)
+CALLBACKS = Counter("musicai_callbacks_total", "Callback queries by action", ("action",))
+ERRORS = Counter("musicai_errors_total", "Errors by location and exception type", ("where", "type"))
+QUEUE_DEPTH = Gauge("musicai_queue_depth", "Work waiting or in flight", ("queue",))
+DB_CONNECTIONS = Gauge("musicai_db_connections", "Open DB connections")
+DB_STATEMENTS = Counter("musicai_db_statements_total", "SQL statements executed")
+
+def count_error(where: str, exc: BaseException):
+    ERRORS.labels(where, type(exc).__name__).inc()
+
+LOG_DROPPED = Gauge("musicai_log_records_dropped", "Log records dropped because the writer thread fell behind")
+if LOG_HANDLER is not None:
+    QUEUE_DEPTH.set_function(LOG_HANDLER.queue.qsize, "log_records")
+    LOG_DROPPED.set_function(lambda: LOG_HANDLER.dropped)
+
+# -------------------------
+# Tracing (per-update spans, slow-update profiles)
+# -------------------------
+@dataclass
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: str = ""
+    start_ns: int = field(default_factory=time.time_ns)
+    duration: float = 0.0
+    attrs: Dict[str, Any] = field(default_factory=dict)
+    error: str = ""
+    # Finished child spans of the whole trace; only populated on the root span
+    spans: List["Span"] = field(default_factory=list)
+    root: Optional["Span"] = None
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def current_trace_id() -> str:
+    span = _current_span.get()
+    return span.trace_id if span else ""
+
+def _span_begin(name: str, attrs: Optional[Dict[str, Any]] = None):
+    """Open a child span if a trace is active; returns state for _span_end or None"""
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    child = Span(name, parent.trace_id, os.urandom(8).hex(), parent.span_id, attrs=attrs or {},
+                 root=parent.root or parent)
+    return child, _current_span.set(child), time.perf_counter()
+
+def _span_end(state, error: Optional[BaseException] = None):
+    child, token, started = state
+    child.duration = time.perf_counter() - started
+    if error is not None:
+        child.error = f"{type(error).__name__}: {error}"
+    _current_span.reset(token)
+    child.root.spans.append(child)
+
+@contextmanager
+def span(name: str, **attrs):
+    """Child span around an arbitrary block; no-op outside a traced update"""
+    state = _span_begin(name, attrs)
+    if state is None:
+        yield None
+        return
+    try:
+        yield state[0]
+    except BaseException as e:
+        _span_end(state, e)
+        raise
+    _span_end(state)
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+def _otlp_span(s: Span) -> Dict[str, Any]:
+    end_ns = s.start_ns + int(s.duration * 1e9)
+    out = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "parentSpanId": s.parent_id,
+        "name": s.name,
+        "kind": 2 if not s.parent_id else 1,  # SERVER for the update, INTERNAL below it
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in s.attrs.items()],
+    }
+    if s.error:
+        out["status"] = {"code": 2, "message": s.error}
+    return out
+
+def otlp_payload(root: Span) -> Dict[str, Any]:
+    """OTLP/JSON ExportTraceServiceRequest for one finished trace"""
+    return {"resourceSpans": [{
+        "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "musicai"}}]},
+        "scopeSpans": [{
+            "scope": {"name": "musicai"},
+            "spans": [_otlp_span(root)] + [_otlp_span(s) for s in root.spans],
+        }],
+    }]}
+
+class TraceExporter:
+    """Background-thread exporter so span I/O never runs on the event loop"""
+
+    def __init__(self, kind: str, max_queue: int = 1000):
+        self.kind = kind
+        self.queue: "queue_mod.Queue[Dict[str, Any]]" = queue_mod.Queue(max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def submit(self, root: Span):
+        try:
+            self.queue.put_nowait(otlp_payload(root))
+        except queue_mod.Full:
+            self.dropped += 1
+
+    def flush(self, timeout: float = 5.0):
+        """Wait (bounded) for queued spans to be written"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _run(self):
+        while True:
+            payload = self.queue.get()
+            try:
+                if self.kind == "otlp":
+                    req = urllib.request.Request(
+                        TRACE_OTLP_ENDPOINT,
+                        data=json.dumps(payload).encode("utf-8"),
+                        headers={"Content-Type": "application/json"},
+                    )
+                    urllib.request.urlopen(req, timeout=5).close()
+                else:
+                    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(payload, ensure_ascii=False) + "\n")
+            except Exception as e:
+                log.warning("Trace export failed: %s", e)
+            finally:
+                self.queue.task_done()
+
+class StackSampler:
+    """Samples all thread stacks while traced updates are running.
+
+    Samples are kept in a short ring buffer; when an update turns out slow, the
+    samples taken during its lifetime are folded into a flamegraph-ready profile.
+    The profile is process-wide: it covers every thread in that window, including
+    concurrent updates and DB work in worker threads, not just the slow update.
+    Folding and writing happen on a writer thread, never on the event loop.
+    """
+
+    IDLE_LEAVES = {"select", "poll", "epoll", "wait", "_wait_for_tstate_lock", "get", "_worker", "sleep"}
+
+    def __init__(self, interval: float, window: float = 120.0):
+        self.interval = interval
+        self.samples: deque = deque(maxlen=max(1, int(window / interval)))
+        self.active = 0
+        self._wake = threading.Event()
+        self._dumps: "queue_mod.Queue[Span]" = queue_mod.Queue(100)
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+        self._writer = threading.Thread(target=self._write_dumps, name="profile-writer", daemon=True)
+        self._writer.start()
+
+    def enter(self):
+        self.active += 1
+        self._wake.set()
+
+    def exit(self):
+        self.active -= 1
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while True:
+            if self.active <= 0:
+                self._wake.clear()
+                self._wake.wait()
+            now = time.time_ns()
+            for ident, frame in sys._current_frames().items():
+                if ident == me or frame.f_code.co_name in self.IDLE_LEAVES:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = [names.get(ident, str(ident))]
+                stack.extend(f"{f.f_code.co_name} ({os.path.basename(f.f_code.co_filename)}:{lineno})"
+                             for f, lineno in reversed(list(traceback.walk_stack(frame))))
+                self.samples.append((now, ";".join(stack)))
+            time.sleep(self.interval)
+
+    def profile(self, start_ns: int, end_ns: int) -> List[Tuple[str, int]]:
+        folded = CounterDict(stack for ts, stack in list(self.samples) if start_ns <= ts <= end_ns)
+        return folded.most_common()
+
+    def dump(self, root: Span) -> str:
+        folded = self.profile(root.start_ns, root.start_ns + int(root.duration * 1e9))
+        if not folded:
+            return ""
+        os.makedirs(TRACE_PROFILE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_PROFILE_DIR, f"{root.trace_id}.process.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in folded:
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def dump_later(self, root: Span):
+        """Queue a slow update's profile for the writer thread"""
+        try:
+            self._dumps.put_nowait(root)
+        except queue_mod.Full:
+            log.warning("Dropping stack profile for trace %s: profile writer is behind", root.trace_id)
+
+    def flush(self, timeout: float = 5.0):
+        """Wait (bounded) for queued profiles to be written"""
+        deadline = time.monotonic() + timeout
+        while self._dumps.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    def _write_dumps(self):
+        while True:
+            root = self._dumps.get()
+            try:
+                path = self.dump(root)
+                if path:
+                    log.warning("Process-wide stack profile during update %s written to %s",
+                                root.attrs.get("update.id"), path)
+            except Exception as e:
+                log.warning("Stack profile for trace %s failed: %s", root.trace_id, e)
+            finally:
+                self._dumps.task_done()
+
+TRACE_EXPORT: Optional[TraceExporter] = TraceExporter(TRACE_EXPORTER) if TRACE_EXPORTER in ("file", "otlp") else None
+PROFILER: Optional[StackSampler] = StackSampler(TRACE_PROFILE_INTERVAL_MS / 1000) if TRACE_PROFILE else None
+
+def _update_attrs(update: Any) -> Tuple[str, Dict[str, Any]]:
+    attrs: Dict[str, Any] = {"update.id": getattr(update, "update_id", 0) or 0}
+    user = getattr(update, "effective_user", None)
+    if user:
+        attrs["user.id"] = user.id
+    query = getattr(update, "callback_query", None)
+    message = getattr(update, "message", None)
+    if query and query.data:
+        action = query.data.split(":", 1)[0]
+    elif message and message.text:
+        action = message.text.split()[0] if message.text.startswith("/") else "text"
+    elif message and message.voice:
+        action = "voice"
+    else:
+        action = "other"
+    attrs["action"] = action
+    return action, attrs
+
+def finish_trace(root: Span):
+    """Export (sampled, or always when slow) and profile slow updates"""
+    slow = root.duration * 1000 >= TRACE_SLOW_MS
+    if slow:
+        breakdown = ", ".join(f"{s.name}={s.duration * 1000:.0f}ms"
+                              for s in sorted(root.spans, key=lambda s: -s.duration)[:5])
+        log.warning("Slow update %s (%s %s): %.0fms [%s] trace=%s", root.attrs.get("update.id"), root.name,
+                    root.attrs.get("action"), root.duration * 1000, breakdown, root.trace_id)
+        if PROFILER:
+            PROFILER.dump_later(root)
+    if TRACE_EXPORT and (slow or random.random() < TRACE_SAMPLE_RATE):
+        TRACE_EXPORT.submit(root)
+
+# -------------------------
+# Instrumentation (latency metrics + spans)
+# -------------------------
+def timed(histogram: Histogram, *label_values: str):
+    """Decorator recording call latency (and errors) of a sync or async function.
+
+    Inside a traced update the call also becomes a child span.
+    """
+    child = histogram.labels(*label_values)
+    where = ".".join(label_values)
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                state = _span_begin(where)
+                started = time.perf_counter()
+                error = None
+                try:
+                    return await fn(*args, **kwargs)
+                except Exception as e:
+                    error = e
+                    count_error(where, e)
+                    raise
+                finally:
+                    child.observe(time.perf_counter() - started)
+                    if state:
+                        _span_end(state, error)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            state = _span_begin(where)
+            started = time.perf_counter()
+            error = None
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                error = e
+                count_error(where, e)
+                raise
+            finally:
+                child.observe(time.perf_counter() - started)
+                if state:
+                    _span_end(state, error)
+        return wrapper
+
+    return decorator
+
+inflight_updates = 0  # handlers running right now; only touched on the event loop
+QUEUE_DEPTH.set_function(lambda: inflight_updates, "updates_inflight")
+
+def traced_handler(fn):
+    """Wrap a Telegram handler so each update gets a root span with child spans below it"""
+    @functools.wraps(fn)
+    async def wrapper(update, context):
+        global inflight_updates
+        inflight_updates += 1
+        action, attrs = _update_attrs(update)
+        root = Span(fn.__name__, os.urandom(16).hex(), os.urandom(8).hex(), attrs=attrs)
+        token = _current_span.set(root)
+        if PROFILER:
+            PROFILER.enter()
+        started = time.perf_counter()
+        try:
+            return await fn(update, context)
+        except Exception as e:
+            root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            inflight_updates -= 1
+            root.duration = time.perf_counter() - started
+            _current_span.reset(token)
+            if PROFILER:
+                PROFILER.exit()
+            finish_trace(root)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API transport that records latency per Telegram method"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # File downloads carry the file path in the URL; keep label cardinality bounded
+        api_method = "getFileContent" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        child = UPSTREAM_SECONDS.labels("telegram", api_method)
+        state = _span_begin(f"telegram.{api_method}")
+        started = time.perf_counter()
+        error = None
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            error = e
+            count_error(f"telegram.{api_method}", e)
+            raise
+        finally:
+            child.observe(time.perf_counter() - started)
+            if state:
+                _span_end(state, error)
 
 # -------------------------
-# Stripe initialization
+# Traffic capture (scrubbed updates/webhooks for replay.py)
 # -------------------------
-if STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
+CAPTURE_FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+# Dropped outright wherever they appear (Telegram users/contacts, Stripe customer details)
+CAPTURE_PII_KEYS = {
+    "last_name", "username", "phone_number", "vcard", "bio", "email", "name",
+    "address", "phone", "customer_email", "receipt_email", "customer_details", "billing_details",
+    "shipping_details", "shipping",
+    # forward_origin of a hidden user, and where a user is
+    "sender_user_name", "author_signature", "location", "venue",
+}
+# Objects whose "id" is a Telegram user/chat id (forward_origin.sender_user in Bot API 7+,
+# forward_from/forward_from_chat in older payloads; member lists are scrubbed per element)
+CAPTURE_ID_PARENTS = {
+    "from", "chat", "user", "sender_chat", "sender_user", "forward_from", "forward_from_chat",
+    "new_chat_members", "left_chat_member",
+}
+# Chats whose "title" names a group or channel
+CAPTURE_CHAT_PARENTS = {"chat", "sender_chat", "forward_from_chat"}
+# Anyone holding the bot token can download the media behind a file id
+CAPTURE_FILE_KEYS = {"file_id", "file_unique_id"}
+
+def pseudo_id(value: int) -> int:
+    """Stable pseudonym for a user/chat id, so per-user update sequences survive scrubbing"""
+    digest = hmac.new(CAPTURE_SALT.encode(), str(value).encode(), hashlib.sha256).digest()
+    return 10**9 + int.from_bytes(digest[:8], "big") % (9 * 10**9)
+
+def pseudo_file_id(value: str) -> str:
+    """Same-length pseudonym for a file id; repeats of one voice note still match"""
+    digest = hmac.new(CAPTURE_SALT.encode(), value.encode(), hashlib.sha256).hexdigest()
+    return (digest * (len(value) // len(digest) + 1))[:len(value)]
+
+def _filler(text: str) -> str:
+    """Same-length placeholder; bot commands are kept so updates still route"""
+    if text.startswith("/"):
+        command, sep, rest = text.partition(" ")
+        return command + sep + _filler(rest)
+    return (CAPTURE_FILLER * (len(text) // len(CAPTURE_FILLER) + 1))[:len(text)]
+
+def scrub(obj: Any, parent: str = "") -> Any:
+    """Remove PII from an update or Stripe event while keeping its shape and sizes"""
+    if isinstance(obj, list):
+        return [scrub(v, parent) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    out = {}
+    for key, value in obj.items():
+        if key in CAPTURE_PII_KEYS:
+            continue
+        if key == "first_name":
+            out[key] = "User"  # required by the Bot API schema
+            continue
+        if key == "id" and parent in CAPTURE_ID_PARENTS and isinstance(value, int):
+            out[key] = pseudo_id(value)
+        elif key in ("text", "caption") and isinstance(value, str):
+            out[key] = _filler(value)
+        elif key == "title" and parent in CAPTURE_CHAT_PARENTS and isinstance(value, str):
+            out[key] = _filler(value)
+        elif key in CAPTURE_FILE_KEYS and isinstance(value, str):
+            out[key] = pseudo_file_id(value)
+        elif key == "data" and parent == "callback_query" and isinstance(value, str):
+            action, sep, arg = value.partition(":")
+            out[key] = f"{action}{sep}{pseudo_id(int(arg))}" if action == "generate" and arg.isdigit() else value
+        elif key == "user_id" and parent in ("metadata", "contact") and str(value).isdigit():
+            out[key] = str(pseudo_id(int(value)))
+        else:
+            out[key] = scrub(value, key)
+    return out
+
+class TrafficRecorder:
+    """Appends scrubbed traffic to a gzip NDJSON file from a background thread"""
+
+    def __init__(self, path: str, max_queue: int = 10000):
+        self.path = path
+        self.queue: "queue_mod.Queue[Optional[Tuple[float, str, Any]]]" = queue_mod.Queue(max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="traffic-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, kind: str, data: Any):
+        """kind is "update" (update dict) or "stripe" (raw webhook body)"""
+        try:
+            self.queue.put_nowait((time.time(), kind, data))
+        except queue_mod.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                ts, kind, data = item
+                try:
+                    if isinstance(data, bytes):
+                        data = json.loads(data)
+                    line = json.dumps({"ts": round(ts, 3), "kind": kind, "data": scrub(data)},
+                                      ensure_ascii=False, separators=(",", ":"))
+                except Exception as e:
+                    log.warning("Dropping unrecordable %s: %s", kind, e)
+                    continue
+                f.write(line + "\n")
+                if self.queue.empty():
+                    f.flush()
+
+    def close(self, timeout: float = 5.0):
+        self.queue.put(None)
+        self._thread.join(timeout)
+
+RECORDER: Optional[TrafficRecorder] = TrafficRecorder(CAPTURE_FILE) if CAPTURE_FILE else None
+
+async def capture_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Group -1 handler: sees every update before the real handlers"""
+    if RECORDER:
+        RECORDER.record("update", update.to_dict())
+
+# -------------------------
+# Stripe (imported on first checkout or webhook: the SDK is the slowest import we have)
+# -------------------------
+_stripe_module = None
+
+def _stripe():
+    global _stripe_module
+    if _stripe_module is None:
+        import stripe
+        if STRIPE_SECRET_KEY:
+            stripe.api_key = STRIPE_SECRET_KEY
+        _stripe_module = stripe
+    return _stripe_module
 
 # -------------------------
 # Translations
@@ -78,6 +891,18 @@ TRANSLATIONS = {
         "done": "✅ Готово!",
         "error": "❌ Помилка: {}",
         "payment_success": "✅ Оплата пройшла успішно!\n\n💎 +{songs} пісень додано на ваш баланс.\n🎵 Ваш баланс: {balance} пісень\n\nТепер ви можете створювати персональні пісні!",
+        "demo": "🎧 Демо",
+        "demo_choose": "Оберіть жанр для безкоштовного демо:",
+        "demo_used": "Ви вже використали безкоштовне демо. Купіть пісні, щоб створити власну!",
+        "demo_unavailable": "Демо для цього вибору поки недоступне.",
+        "my_songs": "🎼 Мої пісні",
+        "songs_empty": "У вас ще немає пісень. Створіть першу!",
+        "songs_title": "🎼 Ваші пісні:",
+        "song_missing": "Пісню не знайдено.",
+        "transcribing": "🎙 Слухаю голосове...",
+        "voice_unavailable": "Голосові повідомлення зараз не підтримуються. Напишіть тему текстом.",
+        "voice_too_long": "Голосове задовге. Запишіть тему коротше, до {} секунд.",
+        "voice_empty": "Не вдалося розібрати голосове. Спробуйте ще раз або напишіть текстом.",
     },
     "en": {
         "welcome": "🎵 Welcome to MusicAI PRO!\nI'll help you create personalized songs.",
@@ -90,6 +915,18 @@ TRANSLATIONS = {
         "done": "✅ Done!",
         "error": "❌ Error: {}",
         "payment_success": "✅ Payment successful!\n\n💎 +{songs} songs added to your balance.\n🎵 Your balance: {balance} songs\n\nYou can now create your personalized songs!",
+        "demo": "🎧 Demo",
+        "demo_choose": "Choose a genre for your free demo:",
+        "demo_used": "You have already used your free demo. Buy songs to create your own!",
+        "demo_unavailable": "No demo is available for this choice yet.",
+        "my_songs": "🎼 My songs",
+        "songs_empty": "You don't have any songs yet. Create your first one!",
+        "songs_title": "🎼 Your songs:",
+        "song_missing": "Song not found.",
+        "transcribing": "🎙 Listening to your voice note...",
+        "voice_unavailable": "Voice notes aren't supported right now. Please type your topic.",
+        "voice_too_long": "That voice note is too long. Please keep the topic under {} seconds.",
+        "voice_empty": "I couldn't make out that voice note. Try again or type your topic.",
     },
     "ru": {
         "welcome": "🎵 Добро пожаловать в MusicAI PRO!\nЯ помогу создать персональную песню.",
@@ -102,6 +939,18 @@ TRANSLATIONS = {
         "done": "✅ Готово!",
         "error": "❌ Ошибка: {}",
         "payment_success": "✅ Оплата прошла успешно!\n\n💎 +{songs} песен добавлено на ваш баланс.\n🎵 Ваш баланс: {balance} песен\n\nТеперь вы можете создавать персональные песни!",
+        "demo": "🎧 Демо",
+        "demo_choose": "Выберите жанр для бесплатного демо:",
+        "demo_used": "Вы уже использовали бесплатное демо. Купите песни, чтобы создать свою!",
+        "demo_unavailable": "Демо для этого выбора пока недоступно.",
+        "my_songs": "🎼 Мои песни",
+        "songs_empty": "У вас пока нет песен. Создайте первую!",
+        "songs_title": "🎼 Ваши песни:",
+        "song_missing": "Песня не найдена.",
+        "transcribing": "🎙 Слушаю голосовое...",
+        "voice_unavailable": "Голосовые сообщения сейчас не поддерживаются. Напишите тему текстом.",
+        "voice_too_long": "Голосовое слишком длинное. Запишите тему короче, до {} секунд.",
+        "voice_empty": "Не удалось разобрать голосовое. Попробуйте ещё раз или напишите текстом.",
     },
     "pl": {
         "welcome": "🎵 Witamy w MusicAI PRO!\nPomogę Ci stworzyć spersonalizowaną piosenkę.",
@@ -114,11 +963,26 @@ TRANSLATIONS = {
         "done": "✅ Gotowe!",
         "error": "❌ Błąd: {}",
         "payment_success": "✅ Płatność zakończona sukcesem!\n\n💎 +{songs} piosenek dodano do twojego salda.\n🎵 Twoje saldo: {balance} piosenek\n\nTeraz możesz tworzyć spersonalizowane piosenki!",
+        "demo": "🎧 Demo",
+        "demo_choose": "Wybierz gatunek darmowego demo:",
+        "demo_used": "Darmowe demo zostało już wykorzystane. Kup piosenki, aby stworzyć własną!",
+        "demo_unavailable": "Demo dla tego wyboru nie jest jeszcze dostępne.",
+        "my_songs": "🎼 Moje piosenki",
+        "songs_empty": "Nie masz jeszcze piosenek. Stwórz pierwszą!",
+        "songs_title": "🎼 Twoje piosenki:",
+        "song_missing": "Nie znaleziono piosenki.",
+        "transcribing": "🎙 Słucham wiadomości głosowej...",
+        "voice_unavailable": "Wiadomości głosowe nie są teraz obsługiwane. Wpisz temat tekstem.",
+        "voice_too_long": "Wiadomość głosowa jest za długa. Nagraj temat krótszy niż {} sekund.",
+        "voice_empty": "Nie udało się rozpoznać wiadomości głosowej. Spróbuj ponownie lub wpisz temat.",
     },
 }
 
 LANGS = ["uk", "en", "ru", "es", "fr", "de", "pl"]
 
+GENRES = ["Pop", "Rock", "Hip-Hop", "Classical", "Club", "Custom"]
+MOODS = ["Happy", "Sad", "Love", "Party", "Support", "Custom"]
+
 # -------------------------
 # Pricing packs
 # -------------------------
@@ -131,14 +995,209 @@ PACKS = {
 # -------------------------
 # DB helpers (sync, call via asyncio.to_thread)
 # -------------------------
+class TrackedConnection(psycopg.Connection):
+    """psycopg connection that keeps the open-connection gauge and statement counts up to date"""
+
+    @classmethod
+    def connect(cls, *args, **kwargs):
+        conn = super().connect(*args, **kwargs)
+        DB_CONNECTIONS.inc()
+        return conn
+
+    def execute(self, query, params=None, **kwargs):
+        DB_STATEMENTS.inc()
+        span = _current_span.get()
+        if span is not None:
+            root = span.root or span
+            root.attrs["db.statements"] = root.attrs.get("db.statements", 0) + 1
+        return super().execute(query, params, **kwargs)
+
+    def close(self):
+        if not self.closed:
+            DB_CONNECTIONS.dec()
+        super().close()
+
+DB_POOL: Optional["psycopg_pool.ConnectionPool"] = None
+
+def open_db_pool() -> bool:
+    """Start the shared connection pool; False (direct connections) without psycopg_pool or DATABASE_URL"""
+    global DB_POOL
+    if psycopg_pool is None or not DATABASE_URL:
+        return False
+    DB_POOL = psycopg_pool.ConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN,
+        max_size=DB_POOL_MAX,
+        connection_class=TrackedConnection,
+        # Prepared statements live per connection, so only pooled connections benefit
+        kwargs={"row_factory": dict_row, "prepare_threshold": 0 if FAST_PROFILE else 5},
+        name="musicai",
+        open=False,
+    )
+    DB_POOL.open(wait=True, timeout=10)
+    QUEUE_DEPTH.set_function(lambda: DB_POOL.get_stats().get("requests_waiting", 0), "db_pool_waiting")
+    return True
+
+def close_db_pool(timeout: float = 5.0):
+    global DB_POOL
+    if DB_POOL is not None:
+        DB_POOL.close(timeout=timeout)
+        DB_POOL = None
+
+@contextmanager
 def db_conn():
+    """Connection for one unit of work: borrowed from the pool when it is open, else a fresh one"""
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL is not set")
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    if DB_POOL is not None and not DB_POOL.closed:
+        with DB_POOL.connection() as conn:
+            yield conn
+        return
+    with TrackedConnection.connect(DATABASE_URL, row_factory=dict_row) as conn:
+        yield conn
+
+@contextmanager
+def pipelined(conn: psycopg.Connection):
+    """In the fast profile, send the block's statements without waiting for each result:
+    one network round trip per sync point (a fetch or commit) instead of per statement"""
+    if DB_PIPELINE:
+        with conn.pipeline():
+            yield
+    else:
+        yield
+
+# Daily rollups kept current by triggers, so /admin/stats never scans the fact tables.
+# Days are UTC. Signups are counted under the user's current language: changing it
+# moves the user between buckets of their signup day.
+DAILY_STATS_SQL = """
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day DATE NOT NULL,
+    metric TEXT NOT NULL,
+    dimension TEXT NOT NULL DEFAULT '',
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, metric, dimension)
+);
+
+CREATE OR REPLACE FUNCTION bump_daily_stat(d DATE, m TEXT, dim TEXT, delta BIGINT) RETURNS void AS $$
+    INSERT INTO daily_stats (day, metric, dimension, value) VALUES (d, m, COALESCE(dim, ''), delta)
+    ON CONFLICT (day, metric, dimension) DO UPDATE SET value = daily_stats.value + EXCLUDED.value
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION daily_stats_users() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM bump_daily_stat((NEW.created_at AT TIME ZONE 'UTC')::date, 'signups', NEW.lang, 1);
+    ELSIF NEW.lang IS DISTINCT FROM OLD.lang THEN
+        PERFORM bump_daily_stat((OLD.created_at AT TIME ZONE 'UTC')::date, 'signups', OLD.lang, -1);
+        PERFORM bump_daily_stat((NEW.created_at AT TIME ZONE 'UTC')::date, 'signups', NEW.lang, 1);
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION daily_stats_payments() RETURNS trigger AS $$
+BEGIN
+    PERFORM bump_daily_stat((NEW.created_at AT TIME ZONE 'UTC')::date, 'packs_sold', NEW.pack, 1);
+    PERFORM bump_daily_stat((NEW.created_at AT TIME ZONE 'UTC')::date, 'revenue_cents', NEW.currency, NEW.amount_cents);
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION daily_stats_generations() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status = 'done' AND (TG_OP = 'INSERT' OR OLD.status IS DISTINCT FROM 'done') THEN
+        PERFORM bump_daily_stat((COALESCE(NEW.finished_at, NOW()) AT TIME ZONE 'UTC')::date, 'songs_generated', NEW.genre, 1);
+    END IF;
+    RETURN NULL;
+END $$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_daily_stats ON users;
+CREATE TRIGGER users_daily_stats AFTER INSERT OR UPDATE OF lang ON users
+    FOR EACH ROW EXECUTE FUNCTION daily_stats_users();
+DROP TRIGGER IF EXISTS payments_daily_stats ON payments;
+CREATE TRIGGER payments_daily_stats AFTER INSERT ON payments
+    FOR EACH ROW EXECUTE FUNCTION daily_stats_payments();
+DROP TRIGGER IF EXISTS generations_daily_stats ON generations;
+CREATE TRIGGER generations_daily_stats AFTER INSERT OR UPDATE OF status ON generations
+    FOR EACH ROW EXECUTE FUNCTION daily_stats_generations();
+"""
 
-def init_db():
-    with db_conn() as conn:
-        conn.execute("""
+# -------------------------
+# Schema migrations
+# -------------------------
+MIGRATION_LOCK_ID = 0x6D75736963616900  # pg advisory lock key ("musicai")
+
+@dataclass
+class Migration:
+    """
+    One schema step. Transactional steps run `sql` (or `fn(conn)`) in a single
+    transaction together with their version row. Non-transactional steps are for
+    CREATE INDEX CONCURRENTLY and batched backfills: they run on the autocommit
+    connection and must be safe to re-run if interrupted.
+    """
+    version: int
+    name: str
+    sql: str = ""
+    fn: Optional[Any] = None
+    transactional: bool = True
+
+def create_index_concurrently(conn, name: str, definition: str):
+    """Build an index without blocking writes; a failed earlier attempt leaves an INVALID index, which is rebuilt"""
+    row = conn.execute(
+        "SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid "
+        "WHERE c.relname = %s AND c.relnamespace = current_schema()::regnamespace",
+        (name,),
+    ).fetchone()
+    if row is not None:
+        if row["indisvalid"]:
+            return
+        log.warning("Dropping invalid index %s left by an interrupted build", name)
+        conn.execute(sql.SQL("DROP INDEX CONCURRENTLY IF EXISTS {}").format(sql.Identifier(name)))
+    conn.execute(sql.SQL("CREATE INDEX CONCURRENTLY {} ON ").format(sql.Identifier(name)) + sql.SQL(definition))
+
+def backfill_in_batches(conn, table: str, key: str, statement: str, params: Optional[Dict[str, Any]] = None,
+                        batch_size: int = 0, pause: float = 0.05) -> int:
+    """
+    Run `statement` over `table` in key ranges of batch_size rows, each batch its own
+    transaction (conn is in autocommit), so row locks are short and replicas keep up.
+    The statement sees the range as %(lo)s < key <= %(hi)s. Returns rows covered.
+    """
+    batch_size = batch_size or BACKFILL_BATCH
+    ident_table, ident_key = sql.Identifier(table), sql.Identifier(key)
+    lo = conn.execute(sql.SQL("SELECT min({}) - 1 AS lo FROM {}").format(ident_key, ident_table)).fetchone()["lo"]
+    next_range = sql.SQL(
+        "SELECT max(k) AS hi, count(*) AS n FROM (SELECT {key} AS k FROM {table} WHERE {key} > %s ORDER BY {key} LIMIT %s) b"
+    ).format(key=ident_key, table=ident_table)
+    total = 0
+    while lo is not None:
+        window = conn.execute(next_range, (lo, batch_size)).fetchone()
+        if not window["n"]:
+            break
+        conn.execute(statement, {**(params or {}), "lo": lo, "hi": window["hi"]})
+        total += window["n"]
+        lo = window["hi"]
+        if pause:
+            time.sleep(pause)
+    return total
+
+def _backfill_signups(conn):
+    """
+    Rebuild signup rollups from users (for users from before the triggers existed).
+    Only users created before the rebuild started are counted; later ones come from
+    the trigger. A language change made while the backfill runs can be off by one.
+    """
+    t0 = conn.execute(
+        "WITH d AS (DELETE FROM daily_stats WHERE metric = 'signups') SELECT NOW() AS t0"
+    ).fetchone()["t0"]
+    count = backfill_in_batches(conn, "users", "user_id", """
+        INSERT INTO daily_stats (day, metric, dimension, value)
+        SELECT (created_at AT TIME ZONE 'UTC')::date, 'signups', lang, COUNT(*) FROM users
+        WHERE user_id > %(lo)s AND user_id <= %(hi)s AND created_at < %(t0)s
+        GROUP BY 1, 3
+        ON CONFLICT (day, metric, dimension) DO UPDATE SET value = daily_stats.value + EXCLUDED.value
+    """, {"t0": t0})
+    log.info("Backfilled signups for %s users", count)
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "users", """
         CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
             lang TEXT NOT NULL DEFAULT 'uk',
@@ -146,54 +1205,830 @@ def init_db():
             demo_used INT NOT NULL DEFAULT 0,
             created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
         )
-        """)
-        conn.commit()
+    """),
+    # Constant default: a catalog-only change, no table rewrite
+    Migration(2, "users_active", "ALTER TABLE users ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT TRUE"),
+    Migration(3, "broadcasts", """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            key TEXT NOT NULL,
+            langs TEXT[],
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_by BIGINT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id BIGINT NOT NULL REFERENCES broadcasts(id) ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            error TEXT,
+            sent_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (broadcast_id, user_id)
+        );
+    """),
+    Migration(4, "users_active_lang_idx", transactional=False, fn=lambda conn: create_index_concurrently(
+        conn, "users_active_lang_idx", "users (lang, user_id) WHERE active",
+    )),
+    # Indexes on brand-new tables are built in the same transaction: nothing to block yet
+    Migration(5, "payments_generations", """
+        CREATE TABLE IF NOT EXISTS payments (
+            session_id TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            pack TEXT NOT NULL,
+            songs INT NOT NULL,
+            amount_cents INT NOT NULL DEFAULT 0,
+            currency TEXT NOT NULL DEFAULT 'usd',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        CREATE INDEX IF NOT EXISTS payments_created_idx ON payments (created_at);
+        CREATE TABLE IF NOT EXISTS generations (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            genre TEXT,
+            mood TEXT,
+            lyrics TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            task_id TEXT,
+            error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS generations_created_idx ON generations (created_at);
+    """),
+    Migration(6, "songs", """
+        CREATE TABLE IF NOT EXISTS songs (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            generation_id BIGINT,
+            task_id TEXT,
+            title TEXT NOT NULL DEFAULT '',
+            tags TEXT NOT NULL DEFAULT '',
+            file_id TEXT,
+            audio_url TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        -- Serves every history page as one index range scan, however many songs a user has
+        CREATE INDEX IF NOT EXISTS songs_user_created_idx ON songs (user_id, created_at DESC, id DESC);
+    """),
+    Migration(7, "daily_stats", DAILY_STATS_SQL),
+    Migration(8, "daily_stats_signups_backfill", transactional=False, fn=_backfill_signups),
+    # UNLOGGED: no WAL and emptied after a crash, which is fine for a cache
+    Migration(9, "kv_cache", """
+        CREATE UNLOGGED TABLE IF NOT EXISTS kv_cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (namespace, key)
+        );
+        CREATE INDEX IF NOT EXISTS kv_cache_expires_idx ON kv_cache (expires_at);
+    """),
+    # Nullable columns without a default: catalog-only
+    Migration(10, "generations_lease", """
+        ALTER TABLE generations ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ,
+                                ADD COLUMN IF NOT EXISTS claimed_by TEXT
+    """),
+]
+
+def _apply_migration(conn, m: Migration, started: float):
+    if m.fn:
+        m.fn(conn)
+    else:
+        conn.execute(m.sql)
+    conn.execute(
+        "INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s)",
+        (m.version, m.name, int((time.perf_counter() - started) * 1000)),
+    )
+
+def _run_migration(conn, m: Migration):
+    """
+    Apply one migration. A transactional one that timed out waiting for a table lock has
+    been rolled back whole, so it is retried with backoff; anything else is not safe to rerun.
+    """
+    for attempt in range(MIGRATION_LOCK_RETRIES + 1):
+        started = time.perf_counter()
+        if not m.transactional:
+            _apply_migration(conn, m, started)
+            return
+        try:
+            with conn.transaction():
+                conn.execute("SELECT set_config('lock_timeout', %s, true)", (MIGRATION_LOCK_TIMEOUT,))
+                _apply_migration(conn, m, started)
+            return
+        except psycopg.errors.LockNotAvailable:
+            if attempt == MIGRATION_LOCK_RETRIES:
+                raise
+            delay = MIGRATION_RETRY_DELAY * 2 ** attempt
+            log.warning("Migration %s %s timed out waiting for a lock, retrying in %ss", m.version, m.name, delay)
+            time.sleep(delay)
+
+def migrate(migrations: Optional[List[Migration]] = None) -> List[int]:
+    """
+    Apply pending migrations in version order and return the versions applied.
+
+    Runs on its own autocommit session: the session-level advisory lock makes
+    concurrent runners (several instances booting at once) wait and then find
+    nothing left to do, and CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    """
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL is not set")
+    applied: List[int] = []
+    with TrackedConnection.connect(DATABASE_URL, row_factory=dict_row, autocommit=True) as conn:
+        # Poll rather than block in pg_advisory_lock: a waiter parked in that call is an
+        # open transaction, and CREATE INDEX CONCURRENTLY in the holder waits for it -> deadlock
+        while not conn.execute("SELECT pg_try_advisory_lock(%s) AS locked", (MIGRATION_LOCK_ID,)).fetchone()["locked"]:
+            time.sleep(MIGRATION_LOCK_POLL)
+        try:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                duration_ms INT NOT NULL DEFAULT 0
+            )
+            """)
+            done = {r["version"] for r in conn.execute("SELECT version FROM schema_migrations").fetchall()}
+            for m in sorted(migrations if migrations is not None else MIGRATIONS, key=lambda m: m.version):
+                if m.version in done:
+                    continue
+                log.info("Applying migration %s %s", m.version, m.name)
+                _run_migration(conn, m)
+                applied.append(m.version)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+    if applied:
+        log.info("Applied migrations %s", applied)
+    return applied
+
+@timed(DB_SECONDS, "init_db")
+def init_db():
+    migrate()
+
+# Reads name their columns: a server-side prepared SELECT * on a pooled connection fails with
+# "cached plan must not change result type" once a migration adds a column to the table
+USER_COLUMNS = "user_id, lang, balance, demo_used, active, created_at"
+SONG_COLUMNS = "id, user_id, generation_id, task_id, title, tags, file_id, audio_url, created_at"
+BROADCAST_COLUMNS = "id, key, langs, status, created_by, created_at, finished_at"
+
+# Helpers that touch a user row first make sure it exists, on the same connection and
+# in the same pipeline as the statements that follow
+USER_UPSERT = "INSERT INTO users (user_id) VALUES (%s) ON CONFLICT DO NOTHING"
 
-def ensure_user(user_id: int):
+@timed(DB_SECONDS, "ensure_user")
+def ensure_user(user_id: int, reactivate: bool = False):
+    """reactivate: the user reached us (e.g. /start after unblocking), make them reachable by broadcasts again"""
     with db_conn() as conn:
-        conn.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT DO NOTHING", (user_id,))
+        if reactivate:
+            conn.execute(
+                "INSERT INTO users (user_id) VALUES (%s) "
+                "ON CONFLICT (user_id) DO UPDATE SET active=TRUE WHERE NOT users.active",
+                (user_id,),
+            )
+        else:
+            conn.execute(USER_UPSERT, (user_id,))
         conn.commit()
 
+@timed(DB_SECONDS, "set_lang")
 def set_lang(user_id: int, lang: str):
-    ensure_user(user_id)
-    with db_conn() as conn:
+    with db_conn() as conn, pipelined(conn):
+        conn.execute(USER_UPSERT, (user_id,))
         conn.execute("UPDATE users SET lang=%s WHERE user_id=%s", (lang, user_id))
         conn.commit()
+    CACHE.set("lang", str(user_id), lang, LANG_CACHE_TTL)
+    LANG_LOCAL.set("lang", str(user_id), lang)
 
+@timed(DB_SECONDS, "get_user")
 def get_user(user_id: int) -> Dict[str, Any]:
-    ensure_user(user_id)
     with db_conn() as conn:
-        row = conn.execute("SELECT * FROM users WHERE user_id=%s", (user_id,)).fetchone()
+        with pipelined(conn):
+            conn.execute(USER_UPSERT, (user_id,))
+            cur = conn.execute(f"SELECT {USER_COLUMNS} FROM users WHERE user_id=%s", (user_id,))
+            conn.commit()
+        row = cur.fetchone()
         return dict(row) if row else {}
 
+@timed(DB_SECONDS, "add_balance")
 def add_balance(user_id: int, songs: int):
-    ensure_user(user_id)
-    with db_conn() as conn:
+    with db_conn() as conn, pipelined(conn):
+        conn.execute(USER_UPSERT, (user_id,))
         conn.execute("UPDATE users SET balance=balance+%s WHERE user_id=%s", (songs, user_id))
         conn.commit()
 
+@timed(DB_SECONDS, "consume_song")
 def consume_song(user_id: int) -> bool:
-    ensure_user(user_id)
     with db_conn() as conn:
-        row = conn.execute("SELECT balance FROM users WHERE user_id=%s", (user_id,)).fetchone()
-        if not row or row["balance"] < 1:
-            return False
-        conn.execute("UPDATE users SET balance=balance-1 WHERE user_id=%s", (user_id,))
+        with pipelined(conn):
+            conn.execute(USER_UPSERT, (user_id,))
+            cur = conn.execute(
+                "UPDATE users SET balance=balance-1 WHERE user_id=%s AND balance >= 1 RETURNING balance",
+                (user_id,),
+            )
+            conn.commit()
+        return cur.fetchone() is not None
+
+@timed(DB_SECONDS, "claim_demo")
+def claim_demo(user_id: int) -> bool:
+    """Atomically mark the free demo as used; False if it already was"""
+    with db_conn() as conn:
+        with pipelined(conn):
+            conn.execute(USER_UPSERT, (user_id,))
+            cur = conn.execute(
+                "UPDATE users SET demo_used=1 WHERE user_id=%s AND demo_used=0 RETURNING user_id",
+                (user_id,),
+            )
+            conn.commit()
+        return cur.fetchone() is not None
+
+@timed(DB_SECONDS, "release_demo")
+def release_demo(user_id: int):
+    """Give the demo back when delivery failed"""
+    with db_conn() as conn:
+        conn.execute("UPDATE users SET demo_used=0 WHERE user_id=%s", (user_id,))
+        conn.commit()
+
+@timed(DB_SECONDS, "record_payment")
+def record_payment(session_id: str, user_id: int, pack_id: str, amount_cents: int, currency: str) -> Optional[Dict[str, Any]]:
+    """
+    Store a completed checkout and credit its songs in one statement (one round trip).
+    Returns the user's new balance and lang for the notification, or None if this
+    session was already credited.
+    """
+    songs = int(PACKS[pack_id]["songs"])
+    with db_conn() as conn:
+        # The upsert creates the user row if needed: a plain UPDATE in the same
+        # statement could not see a row inserted by a sibling CTE
+        row = conn.execute(
+            "WITH paid AS ("
+            " INSERT INTO payments (session_id, user_id, pack, songs, amount_cents, currency)"
+            " VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (session_id) DO NOTHING RETURNING user_id, songs"
+            ") "
+            "INSERT INTO users (user_id, balance) SELECT user_id, songs FROM paid "
+            "ON CONFLICT (user_id) DO UPDATE SET balance = users.balance + EXCLUDED.balance "
+            "RETURNING balance, lang",
+            (session_id, user_id, pack_id, songs, amount_cents, currency),
+        ).fetchone()
+        conn.commit()
+    if row is None:
+        return None
+    # The paid session is finished; the next tap on this pack needs a new one
+    CACHE.delete("checkout", f"{user_id}:{pack_id}")
+    return dict(row)
+
+@timed(DB_SECONDS, "save_songs")
+def save_songs(user_id: int, generation_id: Optional[int], task_id: Optional[str], songs: List[Dict[str, Any]]):
+    """Remember delivered songs; each dict has title, tags, file_id and audio_url"""
+    if not songs:
+        return
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.executemany(
+                "INSERT INTO songs (user_id, generation_id, task_id, title, tags, file_id, audio_url) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s)",
+                [(user_id, generation_id, task_id, s.get("title") or "", s.get("tags") or "", s.get("file_id"), s.get("audio_url"))
+                 for s in songs],
+            )
+        conn.commit()
+
+@timed(DB_SECONDS, "song_page")
+def song_page(user_id: int, older_than: Optional[int] = None, newer_than: Optional[int] = None,
+              limit: int = 5) -> Tuple[List[Dict[str, Any]], bool, bool]:
+    """
+    One page of a user's songs, newest first, keyset-paginated from the id of the
+    song at the edge of the current page. Returns (songs, has_newer, has_older).
+    """
+    columns = "id, title, tags, created_at"
+    with db_conn() as conn:
+        if newer_than is not None:
+            rows = conn.execute(
+                f"SELECT {columns} FROM songs WHERE user_id=%s "
+                "AND (created_at, id) > (SELECT created_at, id FROM songs WHERE id=%s AND user_id=%s) "
+                "ORDER BY created_at, id LIMIT %s",
+                (user_id, newer_than, user_id, limit + 1),
+            ).fetchall()
+            has_newer = len(rows) > limit
+            return list(reversed(rows[:limit])), has_newer, True
+        if older_than is not None:
+            rows = conn.execute(
+                f"SELECT {columns} FROM songs WHERE user_id=%s "
+                "AND (created_at, id) < (SELECT created_at, id FROM songs WHERE id=%s AND user_id=%s) "
+                "ORDER BY created_at DESC, id DESC LIMIT %s",
+                (user_id, older_than, user_id, limit + 1),
+            ).fetchall()
+            return rows[:limit], True, len(rows) > limit
+        rows = conn.execute(
+            f"SELECT {columns} FROM songs WHERE user_id=%s ORDER BY created_at DESC, id DESC LIMIT %s",
+            (user_id, limit + 1),
+        ).fetchall()
+        return rows[:limit], False, len(rows) > limit
+
+@timed(DB_SECONDS, "get_song")
+def get_song(user_id: int, song_id: int) -> Dict[str, Any]:
+    with db_conn() as conn:
+        row = conn.execute(f"SELECT {SONG_COLUMNS} FROM songs WHERE id=%s AND user_id=%s", (song_id, user_id)).fetchone()
+        return dict(row) if row else {}
+
+@timed(DB_SECONDS, "set_song_file_id")
+def set_song_file_id(song_id: int, file_id: str):
+    with db_conn() as conn:
+        conn.execute("UPDATE songs SET file_id=%s WHERE id=%s", (file_id, song_id))
+        conn.commit()
+
+@timed(DB_SECONDS, "start_generation")
+def start_generation(user_id: int, lyrics: str, genre: str, mood: str) -> int:
+    with db_conn() as conn:
+        row = conn.execute(
+            "INSERT INTO generations (user_id, lyrics, genre, mood) VALUES (%s, %s, %s, %s) RETURNING id",
+            (user_id, lyrics, genre, mood),
+        ).fetchone()
+        conn.commit()
+        return row["id"]
+
+@timed(DB_SECONDS, "finish_generation")
+def finish_generation(generation_id: int, status: str, task_id: Optional[str] = None, error: Optional[str] = None):
+    with db_conn() as conn:
+        conn.execute(
+            "UPDATE generations SET status=%s, task_id=%s, error=%s, finished_at=NOW() WHERE id=%s",
+            (status, task_id, error, generation_id),
+        )
         conn.commit()
-        return True
+
+@timed(DB_SECONDS, "interrupt_generations")
+def interrupt_generations(generation_ids: List[int], task_ids: Optional[Dict[int, str]] = None) -> int:
+    """
+    Checkpoint generations cut off by a shutdown so the next instance resumes them,
+    keeping the PIAPI task id of those whose result had already arrived
+    """
+    task_ids = task_ids or {}
+    with db_conn() as conn:
+        cur = conn.execute(
+            "UPDATE generations g SET status='interrupted', task_id=COALESCE(t.task_id, g.task_id), "
+            "claimed_at=NULL, claimed_by=NULL "
+            "FROM unnest(%s::bigint[], %s::text[]) AS t(id, task_id) "
+            "WHERE g.id = t.id AND g.status IN ('pending', 'resuming')",
+            (generation_ids, [task_ids.get(gid) for gid in generation_ids]),
+        )
+        conn.commit()
+        return cur.rowcount
+
+@timed(DB_SECONDS, "claim_interrupted_generations")
+def claim_interrupted_generations(lease: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Lease interrupted generations from the last day to this instance as 'resuming'.
+    SKIP LOCKED lets instances starting together split the rows instead of queueing,
+    and a lease older than GENERATION_LEASE_SECONDS (its holder died) is taken over.
+    """
+    lease = GENERATION_LEASE_SECONDS if lease is None else lease
+    with db_conn() as conn:
+        rows = conn.execute(
+            """
+            UPDATE generations SET status='resuming', claimed_at=NOW(), claimed_by=%(me)s
+            WHERE id IN (
+                SELECT id FROM generations
+                WHERE (status='interrupted' OR (status='resuming' AND claimed_at < NOW() - make_interval(secs => %(lease)s)))
+                  AND created_at > NOW() - INTERVAL '1 day'
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, lyrics, genre, mood, task_id
+            """,
+            {"me": INSTANCE_ID, "lease": lease},
+        ).fetchall()
+        conn.commit()
+        return rows
+
+# -------------------------
+# Cache
+# -------------------------
+CACHE_REQUESTS = Counter("musicai_cache_requests_total", "Cache lookups by namespace and outcome", ("namespace", "outcome"))
+
+class Cache(ABC):
+    """
+    Key-value cache for hot lookups. Keys live in namespaces ("lang", "checkout",
+    "transcript") that can be invalidated as a whole. Values must be JSON-native, and
+    None is never stored, so get() returning None always means a miss.
+
+    Methods are sync; `blocking` backends do I/O and async callers run them in a thread.
+    """
+    name = ""
+    blocking = False
+
+    def __init__(self, default_ttl: float):
+        self.default_ttl = default_ttl
+        self._inflight: Dict[Tuple[str, str], "asyncio.Task[Any]"] = {}
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Any:
+        """The cached value, or None"""
+
+    @abstractmethod
+    def get_many(self, namespace: str, keys: List[str]) -> Dict[str, Any]:
+        """Values of the keys that are cached; misses are left out"""
+
+    def set(self, namespace: str, key: str, value: Any, ttl: Optional[float] = None):
+        self.set_many(namespace, {key: value}, ttl)
+
+    @abstractmethod
+    def set_many(self, namespace: str, items: Dict[str, Any], ttl: Optional[float] = None):
+        """Store the items for ttl seconds (default_ttl when None); None values are skipped"""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str):
+        """Drop one key"""
+
+    @abstractmethod
+    def invalidate(self, namespace: str):
+        """Drop every key in the namespace"""
+
+    def _count(self, namespace: str, hits: int, misses: int):
+        if hits:
+            CACHE_REQUESTS.labels(namespace, "hit").inc(hits)
+        if misses:
+            CACHE_REQUESTS.labels(namespace, "miss").inc(misses)
+
+    async def _call(self, fn, *args):
+        if self.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def get_or_compute(self, namespace: str, key: str, compute, ttl: Optional[float] = None) -> Any:
+        """
+        Cached value, or the result of `await compute()` stored under the key. Concurrent
+        misses for one key share a single compute; failures and None are not stored.
+        """
+        value = await self._call(self.get, namespace, key)
+        if value is not None:
+            return value
+        loop = asyncio.get_running_loop()
+        task = self._inflight.get((namespace, key))
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(self._compute(namespace, key, compute, ttl))
+            self._inflight[(namespace, key)] = task
+            task.add_done_callback(functools.partial(self._compute_done, (namespace, key)))
+        else:
+            CACHE_REQUESTS.labels(namespace, "coalesced").inc()
+        # Shield so one cancelled caller does not abort the compute for the others
+        return await asyncio.shield(task)
+
+    async def _compute(self, namespace: str, key: str, compute, ttl: Optional[float]) -> Any:
+        if self.blocking:
+            # Our miss was read in a thread: a compute for this key may have stored and
+            # left _inflight while it ran
+            value = await self._call(self.get, namespace, key)
+            if value is not None:
+                return value
+        value = await compute()
+        if value is not None:
+            await self._call(self.set, namespace, key, value, ttl)
+        return value
+
+    def _compute_done(self, inflight_key: Tuple[str, str], task: "asyncio.Task[Any]"):
+        if self._inflight.get(inflight_key) is task:
+            del self._inflight[inflight_key]
+
+class LocalCache(Cache):
+    """
+    Per-process LRU of `size` entries. Invalidating a namespace bumps its version, which
+    is part of every key, so it is O(1); the orphaned entries age out of the LRU.
+    ttl_caps bounds the TTL per namespace. Values are returned as stored: callers must not mutate them.
+    """
+    name = "local"
+
+    def __init__(self, size: int = CACHE_SIZE, default_ttl: float = CACHE_TTL,
+                 ttl_caps: Optional[Dict[str, float]] = None):
+        super().__init__(default_ttl)
+        self.size = size
+        self.ttl_caps = ttl_caps or {}
+        self._entries: "OrderedDict[Tuple[str, int, str], Tuple[float, Any]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()  # DB helpers write through from worker threads
+
+    def _lookup(self, k: Tuple[str, int, str], now: float) -> Any:
+        entry = self._entries.get(k)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[k]
+            return None
+        self._entries.move_to_end(k)
+        return entry[1]
+
+    def get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            value = self._lookup((namespace, self._versions.get(namespace, 0), key), time.monotonic())
+        self._count(namespace, value is not None, value is None)
+        return value
+
+    def get_many(self, namespace: str, keys: List[str]) -> Dict[str, Any]:
+        found = {}
+        now = time.monotonic()
+        with self._lock:
+            version = self._versions.get(namespace, 0)
+            for key in keys:
+                value = self._lookup((namespace, version, key), now)
+                if value is not None:
+                    found[key] = value
+        self._count(namespace, len(found), len(keys) - len(found))
+        return found
+
+    def set_many(self, namespace: str, items: Dict[str, Any], ttl: Optional[float] = None):
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires = time.monotonic() + min(ttl, self.ttl_caps.get(namespace, ttl))
+        with self._lock:
+            version = self._versions.get(namespace, 0)
+            for key, value in items.items():
+                if value is None:
+                    continue
+                k = (namespace, version, key)
+                self._entries[k] = (expires, value)
+                self._entries.move_to_end(k)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._entries.pop((namespace, self._versions.get(namespace, 0), key), None)
+
+    def invalidate(self, namespace: str):
+        with self._lock:
+            self._versions[namespace] = self._versions.get(namespace, 0) + 1
+
+class PostgresCache(Cache):
+    """
+    Shared by every worker through the UNLOGGED kv_cache table. Expired rows are ignored
+    on read; every CACHE_SWEEP_INTERVAL seconds a write also deletes them.
+    """
+    name = "postgres"
+    blocking = True
+
+    def __init__(self, default_ttl: float = CACHE_TTL, sweep_interval: float = CACHE_SWEEP_INTERVAL):
+        super().__init__(default_ttl)
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+
+    @timed(DB_SECONDS, "cache_get")
+    def get(self, namespace: str, key: str) -> Any:
+        with db_conn() as conn:
+            row = conn.execute(
+                "SELECT value FROM kv_cache WHERE namespace=%s AND key=%s AND expires_at > NOW()",
+                (namespace, key),
+            ).fetchone()
+            conn.commit()
+        self._count(namespace, row is not None, row is None)
+        return row["value"] if row else None
+
+    @timed(DB_SECONDS, "cache_get_many")
+    def get_many(self, namespace: str, keys: List[str]) -> Dict[str, Any]:
+        if not keys:
+            return {}
+        with db_conn() as conn:
+            rows = conn.execute(
+                "SELECT key, value FROM kv_cache WHERE namespace=%s AND key = ANY(%s) AND expires_at > NOW()",
+                (namespace, list(keys)),
+            ).fetchall()
+            conn.commit()
+        found = {r["key"]: r["value"] for r in rows}
+        self._count(namespace, len(found), len(keys) - len(found))
+        return found
+
+    @timed(DB_SECONDS, "cache_set")
+    def set_many(self, namespace: str, items: Dict[str, Any], ttl: Optional[float] = None):
+        items = {k: v for k, v in items.items() if v is not None}
+        if items:
+            with db_conn() as conn:
+                conn.execute(
+                    "INSERT INTO kv_cache (namespace, key, value, expires_at) "
+                    "SELECT %s, k, v, NOW() + make_interval(secs => %s) FROM unnest(%s::text[], %s::jsonb[]) AS t(k, v) "
+                    "ON CONFLICT (namespace, key) DO UPDATE SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at",
+                    (namespace, ttl if ttl is not None else self.default_ttl,
+                     list(items), [json_dumps(v) for v in items.values()]),
+                )
+                conn.commit()
+        if time.monotonic() - self._last_sweep >= self.sweep_interval:
+            self._last_sweep = time.monotonic()
+            self.sweep()
+
+    @timed(DB_SECONDS, "cache_delete")
+    def delete(self, namespace: str, key: str):
+        with db_conn() as conn:
+            conn.execute("DELETE FROM kv_cache WHERE namespace=%s AND key=%s", (namespace, key))
+            conn.commit()
+
+    @timed(DB_SECONDS, "cache_invalidate")
+    def invalidate(self, namespace: str):
+        with db_conn() as conn:
+            conn.execute("DELETE FROM kv_cache WHERE namespace=%s", (namespace,))
+            conn.commit()
+
+    @timed(DB_SECONDS, "cache_sweep")
+    def sweep(self, batch_size: int = 1000) -> int:
+        """Delete expired rows in short batches; returns how many"""
+        total = 0
+        with db_conn() as conn:
+            while True:
+                deleted = conn.execute(
+                    "DELETE FROM kv_cache WHERE ctid = ANY(ARRAY("
+                    " SELECT ctid FROM kv_cache WHERE expires_at <= NOW() LIMIT %s))",
+                    (batch_size,),
+                ).rowcount
+                conn.commit()
+                total += deleted
+                if deleted < batch_size:
+                    return total
+
+# Written or invalidated by whichever worker handled set_lang or the payment webhook
+CACHE_SHARED_NAMESPACES = ("lang", "checkout")
+
+def make_cache(backend: str) -> Cache:
+    if backend == "postgres":
+        return PostgresCache()
+    if backend != "local":
+        log.warning("Unknown CACHE_BACKEND '%s' - using local", backend)
+    # Other workers never see this process's writes, so what they may change is kept only briefly
+    return LocalCache(ttl_caps={ns: CACHE_LOCAL_TTL for ns in CACHE_SHARED_NAMESPACES})
+
+CACHE = make_cache(CACHE_BACKEND)
+# Per-process tier in front of a blocking CACHE for user_lang()
+LANG_LOCAL = LocalCache(default_ttl=CACHE_LOCAL_TTL)
 
 # -------------------------
 # Helpers
 # -------------------------
+def _shared_user_lang(user_id: int) -> str:
+    lang = CACHE.get("lang", str(user_id))
+    if lang is None:
+        lang = get_user(user_id).get("lang", "uk")
+        CACHE.set("lang", str(user_id), lang, LANG_CACHE_TTL)
+    return lang
+
+def user_lang(user_id: int) -> str:
+    """
+    The user's language; cached, since every tr() call needs it. tr() is sync and runs
+    on the event loop, so a blocking CACHE is only asked when LANG_LOCAL misses.
+    """
+    if not CACHE.blocking:
+        return _shared_user_lang(user_id)
+    lang = LANG_LOCAL.get("lang", str(user_id))
+    if lang is None:
+        lang = _shared_user_lang(user_id)
+        LANG_LOCAL.set("lang", str(user_id), lang)
+    return lang
+
 def tr(user_id: int, key: str) -> str:
     """Translate text for user"""
-    user = get_user(user_id)
-    lang = user.get("lang", "uk")
+    lang = user_lang(user_id)
     return TRANSLATIONS.get(lang, TRANSLATIONS["uk"]).get(key, key)
 
+# -------------------------
+# Shared HTTP client
+# -------------------------
+_http_session: Optional[aiohttp.ClientSession] = None
+_http_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def http_session() -> aiohttp.ClientSession:
+    """Process-wide aiohttp session so upstream calls reuse pooled keep-alive connections"""
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300), json_serialize=json_dumps,
+        )
+        _http_session_loop = loop
+    return _http_session
+
+async def close_http_session():
+    global _http_session
+    if _http_session is not None and not _http_session.closed and _http_session_loop is asyncio.get_running_loop():
+        await _http_session.close()
+    _http_session = None
+
+# -------------------------
+# OpenRouter model routing
+# -------------------------
+MODEL_STATS_WINDOW = 50       # latency samples kept per model
+MODEL_FAILURE_THRESHOLD = 3   # consecutive failures before a model is benched
+MODEL_COOLDOWN = 60.0         # seconds a benched model is skipped
+
+@dataclass
+class ModelStats:
+    """Rolling latency/error window for one lyrics model"""
+    model: str
+    latencies: deque = field(default_factory=lambda: deque(maxlen=MODEL_STATS_WINDOW))
+    requests: int = 0
+    errors: int = 0
+    consecutive_failures: int = 0
+    down_until: float = 0.0
+
+    def healthy(self, now: Optional[float] = None) -> bool:
+        return (now if now is not None else time.monotonic()) >= self.down_until
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def record_success(self, elapsed: float):
+        self.requests += 1
+        self.latencies.append(elapsed)
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+
+    def record_failure(self):
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= MODEL_FAILURE_THRESHOLD:
+            self.down_until = time.monotonic() + MODEL_COOLDOWN
+            log.warning("Lyrics model %s benched for %.0fs after %s failures",
+                        self.model, MODEL_COOLDOWN, self.consecutive_failures)
+
+MODEL_STATS: Dict[str, ModelStats] = {m: ModelStats(m) for m in OPENROUTER_MODELS}
+
+def model_stats(model: str) -> ModelStats:
+    stats = MODEL_STATS.get(model)
+    if stats is None:
+        stats = MODEL_STATS[model] = ModelStats(model)
+    return stats
+
+def rank_models() -> List[str]:
+    """Order the model pool: healthy first, then fastest median latency, then config order.
+
+    Models without samples yet keep their configured position behind measured ones;
+    hedging and failover give them traffic to learn from.
+    """
+    now = time.monotonic()
+
+    def key(item):
+        idx, model = item
+        stats = model_stats(model)
+        p50 = stats.percentile(50)
+        return (not stats.healthy(now), p50 is None, p50 or 0.0, idx)
+
+    return [model for _, model in sorted(enumerate(OPENROUTER_MODELS), key=key)]
+
 # -------------------------
 # OpenRouter lyrics generation
 # -------------------------
+async def _openrouter_call(session: aiohttp.ClientSession, model: str, prompt: str) -> str:
+    """Single chat completion against one model, recording latency/errors"""
+    stats = model_stats(model)
+    started = time.monotonic()
+    try:
+        async with session.post(
+            OPENROUTER_URL,
+            headers={
+                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+                "Content-Type": "application/json",
+            },
+            json={
+                "model": model,
+                "messages": [{"role": "user", "content": prompt}],
+            },
+        ) as resp:
+            if resp.status != 200:
+                text = await resp.text()
+                raise RuntimeError(f"OpenRouter error ({model}): {text}")
+            data = await resp.json(loads=json_loads)
+            content = data["choices"][0]["message"]["content"]
+    except asyncio.CancelledError:
+        # Lost a hedge race: the time until cancellation is not a latency sample,
+        # recording it would drag p50/p90 (and the ranking) towards the hedge delay
+        raise
+    except Exception:
+        stats.record_failure()
+        raise
+    stats.record_success(time.monotonic() - started)
+    return content
+
+async def _hedged_call(session: aiohttp.ClientSession, models: List[str], prompt: str) -> str:
+    """Race the two best models; the backup only starts once the primary is past its p90"""
+    primary, backup = models[0], models[1]
+    delay = model_stats(primary).percentile(90) or OPENROUTER_HEDGE_DELAY
+
+    pending = {asyncio.create_task(_openrouter_call(session, primary, prompt))}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done or next(iter(done)).exception() is not None:
+            log.info("Hedging lyrics request: %s -> %s after %.2fs", primary, backup, delay)
+            pending.add(asyncio.create_task(_openrouter_call(session, backup, prompt)))
+
+        last_error: Optional[BaseException] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is None:
+                    winner = winner or task
+                else:
+                    last_error = task.exception()
+            if winner:
+                return winner.result()
+        raise last_error
+    finally:
+        for task in pending:
+            task.cancel()
+
+@timed(UPSTREAM_SECONDS, "openrouter", "lyrics")
 async def openrouter_lyrics(topic: str, lang_code: str, genre: str, mood: str) -> str:
     """Generate song lyrics using OpenRouter"""
     if not OPENROUTER_API_KEY:
@@ -216,52 +2051,285 @@ Format:
 ...more lyrics with rhymes...
 """
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": "openai/gpt-3.5-turbo",
-                "messages": [{"role": "user", "content": prompt}],
-            },
-        ) as resp:
+    models = rank_models()
+    if not models:
+        raise RuntimeError("OPENROUTER_MODELS is empty")
+
+    session = http_session()
+    if OPENROUTER_HEDGE and len(models) > 1:
+        return await _hedged_call(session, models, prompt)
+
+    # Sequential failover through the ranked pool
+    last_error: Optional[Exception] = None
+    for model in models:
+        try:
+            return await _openrouter_call(session, model, prompt)
+        except Exception as e:
+            log.warning("Lyrics model %s failed: %s", model, e)
+            last_error = e
+    raise last_error
+
+async def openrouter_lyrics_variants(topic: str, lang_code: str, genre: str, mood: str, n: int) -> List[str]:
+    """Generate n lyric variants concurrently; failed variants are dropped"""
+    results = await asyncio.gather(
+        *(openrouter_lyrics(topic, lang_code, genre, mood) for _ in range(n)),
+        return_exceptions=True,
+    )
+    variants = [r for r in results if isinstance(r, str)]
+    if not variants:
+        raise results[0]
+    if len(variants) < n:
+        log.warning("Only %d/%d lyric variants succeeded", len(variants), n)
+    return variants
+
+# -------------------------
+# Voice topics (speech-to-text)
+# -------------------------
+VOICE_CHUNK = 64 * 1024  # bytes per read, both from disk and from the Telegram file URL
+
+class Transcriber(ABC):
+    """Speech-to-text backend: receives the audio as it downloads, one chunk at a time"""
+    name = ""
+
+    @abstractmethod
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, mime_type: str) -> str:
+        """The transcript of the audio in chunks"""
+
+class OpenAITranscriber(Transcriber):
+    """OpenAI-compatible /audio/transcriptions; the chunks go out as a chunked multipart upload"""
+    name = "openai"
+
+    def __init__(self, url: str, api_key: str, model: str):
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, mime_type: str) -> str:
+        form = aiohttp.FormData()
+        form.add_field("model", self.model)
+        form.add_field("response_format", "json")
+        form.add_field("file", chunks, filename=filename, content_type=mime_type)
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        async with http_session().post(self.url, data=form, headers=headers) as resp:
             if resp.status != 200:
                 text = await resp.text()
-                raise RuntimeError(f"OpenRouter error: {text}")
-            data = await resp.json()
-            return data["choices"][0]["message"]["content"]
+                raise RuntimeError(f"Transcription error {resp.status}: {text}")
+            data = await resp.json(loads=json_loads)
+        return (data.get("text") or "").strip()
+
+class LocalTranscriber(Transcriber):
+    """Offline stand-in: reads the whole stream (so downloads are exercised) and returns canned text"""
+    name = "local"
+
+    def __init__(self, text: str = "", delay: float = 0.0):
+        self.text = text
+        self.delay = delay
+        self.calls = 0
+        self.largest_chunk = 0
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, mime_type: str) -> str:
+        self.calls += 1
+        size = 0
+        async for chunk in chunks:
+            size += len(chunk)
+            self.largest_chunk = max(self.largest_chunk, len(chunk))
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return self.text or f"voice note {filename} ({size} bytes)"
+
+def make_transcriber(backend: str) -> Optional[Transcriber]:
+    if backend == "openai":
+        return OpenAITranscriber(TRANSCRIBE_URL, TRANSCRIBE_API_KEY, TRANSCRIBE_MODEL)
+    if backend == "local":
+        return LocalTranscriber()
+    if backend:
+        log.warning("Unknown TRANSCRIBE_BACKEND '%s' - voice input disabled", backend)
+    return None
+
+TRANSCRIBER = make_transcriber(TRANSCRIBE_BACKEND)
+
+QUEUE_DEPTH.set_function(lambda: sum(ns == "transcript" for ns, _ in list(CACHE._inflight)), "transcribe_inflight")
+
+_transcribe_slots: Optional[asyncio.Semaphore] = None
+_transcribe_slots_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def transcribe_slots() -> asyncio.Semaphore:
+    """TRANSCRIBE_CONCURRENCY slots, per event loop like the HTTP session"""
+    global _transcribe_slots, _transcribe_slots_loop
+    loop = asyncio.get_running_loop()
+    if _transcribe_slots is None or _transcribe_slots_loop is not loop:
+        _transcribe_slots = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+        _transcribe_slots_loop = loop
+    return _transcribe_slots
+
+async def file_chunks(path: str, chunk_size: int = VOICE_CHUNK) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+async def url_chunks(url: str, chunk_size: int = VOICE_CHUNK) -> AsyncIterator[bytes]:
+    """Yield the body as it arrives; aiohttp stops reading the socket while the consumer lags"""
+    async with http_session().get(url) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Voice download failed: HTTP {resp.status}")
+        async for chunk in resp.content.iter_chunked(chunk_size):
+            yield chunk
+
+def voice_chunks(source: Any) -> Tuple[AsyncIterator[bytes], str]:
+    """Chunks and file name of a local path or a Telegram File (a URL, or a path in local Bot API mode)"""
+    path = source if isinstance(source, str) else source.file_path
+    name = os.path.basename(path.split("?", 1)[0]) or "voice.ogg"
+    if path.startswith(("http://", "https://")):
+        return url_chunks(path), name
+    return file_chunks(path), name
+
+async def _transcribe(source: Any, mime_type: str, transcriber: Transcriber) -> str:
+    async with transcribe_slots():
+        chunks, name = voice_chunks(source)
+        with span("transcribe", backend=transcriber.name):
+            return await transcriber.transcribe(chunks, name, mime_type)
+
+@timed(UPSTREAM_SECONDS, "transcribe", "voice")
+async def voice_to_text(source: Any, cache_key: str = "", mime_type: str = "audio/ogg",
+                        transcriber: Optional[Transcriber] = None) -> str:
+    """
+    Transcribe a voice note from a local path or a Telegram File. The audio streams to the
+    backend chunk by chunk and is never held whole in memory. With a cache_key (the voice's
+    file_unique_id: a forwarded voice note has a new file_id but the same unique id) the
+    transcript goes through CACHE, and concurrent requests share one transcription.
+    """
+    transcriber = transcriber or TRANSCRIBER
+    if transcriber is None:
+        raise RuntimeError("TRANSCRIBE_BACKEND not set")
+    if not cache_key:
+        return await _transcribe(source, mime_type, transcriber)
+    return await CACHE.get_or_compute(
+        "transcript", cache_key, lambda: _transcribe(source, mime_type, transcriber), TRANSCRIPT_CACHE_TTL,
+    )
 
 # -------------------------
 # PIAPI Suno music generation
 # -------------------------
-async def piapi_generate_music(lyrics: str, genre: str, mood: str, demo: bool) -> Dict[str, Any]:
-    """Generate music using PIAPI Suno endpoint"""
+GENERATION_CACHE_SIZE = 512
+
+# Content-addressed generation store: in-flight tasks (single-flight) and recent results
+_generation_inflight: Dict[str, "asyncio.Task[Dict[str, Any]]"] = {}
+_generation_results: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+# Users already charged for each in-flight or stored key: their double taps are refunded
+_generation_payers: Dict[str, "set[int]"] = {}
+DEDUPE_STATS = {"submitted": 0, "coalesced": 0, "reused": 0}
+QUEUE_DEPTH.set_function(lambda: len(_generation_inflight), "piapi_inflight")
+GENERATION_DEDUPE = Gauge("musicai_generation_dedupe", "PIAPI generations by dedupe outcome", ("outcome",))
+for _outcome in DEDUPE_STATS:
+    GENERATION_DEDUPE.set_function(lambda o=_outcome: DEDUPE_STATS[o], _outcome)
+
+def generation_key(payload: Dict[str, Any]) -> str:
+    """Hash of everything that determines the generated audio"""
+    blob = json.dumps(
+        [payload["lyrics"], payload["tags"], payload["title"], payload["make_instrumental"]],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+def dedupe_savings() -> Dict[str, Any]:
+    """Upstream requests and money saved by coalescing and reuse"""
+    saved = DEDUPE_STATS["coalesced"] + DEDUPE_STATS["reused"]
+    return {**DEDUPE_STATS, "requests_saved": saved, "money_saved": round(saved * PIAPI_TASK_COST, 2)}
+
+def _generation_done(key: str, task: "asyncio.Task[Dict[str, Any]]"):
+    _generation_inflight.pop(key, None)
+    if task.cancelled() or task.exception() is not None:
+        _generation_payers.pop(key, None)
+        return  # failures are never reused
+    _generation_results[key] = (time.monotonic(), task.result())
+    _generation_results.move_to_end(key)
+    while len(_generation_results) > GENERATION_CACHE_SIZE:
+        evicted, _ = _generation_results.popitem(last=False)
+        _generation_payers.pop(evicted, None)
+
+async def _refund_duplicate(key: str, user_id: Optional[int]):
+    """Charge a user once per shared generation: a repeat from the same payer gets its song back"""
+    if user_id is None:
+        return
+    payers = _generation_payers.setdefault(key, set())
+    if user_id not in payers:
+        payers.add(user_id)
+        return
+    await asyncio.to_thread(add_balance, user_id, 1)
+    log.info("Refunded duplicate generation %s to user %s", key[:12], user_id)
+
+@timed(UPSTREAM_SECONDS, "piapi", "submit")
+async def _piapi_submit(payload: Dict[str, Any]) -> Dict[str, Any]:
+    url = f"{PIAPI_BASE_URL}{PIAPI_GENERATE_PATH}"
+    
+    headers = {
+        "Authorization": f"Bearer {PIAPI_API_KEY}",
+        "Content-Type": "application/json",
+    }
+    
+    async with http_session().post(url, json=payload, headers=headers) as resp:
+        if resp.status != 200:
+            text = await resp.text()
+            raise RuntimeError(f"PIAPI error {resp.status}: {text}")
+        return await resp.json(loads=json_loads)
+
+@timed(UPSTREAM_SECONDS, "piapi", "fetch_task")
+async def piapi_fetch_task(task_id: str) -> Dict[str, Any]:
+    """Result of an already submitted task; polling it is not billed"""
+    url = f"{PIAPI_BASE_URL}{PIAPI_TASK_PATH.format(task_id=task_id)}"
+    async with http_session().get(url, headers={"Authorization": f"Bearer {PIAPI_API_KEY}"}) as resp:
+        if resp.status != 200:
+            text = await resp.text()
+            raise RuntimeError(f"PIAPI error {resp.status}: {text}")
+        return await resp.json(loads=json_loads)
+
+@timed(UPSTREAM_SECONDS, "piapi", "generate_music")
+async def piapi_generate_music(lyrics: str, genre: str, mood: str, demo: bool,
+                               paid_by: Optional[int] = None) -> Dict[str, Any]:
+    """Generate music using PIAPI Suno endpoint.
+
+    Identical requests join the task already in flight, and a completed result is
+    reused for PIAPI_DEDUPE_TTL seconds, so double taps and retries are not billed twice.
+    paid_by is the user charged for this call; if they already paid for the same
+    generation, the song is refunded. Each caller gets its own copy of the result.
+    """
     if not PIAPI_API_KEY:
         raise RuntimeError("PIAPI_API_KEY not set")
     
-    url = f"{PIAPI_BASE_URL}{PIAPI_GENERATE_PATH}"
-    
     payload = {
         "lyrics": lyrics,
         "tags": f"{genre}, {mood}",
         "title": f"{genre} song",
         "make_instrumental": False,
     }
+    key = generation_key(payload)
     
-    headers = {
-        "Authorization": f"Bearer {PIAPI_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    cached = _generation_results.get(key)
+    if cached:
+        if time.monotonic() - cached[0] < PIAPI_DEDUPE_TTL:
+            DEDUPE_STATS["reused"] += 1
+            log.info("Reusing generation %s; dedupe savings: %s", key[:12], dedupe_savings())
+            await _refund_duplicate(key, paid_by)
+            return copy.deepcopy(cached[1])
+        del _generation_results[key]
+        _generation_payers.pop(key, None)
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload, headers=headers) as resp:
-            if resp.status != 200:
-                text = await resp.text()
-                raise RuntimeError(f"PIAPI error {resp.status}: {text}")
-            return await resp.json()
+    task = _generation_inflight.get(key)
+    if task is None:
+        DEDUPE_STATS["submitted"] += 1
+        task = asyncio.create_task(_piapi_submit(payload))
+        _generation_inflight[key] = task
+        task.add_done_callback(lambda t: _generation_done(key, t))
+    else:
+        DEDUPE_STATS["coalesced"] += 1
+        log.info("Joining in-flight generation %s; dedupe savings: %s", key[:12], dedupe_savings())
+    await _refund_duplicate(key, paid_by)
+    
+    # Shield so one impatient caller cannot cancel the task for everyone else
+    return copy.deepcopy(await asyncio.shield(task))
 
 def extract_audio_urls(piapi_resp: Dict[str, Any]) -> list:
     """Extract audio URLs from PIAPI response"""
@@ -272,6 +2340,358 @@ def extract_audio_urls(piapi_resp: Dict[str, Any]) -> list:
                 urls.append(item["audio_url"])
     return urls
 
+# -------------------------
+# Demo clip library
+# -------------------------
+@dataclass
+class DemoClip:
+    genre: str
+    mood: str
+    lang: str
+    url: str = ""
+    file_id: str = ""  # Telegram file_id, filled in after the first upload
+    title: str = ""
+
+# (genre, mood, lang) -> clip, with None meaning "any"; built by load_demo_library()
+DEMO_LIBRARY: Dict[Tuple[Optional[str], Optional[str], Optional[str]], DemoClip] = {}
+
+def load_demo_library(path: str = "") -> int:
+    """Load pre-generated demo clips from a JSON list.
+
+    Each entry: {"genre": "Pop", "mood": "Happy", "lang": "en", "url": "...", "file_id": "...", "title": "..."}.
+    Either url or file_id is required. Clips are indexed under exact and wildcard keys
+    so lookups never scan. Returns the number of clips loaded.
+    """
+    path = path or DEMO_LIBRARY_PATH
+    DEMO_LIBRARY.clear()
+    if not path or not os.path.exists(path):
+        log.warning("Demo library %s not found - demo mode disabled", path or "(unset)")
+        return 0
+
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+
+    count = 0
+    for entry in entries:
+        clip = DemoClip(
+            genre=entry["genre"],
+            mood=entry["mood"],
+            lang=entry.get("lang", "en"),
+            url=entry.get("url", ""),
+            file_id=entry.get("file_id", ""),
+            title=entry.get("title", ""),
+        )
+        if clip.genre not in GENRES or clip.mood not in MOODS or not (clip.url or clip.file_id):
+            log.warning("Skipping invalid demo clip: %s", entry)
+            continue
+        count += 1
+        DEMO_LIBRARY.setdefault((clip.genre, clip.mood, clip.lang), clip)
+        DEMO_LIBRARY.setdefault((clip.genre, clip.mood, None), clip)
+        DEMO_LIBRARY.setdefault((clip.genre, None, None), clip)
+        DEMO_LIBRARY.setdefault((None, None, None), clip)
+    log.info("Loaded %s demo clips from %s", count, path)
+    return count
+
+def find_demo_clip(genre: str, mood: str, lang: str) -> Optional[DemoClip]:
+    """Closest clip: exact match, then any language, then any mood, then anything"""
+    for key in ((genre, mood, lang), (genre, mood, None), (genre, None, None), (None, None, None)):
+        clip = DEMO_LIBRARY.get(key)
+        if clip:
+            return clip
+    return None
+
+async def send_demo(query, user_id: int, genre: str, mood: str):
+    """Serve the free demo from the clip library - no upstream generation"""
+    user = await asyncio.to_thread(get_user, user_id)
+    lang = user.get("lang", "uk")
+    
+    clip = find_demo_clip(genre, mood, lang)
+    if not clip:
+        await query.edit_message_text(tr(user_id, "demo_unavailable"), reply_markup=menu_keyboard(lang))
+        return
+    
+    if not await asyncio.to_thread(claim_demo, user_id):
+        await query.edit_message_text(tr(user_id, "demo_used"), reply_markup=buy_keyboard(lang, user_id))
+        return
+    
+    try:
+        msg = await query.message.reply_audio(clip.file_id or clip.url, title=clip.title or None)
+    except Exception:
+        await asyncio.to_thread(release_demo, user_id)
+        raise
+    
+    # Later sends reuse Telegram's copy instead of re-fetching the URL
+    if not clip.file_id and msg and msg.audio:
+        clip.file_id = msg.audio.file_id
+        log.info("Cached demo file_id for %s/%s/%s", clip.genre, clip.mood, clip.lang)
+
+# -------------------------
+# Admin broadcasts
+# -------------------------
+BROADCAST_MESSAGES = Counter("musicai_broadcast_messages_total", "Broadcast deliveries by outcome", ("status",))
+BROADCAST_MAX_RETRIES = 3
+BROADCAST_TASKS: Dict[int, "asyncio.Task[Dict[str, int]]"] = {}
+
+class TokenBucket:
+    """Async rate limiter shared by the broadcast workers; pause() holds everyone after a RetryAfter"""
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+        self._lock_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0.0
+
+    def lock(self) -> asyncio.Lock:
+        """Per event loop like the HTTP session, so a module-level bucket outlives any one loop"""
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock = asyncio.Lock()
+            self._lock_loop = loop
+        return self._lock
+
+    async def acquire(self):
+        async with self.lock():
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Telegram's limit is per bot: broadcasts and payment notifications draw from one bucket
+BROADCAST_BUCKET = TokenBucket(BROADCAST_RATE)
+
+def broadcast_text(key: str, lang: str) -> Optional[str]:
+    """Message for one language, falling back like tr(); None if no language has the key"""
+    for table in (TRANSLATIONS.get(lang), TRANSLATIONS["uk"], TRANSLATIONS["en"]):
+        if table and key in table:
+            return table[key]
+    return None
+
+@timed(DB_SECONDS, "create_broadcast")
+def create_broadcast(key: str, langs: Optional[List[str]], created_by: int) -> int:
+    with db_conn() as conn:
+        row = conn.execute(
+            "INSERT INTO broadcasts (key, langs, created_by) VALUES (%s, %s, %s) RETURNING id",
+            (key, langs, created_by),
+        ).fetchone()
+        conn.commit()
+        return row["id"]
+
+@timed(DB_SECONDS, "get_broadcast")
+def get_broadcast(broadcast_id: int) -> Dict[str, Any]:
+    with db_conn() as conn:
+        row = conn.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id=%s", (broadcast_id,)).fetchone()
+        if not row:
+            return {}
+        counts = conn.execute(
+            "SELECT status, COUNT(*) AS n FROM broadcast_recipients WHERE broadcast_id=%s GROUP BY status",
+            (broadcast_id,),
+        ).fetchall()
+        return {**row, "counts": {r["status"]: r["n"] for r in counts}}
+
+async def send_broadcast_message(bot, bucket: TokenBucket, user_id: int, text: str) -> Tuple[str, Optional[str]]:
+    """Deliver one message; returns (status, error) with status sent, blocked or failed"""
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return "sent", None
+        except RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            log.warning("Broadcast flood control: pausing %ss", delay)
+            bucket.pause(float(delay))
+        except Forbidden as e:
+            return "blocked", str(e)
+        except BadRequest as e:
+            return "failed", str(e)
+        except NetworkError as e:
+            if attempt == BROADCAST_MAX_RETRIES:
+                return "failed", str(e)
+            await asyncio.sleep(2 ** attempt)
+        except TelegramError as e:
+            return "failed", str(e)
+    return "failed", "flood control retries exhausted"
+
+async def _flush_broadcast(conn, broadcast_id: int, results: List[Tuple[int, str, Optional[str]]]):
+    """Persist per-recipient statuses and deactivate users who blocked the bot"""
+    if not results:
+        return
+    batch = results[:]
+    results.clear()
+    async with conn.transaction(), conn.cursor() as cur:
+        await cur.executemany(
+            "INSERT INTO broadcast_recipients (broadcast_id, user_id, status, error) VALUES (%s, %s, %s, %s) "
+            "ON CONFLICT (broadcast_id, user_id) DO UPDATE "
+            "SET status=EXCLUDED.status, error=EXCLUDED.error, sent_at=NOW()",
+            [(broadcast_id, user_id, status, error) for user_id, status, error in batch],
+        )
+        blocked = [user_id for user_id, status, _ in batch if status == "blocked"]
+        if blocked:
+            await cur.execute("UPDATE users SET active=FALSE WHERE user_id = ANY(%s)", (blocked,))
+
+async def run_broadcast(broadcast_id: int, bot) -> Dict[str, int]:
+    """
+    Send a broadcast to every active user in its languages who hasn't received it yet.
+
+    Recipients stream from a server-side cursor, so memory stays constant however many
+    users there are. The connection is in autocommit and the cursor is WITH HOLD: its
+    result is materialized on the server when the query ends, so no transaction stays
+    open for the hours a large send takes.
+    Statuses are written every BROADCAST_BATCH sends; rerunning the same id resumes,
+    re-sending at most the last unflushed batch.
+    """
+    counts: Dict[str, int] = CounterDict()
+    async with await psycopg.AsyncConnection.connect(DATABASE_URL, row_factory=dict_row, autocommit=True) as conn:
+        row = await (await conn.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id=%s", (broadcast_id,))).fetchone()
+        if not row:
+            raise ValueError(f"Unknown broadcast {broadcast_id}")
+        texts = {lang: broadcast_text(row["key"], lang) for lang in LANGS}
+        await conn.execute("UPDATE broadcasts SET status='running', finished_at=NULL WHERE id=%s", (broadcast_id,))
+
+        pending: "asyncio.Queue[Optional[Tuple[int, str]]]" = asyncio.Queue(maxsize=BROADCAST_BATCH)
+        results: List[Tuple[int, str, Optional[str]]] = []
+
+        async def worker():
+            while True:
+                item = await pending.get()
+                if item is None:
+                    return
+                user_id, lang = item
+                status, error = await send_broadcast_message(bot, BROADCAST_BUCKET, user_id, texts.get(lang) or texts["uk"])
+                BROADCAST_MESSAGES.labels(status).inc()
+                counts[status] += 1
+                results.append((user_id, status, error))
+
+        workers = [asyncio.create_task(worker()) for _ in range(BROADCAST_WORKERS)]
+        QUEUE_DEPTH.set_function(pending.qsize, "broadcast")
+        status = "paused"
+        try:
+            async with conn.cursor(name=f"broadcast_{broadcast_id}", withhold=True) as cur:
+                cur.itersize = BROADCAST_BATCH
+                await cur.execute(
+                    """
+                    SELECT u.user_id, u.lang FROM users u
+                    WHERE u.active
+                      AND (%(langs)s::text[] IS NULL OR u.lang = ANY(%(langs)s::text[]))
+                      AND NOT EXISTS (
+                          SELECT 1 FROM broadcast_recipients r
+                          WHERE r.broadcast_id = %(id)s AND r.user_id = u.user_id AND r.status IN ('sent', 'blocked')
+                      )
+                    ORDER BY u.user_id
+                    """,
+                    {"langs": row["langs"], "id": broadcast_id},
+                )
+                async for recipient in cur:
+                    await pending.put((recipient["user_id"], recipient["lang"]))
+                    if len(results) >= BROADCAST_BATCH:
+                        await _flush_broadcast(conn, broadcast_id, results)
+            for _ in workers:
+                await pending.put(None)
+            await asyncio.gather(*workers)
+            status = "done"
+        finally:
+            # Cancelled or failed: stop sending and keep what was delivered so a rerun resumes
+            for w in workers:
+                w.cancel()
+            QUEUE_DEPTH.set_function(lambda: 0, "broadcast")
+            await _flush_broadcast(conn, broadcast_id, results)
+            await conn.execute(
+                "UPDATE broadcasts SET status=%s, finished_at=NOW() WHERE id=%s", (status, broadcast_id),
+            )
+    log.info("Broadcast %s %s: %s", broadcast_id, status, dict(counts))
+    return dict(counts)
+
+# -------------------------
+# Generation delivery and resume
+# -------------------------
+INFLIGHT_GENERATIONS: Dict[int, int] = {}  # generation id -> user id
+# PIAPI task of each in-flight generation whose result has arrived, checkpointed with it on shutdown
+GENERATION_TASK_IDS: Dict[int, str] = {}
+QUEUE_DEPTH.set_function(lambda: len(INFLIGHT_GENERATIONS), "generations_inflight")
+_background_tasks: set = set()
+
+async def _resumed_result(task_id: str, generation_id: int) -> Optional[Dict[str, Any]]:
+    """The finished result of a checkpointed task, or None if it has to be generated again"""
+    try:
+        result = await piapi_fetch_task(task_id)
+    except Exception as e:
+        log.warning("Could not fetch PIAPI task %s for generation %s: %s", task_id, generation_id, e)
+        return None
+    return result if extract_audio_urls(result) else None
+
+async def deliver_generation(send_audio, send_text, user_id: int, generation_id: int, lyrics: str, genre: str, mood: str,
+                             task_id: Optional[str] = None):
+    """
+    Generate music for a recorded generation and send it; send_audio/send_text post to the user's chat.
+    With the task_id of an earlier attempt, that task's result is fetched before submitting a new one.
+    """
+    INFLIGHT_GENERATIONS[generation_id] = user_id
+    saved = False
+    try:
+        result = await _resumed_result(task_id, generation_id) if task_id else None
+        if result is None:
+            result = await piapi_generate_music(lyrics, genre, mood, demo=False, paid_by=user_id)
+        if result.get("task_id"):
+            GENERATION_TASK_IDS[generation_id] = result["task_id"]
+        audio_urls = extract_audio_urls(result)
+        
+        if audio_urls:
+            songs = [
+                {"title": f"{genre} song", "tags": f"{genre}, {mood}", "audio_url": url, "file_id": None}
+                for url in audio_urls
+            ]
+            try:
+                for song in songs:
+                    msg = await send_audio(song["audio_url"])
+                    song["file_id"] = msg.audio.file_id if msg and msg.audio else None
+            finally:
+                # The song is paid for: keep it, sent or not, so a failed send is still in "My songs"
+                await asyncio.to_thread(save_songs, user_id, generation_id, result.get("task_id"), songs)
+                await asyncio.to_thread(finish_generation, generation_id, "done", result.get("task_id"))
+                saved = True
+            await send_text(tr(user_id, "done"))
+        else:
+            await asyncio.to_thread(finish_generation, generation_id, "failed", result.get("task_id"), "No audio generated")
+            await send_text(tr(user_id, "error").format("No audio generated"))
+    except Exception as e:
+        log.error("Music generation error: %s", e)
+        if not saved:
+            await asyncio.to_thread(finish_generation, generation_id, "failed", None, str(e))
+        await send_text(tr(user_id, "error").format(str(e)))
+    finally:
+        INFLIGHT_GENERATIONS.pop(generation_id, None)
+        GENERATION_TASK_IDS.pop(generation_id, None)
+
+async def resume_interrupted_generations(bot) -> int:
+    """
+    Finish generations a previous instance checkpointed at shutdown: a known PIAPI task
+    is fetched, and only generations without a usable one are submitted again
+    """
+    rows = await asyncio.to_thread(claim_interrupted_generations)
+    for row in rows:
+        log.info("Resuming interrupted generation %s for user %s", row["id"], row["user_id"])
+        task = asyncio.create_task(deliver_generation(
+            functools.partial(bot.send_audio, row["user_id"]),
+            functools.partial(bot.send_message, row["user_id"]),
+            row["user_id"], row["id"], row["lyrics"], row["genre"], row["mood"], row.get("task_id"),
+        ))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return len(rows)
+
 # -------------------------
 # Keyboards
 # -------------------------
@@ -286,18 +2706,43 @@ def menu_keyboard(lang: str) -> InlineKeyboardMarkup:
     user_trans = TRANSLATIONS.get(lang, TRANSLATIONS["uk"])
     return InlineKeyboardMarkup([
         [InlineKeyboardButton("💰 " + user_trans["buy"], callback_data="buy")],
+        [InlineKeyboardButton(user_trans["demo"], callback_data="demo")],
+        [InlineKeyboardButton(user_trans["my_songs"], callback_data="songs")],
         [InlineKeyboardButton("💎 Баланс" if lang in ["uk", "ru"] else ("Saldo" if lang == "pl" else "Balance"), callback_data="balance")],
         [InlineKeyboardButton("❓ Допомога" if lang == "uk" else ("Помощь" if lang == "ru" else ("Pomoc" if lang == "pl" else "Help")), callback_data="help")],
     ])
 
-def genres_keyboard(lang: str) -> InlineKeyboardMarkup:
-    genres = ["Pop", "Rock", "Hip-Hop", "Classical", "Club", "Custom"]
-    buttons = [[InlineKeyboardButton(g, callback_data=f"genre:{g}")] for g in genres]
+def genres_keyboard(lang: str, action: str = "genre") -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(g, callback_data=f"{action}:{g}")] for g in GENRES]
     return InlineKeyboardMarkup(buttons)
 
-def moods_keyboard(lang: str) -> InlineKeyboardMarkup:
-    moods = ["Happy", "Sad", "Love", "Party", "Support", "Custom"]
-    buttons = [[InlineKeyboardButton(m, callback_data=f"mood:{m}")] for m in moods]
+def moods_keyboard(lang: str, action: str = "mood") -> InlineKeyboardMarkup:
+    """action may carry its own argument: "demo_mood:Pop" gives buttons like demo_mood:Pop:Happy"""
+    buttons = [[InlineKeyboardButton(m, callback_data=f"{action}:{m}")] for m in MOODS]
+    return InlineKeyboardMarkup(buttons)
+
+def generate_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🎵 Сгенерировать песню", callback_data=f"generate:{user_id}")
+    ]])
+
+def variant_keyboard(index: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"✅ Variant {index + 1}", callback_data=f"pick:{index}")
+    ]])
+
+def songs_keyboard(songs: List[Dict[str, Any]], has_newer: bool, has_older: bool) -> InlineKeyboardMarkup:
+    buttons = [
+        [InlineKeyboardButton(f"🎵 {s['title'] or s['tags'] or 'Song'} · {s['created_at']:%d.%m.%Y}", callback_data=f"song:{s['id']}")]
+        for s in songs
+    ]
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("◀️", callback_data=f"songs:p:{songs[0]['id']}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("▶️", callback_data=f"songs:n:{songs[-1]['id']}"))
+    if nav:
+        buttons.append(nav)
     return InlineKeyboardMarkup(buttons)
 
 def buy_keyboard(lang: str, user_id: int) -> InlineKeyboardMarkup:
@@ -307,6 +2752,7 @@ def buy_keyboard(lang: str, user_id: int) -> InlineKeyboardMarkup:
         buttons.append([InlineKeyboardButton(label, callback_data=f"buypack:{pack_id}")])
     return InlineKeyboardMarkup(buttons)
 
+@timed(UPSTREAM_SECONDS, "stripe", "checkout_session")
 def create_checkout_session(user_id: int, pack_id: str) -> str:
     """Create Stripe checkout session and return URL"""
     if not STRIPE_SECRET_KEY:
@@ -316,7 +2762,7 @@ def create_checkout_session(user_id: int, pack_id: str) -> str:
     if not pack:
         raise ValueError("Invalid pack")
     
-    session = stripe.checkout.Session.create(
+    session = _stripe().checkout.Session.create(
         payment_method_types=["card"],
         line_items=[{
             "price_data": {
@@ -333,12 +2779,17 @@ def create_checkout_session(user_id: int, pack_id: str) -> str:
     )
     return session.url
 
+@timed(UPSTREAM_SECONDS, "stripe", "construct_event")
+def construct_stripe_event(payload: bytes, signature: str):
+    """Verify a webhook signature and parse the event"""
+    return _stripe().Webhook.construct_event(payload, signature, STRIPE_WEBHOOK_SECRET)
+
 # -------------------------
 # Telegram Handlers
 # -------------------------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    await asyncio.to_thread(ensure_user, user_id)
+    await asyncio.to_thread(ensure_user, user_id, True)
     
     text = tr(user_id, "welcome")
     await update.message.reply_text(text, reply_markup=lang_keyboard())
@@ -351,6 +2802,110 @@ async def cmd_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = tr(user_id, "choose_language")
     await update.message.reply_text(text, reply_markup=lang_keyboard())
 
+BROADCAST_USAGE = (
+    "Usage:\n"
+    "/broadcast <translation_key> [uk,en,...] - send to active users\n"
+    "/broadcast resume <id> - continue an interrupted broadcast\n"
+    "/broadcast status <id>"
+)
+
+async def _broadcast_and_report(broadcast_id: int, bot, admin_chat: int):
+    try:
+        counts = await run_broadcast(broadcast_id, bot)
+        await bot.send_message(chat_id=admin_chat, text=f"Broadcast {broadcast_id} finished: {counts}")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        count_error("broadcast", e)
+        log.error("Broadcast %s failed: %s", broadcast_id, e)
+        await bot.send_message(chat_id=admin_chat, text=f"Broadcast {broadcast_id} stopped: {e}")
+    finally:
+        BROADCAST_TASKS.pop(broadcast_id, None)
+
+async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Admin-only: start, resume or inspect a broadcast"""
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        return
+    args = context.args or []
+    running = next(iter(BROADCAST_TASKS), None)
+
+    if len(args) == 2 and args[0] in ("resume", "status") and args[1].isdigit():
+        broadcast_id = int(args[1])
+        broadcast = await asyncio.to_thread(get_broadcast, broadcast_id)
+        if not broadcast:
+            await update.message.reply_text(f"Broadcast {broadcast_id} not found")
+            return
+        if args[0] == "status":
+            state = "running" if broadcast_id in BROADCAST_TASKS else broadcast["status"]
+            await update.message.reply_text(f"Broadcast {broadcast_id} '{broadcast['key']}' {state}: {broadcast['counts']}")
+            return
+        if running is not None:
+            await update.message.reply_text(f"Broadcast {running} is still running")
+            return
+    elif len(args) in (1, 2) and args[0] not in ("resume", "status"):
+        key = args[0]
+        langs = [lang.strip() for lang in args[1].split(",") if lang.strip()] if len(args) == 2 else None
+        if broadcast_text(key, "uk") is None:
+            await update.message.reply_text(f"Unknown translation key: {key}")
+            return
+        if langs and any(lang not in LANGS for lang in langs):
+            await update.message.reply_text(f"Languages must be among: {', '.join(LANGS)}")
+            return
+        if running is not None:
+            await update.message.reply_text(f"Broadcast {running} is still running")
+            return
+        broadcast_id = await asyncio.to_thread(create_broadcast, key, langs, user_id)
+    else:
+        await update.message.reply_text(BROADCAST_USAGE)
+        return
+
+    BROADCAST_TASKS[broadcast_id] = asyncio.create_task(
+        _broadcast_and_report(broadcast_id, context.bot, update.effective_chat.id)
+    )
+    await update.message.reply_text(f"Broadcast {broadcast_id} started")
+
+SONGS_PAGE_SIZE = 5
+
+async def song_history(user_id: int, older_than: Optional[int] = None, newer_than: Optional[int] = None):
+    """Text and keyboard for one page of the user's song history"""
+    songs, has_newer, has_older = await asyncio.to_thread(song_page, user_id, older_than, newer_than, SONGS_PAGE_SIZE)
+    if not songs:
+        return tr(user_id, "songs_empty"), None
+    return tr(user_id, "songs_title"), songs_keyboard(songs, has_newer, has_older)
+
+async def send_song(message, user_id: int, song_id: int):
+    """Re-deliver a song from Telegram's cache, falling back to the original URL"""
+    song = await asyncio.to_thread(get_song, user_id, song_id)
+    if not song:
+        await message.reply_text(tr(user_id, "song_missing"))
+        return
+    title = song["title"] or None
+    msg = None
+    if song["file_id"]:
+        try:
+            msg = await message.reply_audio(song["file_id"], title=title)
+        except BadRequest as e:
+            if not song["audio_url"]:
+                raise
+            log.warning("Cached file_id for song %s rejected (%s), re-sending URL", song_id, e)
+            song["file_id"] = None
+    if msg is None:
+        msg = await message.reply_audio(song["audio_url"], title=title)
+    if not song["file_id"] and msg and msg.audio:
+        await asyncio.to_thread(set_song_file_id, song_id, msg.audio.file_id)
+
+async def cmd_songs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the newest page of the user's songs"""
+    user_id = update.effective_user.id
+    text, markup = await song_history(user_id)
+    await update.message.reply_text(text, reply_markup=markup)
+
+CALLBACK_ACTIONS = {
+    "lang", "buy", "buypack", "balance", "help", "demo", "demo_genre", "demo_mood",
+    "genre", "mood", "pick", "generate", "songs", "song",
+}
+
 async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
@@ -361,13 +2916,15 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = query.from_user.id
         data = query.data
         
-        log.info(f"Callback from user {user_id}: {data}")
+        update_log.info("Callback from user %s: %s", user_id, data)
+        action = data.split(":", 1)[0]
+        CALLBACKS.labels(action if action in CALLBACK_ACTIONS else "unknown").inc()
         
         # Ensure user exists in database first
         try:
             await asyncio.to_thread(ensure_user, user_id)
         except Exception as db_err:
-            log.error(f"Failed to ensure user {user_id} in database: {db_err}", exc_info=True)
+            log.error("Failed to ensure user %s in database: %s", user_id, db_err, exc_info=True)
             await query.answer("❌ Database error. Please contact support.", show_alert=True)
             return
         
@@ -375,7 +2932,7 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await query.answer()
         except Exception as e:
-            log.error(f"Failed to answer callback query: {e}")
+            log.error("Failed to answer callback query: %s", e)
         
         if data.startswith("lang:"):
             lang = data.split(":")[1]
@@ -394,10 +2951,13 @@ async def on_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif data.startswith("buypack:"):
             pack_id = data.split(":")[1]
             try:
-                url = create_checkout_session(user_id, pack_id)
+                url = await CACHE.get_or_compute(
+                    "checkout", f"{user_id}:{pack_id}",
+                    lambda: asyncio.to_thread(create_checkout_session, user_id, pack_id), CHECKOUT_CACHE_TTL,
+                )
                 await query.edit_message_text(f"Click to complete payment:\n{url}")
             except Exception as e:
-                log.error(f"Checkout session error: {e}")
+                log.error("Checkout session error: %s", e)
                 await query.edit_message_text(tr(user_id, "error").format(str(e)))
         
         elif data == "balance":
@@ -449,6 +3009,34 @@ Questions? Contact @support""" if lang == "en" else """🎵 MusicAI PRO - Соз
 Вопросы? Напишите @support"""
             await query.edit_message_text(help_text, reply_markup=menu_keyboard(lang))
         
+        elif data == "songs" or data.startswith("songs:"):
+            # songs:n:<id> pages to older songs than <id>, songs:p:<id> to newer ones
+            parts = data.split(":")
+            cursor = int(parts[2]) if len(parts) == 3 and parts[2].isdigit() else None
+            text, markup = await song_history(
+                user_id,
+                older_than=cursor if parts[1:2] == ["n"] else None,
+                newer_than=cursor if parts[1:2] == ["p"] else None,
+            )
+            await query.edit_message_text(text, reply_markup=markup)
+        
+        elif data.startswith("song:"):
+            await send_song(query.message, user_id, int(data.split(":")[1]))
+        
+        # The demo flow has its own callbacks and carries its choices in them, so an
+        # abandoned demo cannot leak into a later paid generation
+        elif data == "demo":
+            await query.edit_message_text(tr(user_id, "demo_choose"), reply_markup=genres_keyboard("en", "demo_genre"))
+        
+        elif data.startswith("demo_genre:"):
+            genre = data.split(":")[1]
+            await query.edit_message_text(f"Genre: {genre}\nNow choose mood:",
+                                          reply_markup=moods_keyboard("en", f"demo_mood:{genre}"))
+        
+        elif data.startswith("demo_mood:"):
+            _, genre, mood = data.split(":")
+            await send_demo(query, user_id, genre, mood)
+        
         elif data.startswith("genre:"):
             genre = data.split(":")[1]
             context.user_data["genre"] = genre
@@ -459,6 +3047,17 @@ Questions? Contact @support""" if lang == "en" else """🎵 MusicAI PRO - Соз
             context.user_data["mood"] = mood
             await query.edit_message_text(f"Mood: {mood}\n\nNow tell me about your song!")
         
+        elif data.startswith("pick:"):
+            variants = context.user_data.get("lyrics_variants") or []
+            index = int(data.split(":")[1])
+            if index >= len(variants):
+                await query.edit_message_text(tr(user_id, "error").format("Lyrics expired, send your topic again"))
+                return
+            
+            lyrics = variants[index]
+            context.user_data["lyrics"] = lyrics
+            await query.edit_message_text(f"📝 Your lyrics:\n\n{lyrics}", reply_markup=generate_keyboard(user_id))
+        
         elif data.startswith("generate:"):
             # Generate music from lyrics
             user_data = context.user_data
@@ -476,27 +3075,18 @@ Questions? Contact @support""" if lang == "en" else """🎵 MusicAI PRO - Соз
                 await query.edit_message_text(tr(user_id, "error").format("Insufficient balance"))
                 return
             
+            generation_id = await asyncio.to_thread(start_generation, user_id, lyrics, genre, mood)
             await query.edit_message_text("🎶 ГЕНЕРАЦИЯ ПЕСНИ НАЧАЛАСЬ! ⚡️\nОбычно занимает не более 5 минут.\nЯ сообщу, как только будет готово 🎧")
-            
-            try:
-                result = await piapi_generate_music(lyrics, genre, mood, demo=False)
-                audio_urls = extract_audio_urls(result)
-                
-                if audio_urls:
-                    for url in audio_urls:
-                        await query.message.reply_audio(url)
-                    await query.message.reply_text(tr(user_id, "done"))
-                else:
-                    await query.message.reply_text(tr(user_id, "error").format("No audio generated"))
-            except Exception as e:
-                log.error(f"Music generation error: {e}")
-                await query.message.reply_text(tr(user_id, "error").format(str(e)))
+            await deliver_generation(
+                query.message.reply_audio, query.message.reply_text, user_id, generation_id, lyrics, genre, mood,
+            )
         else:
-            log.warning(f"Unknown callback data: {data}")
+            log.warning("Unknown callback data: %s", data)
             
     except Exception as e:
+        count_error("on_callback", e)
         error_msg = str(e)
-        log.error(f"Error in on_callback handler: {error_msg}", exc_info=True)
+        log.error("Error in on_callback handler: %s", error_msg, exc_info=True)
         try:
             if update and update.callback_query:
                 # Try to send a more helpful error message
@@ -507,12 +3097,43 @@ Questions? Contact @support""" if lang == "en" else """🎵 MusicAI PRO - Соз
                 else:
                     await update.callback_query.answer(f"❌ Error: {error_msg[:100]}", show_alert=True)
         except Exception as reply_error:
-            log.error(f"Failed to send error message to user: {reply_error}")
+            log.error("Failed to send error message to user: %s", reply_error)
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await lyrics_from_topic(update, context, update.message.text)
+
+async def on_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """A voice note is a spoken topic: transcribe it and continue as if it had been typed"""
+    user_id = update.effective_user.id
+    voice = update.message.voice
+    if "genre" not in context.user_data or "mood" not in context.user_data:
+        await lyrics_from_topic(update, context, "")  # same prompt to pick a genre first
+        return
+    if TRANSCRIBER is None:
+        await update.message.reply_text(tr(user_id, "voice_unavailable"))
+        return
+    if (voice.duration or 0) > VOICE_MAX_SECONDS:
+        await update.message.reply_text(tr(user_id, "voice_too_long").format(VOICE_MAX_SECONDS))
+        return
+
+    await update.message.reply_text(tr(user_id, "transcribing"))
+    try:
+        file = await voice.get_file()
+        topic = await voice_to_text(file, voice.file_unique_id, voice.mime_type or "audio/ogg")
+    except Exception as e:
+        count_error("on_voice", e)
+        log.error("Voice transcription error: %s", e)
+        await update.message.reply_text(tr(user_id, "error").format(str(e)))
+        return
+    if not topic:
+        await update.message.reply_text(tr(user_id, "voice_empty"))
+        return
+    await update.message.reply_text(f"🎙 {topic}")
+    await lyrics_from_topic(update, context, topic)
+
+async def lyrics_from_topic(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """Write lyrics for a typed or transcribed topic once genre and mood are chosen"""
     user_id = update.effective_user.id
-    text = update.message.text
-    
     user_data = context.user_data
     
     # If user has selected genre and mood, generate lyrics
@@ -520,55 +3141,189 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(tr(user_id, "generating"))
         
         try:
-            lyrics = await openrouter_lyrics(
-                text,
-                user_data.get("lang", "en"),
-                user_data["genre"],
-                user_data["mood"]
+            variants = await openrouter_lyrics_variants(
+                text, user_data.get("lang", "en"), user_data["genre"], user_data["mood"], LYRICS_VARIANTS,
             )
             
-            context.user_data["lyrics"] = lyrics
-            
-            # Show lyrics with generate button
-            kb = InlineKeyboardMarkup([[
-                InlineKeyboardButton("🎵 Сгенерировать песню", callback_data=f"generate:{user_id}")
-            ]])
-            
-            await update.message.reply_text(f"📝 Your lyrics:\n\n{lyrics}", reply_markup=kb)
+            if len(variants) == 1:
+                lyrics = variants[0]
+                context.user_data["lyrics"] = lyrics
+                
+                # Show lyrics with generate button
+                await update.message.reply_text(f"📝 Your lyrics:\n\n{lyrics}", reply_markup=generate_keyboard(user_id))
+            else:
+                # Let the user pick one; the choice is stored by the pick: callback
+                context.user_data["lyrics_variants"] = variants
+                context.user_data.pop("lyrics", None)
+                for i, lyrics in enumerate(variants):
+                    await update.message.reply_text(f"📝 Variant {i + 1}:\n\n{lyrics}", reply_markup=variant_keyboard(i))
         except Exception as e:
-            log.error(f"Lyrics generation error: {e}")
+            count_error("lyrics_from_topic", e)
+            log.error("Lyrics generation error: %s", e)
             await update.message.reply_text(tr(user_id, "error").format(str(e)))
     else:
         # Start the flow
         await update.message.reply_text("Choose genre first:", reply_markup=genres_keyboard("en"))
 
+# -------------------------
+# Payment notifications
+# -------------------------
+# Seconds a user's notification waits for more payments of the same burst
+PAYMENT_NOTIFY_DELAY = float(os.getenv("PAYMENT_NOTIFY_DELAY", "1.0"))
+
+class PaymentNotifier:
+    """
+    Sends "payment successful" messages in batches off the webhook path. Payments for
+    the same user within PAYMENT_NOTIFY_DELAY become one message with the summed songs
+    and the latest balance; sends share the broadcast rate limit and flood handling.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.pending: Dict[int, Dict[str, Any]] = {}
+        self.sent = 0
+        self.coalesced = 0
+        self._timer: Optional[asyncio.Task] = None  # only ever sleeping; hands off to a flush task
+        self._flushes: "set[asyncio.Task]" = set()
+
+    def add(self, user_id: int, songs: int, balance: int, lang: str):
+        entry = self.pending.get(user_id)
+        if entry is None:
+            self.pending[user_id] = {"songs": songs, "balance": balance, "lang": lang}
+        else:
+            self.coalesced += 1
+            entry["songs"] += songs
+            # Credits only add, so the highest balance seen is the most recent one
+            entry["balance"] = max(entry["balance"], balance)
+            entry["lang"] = lang
+        timer = self._timer
+        if timer is None or timer.done() or timer.get_loop() is not asyncio.get_running_loop():
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        task = asyncio.create_task(self.flush())
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def flush(self):
+        batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        if telegram_app is None or telegram_app.bot is None:
+            log.warning("Dropping %d payment notifications: bot not running", len(batch))
+            return
+        async def send(user_id: int, entry: Dict[str, Any]):
+            text = broadcast_text("payment_success", entry["lang"]).format(songs=entry["songs"], balance=entry["balance"])
+            status, error = await send_broadcast_message(telegram_app.bot, BROADCAST_BUCKET, user_id, text)
+            if status == "sent":
+                self.sent += 1
+            else:
+                log.error("Failed to notify user %s: %s", user_id, error)
+
+        await asyncio.gather(*(send(user_id, entry) for user_id, entry in batch.items()))
+
+    async def close(self):
+        """Shutdown: send what is pending now instead of waiting for the timer"""
+        loop = asyncio.get_running_loop()
+        if self._timer is not None and not self._timer.done() and self._timer.get_loop() is loop:
+            self._timer.cancel()
+        await asyncio.gather(*(t for t in list(self._flushes) if t.get_loop() is loop))
+        await self.flush()
+
+PAYMENT_NOTIFIER = PaymentNotifier(PAYMENT_NOTIFY_DELAY)
+QUEUE_DEPTH.set_function(lambda: len(PAYMENT_NOTIFIER.pending), "payment_notifications")
+
 # -------------------------
 # FastAPI (Stripe webhook)
 # -------------------------
-app = FastAPI()
+# Endpoints whose payload is already JSON-native return JSON_RESPONSE(...) themselves:
+# FastAPI otherwise walks the whole value with jsonable_encoder before serializing it
+JSON_RESPONSE = ORJSONResponse if FAST_JSON else JSONResponse
+app = FastAPI(default_response_class=JSON_RESPONSE)
+
+STARTUP_SECONDS = Gauge("musicai_startup_seconds", "Duration of each startup phase", ("phase",))
+STARTUP_TIMINGS: Dict[str, float] = {}
+# perf_counter() at the start and end of each phase, to tell which ones overlapped
+STARTUP_SPANS: Dict[str, Tuple[float, float]] = {}
+
+async def startup_phase(name: str, awaitable):
+    """Await one startup phase and record how long it took"""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        ended = time.perf_counter()
+        elapsed = ended - started
+        STARTUP_SPANS[name] = (started, ended)
+        STARTUP_TIMINGS[name] = round(elapsed, 3)
+        STARTUP_SECONDS.labels(name).set(elapsed)
+
+async def _open_db():
+    if await asyncio.to_thread(open_db_pool):
+        log.info("DB pool open (%s-%s connections)", DB_POOL_MIN, DB_POOL_MAX)
+    await asyncio.to_thread(init_db)
+    log.info("DB ready")
+
+async def _open_http():
+    http_session()
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database on startup"""
-    await asyncio.to_thread(init_db)
-    log.info("DB ready")
+    """
+    Bring up the DB pool and schema, demo library and HTTP client concurrently. The
+    Telegram bot initializes in the background at the same time and starts polling
+    once the DB is ready.
+    """
+    started = time.perf_counter()
+    db_ready = asyncio.Event()
+
+    async def db_phase():
+        await _open_db()
+        db_ready.set()
+
+    start_telegram_bot(db_ready)
+    try:
+        await asyncio.gather(
+            startup_phase("db", db_phase()),
+            startup_phase("demo_library", asyncio.to_thread(load_demo_library)),
+            startup_phase("http_client", _open_http()),
+        )
+    except BaseException:
+        # db_ready will never be set: don't leave the bot waiting on it
+        if _telegram_start_task is not None:
+            _telegram_start_task.cancel()
+        raise
+    STARTUP_TIMINGS["ready"] = round(time.perf_counter() - started, 3)
+    log.info("Startup ready in %.2fs: %s", STARTUP_TIMINGS["ready"], STARTUP_TIMINGS)
+    if STRIPE_SECRET_KEY or STRIPE_WEBHOOK_SECRET:
+        # Import the SDK now, in a thread, rather than on the loop in the first checkout or webhook
+        task = asyncio.create_task(asyncio.to_thread(_stripe))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    if FAST_PROFILE:
+        profile = perf_profile()
+        log.info("Performance profile: %s", profile)
+        if not (FAST_JSON and FAST_LOOP):
+            log.warning("PERF_PROFILE=fast without orjson/uvloop installed - falling back to stdlib for those")
     
     if not PIAPI_API_KEY:
         log.warning("⚠️ PIAPI_API_KEY not set - music generation will not work")
     if not OPENROUTER_API_KEY:
         log.warning("⚠️ OPENROUTER_API_KEY not set - lyrics generation will not work")
+    if WEB_CONCURRENCY > 1 and CACHE.name == "local":
+        log.warning("⚠️ %d workers with CACHE_BACKEND=local - languages and paid checkouts can be stale "
+                    "for up to %.0fs on other workers; set CACHE_BACKEND=postgres", WEB_CONCURRENCY, CACHE_LOCAL_TTL)
 
 @app.get("/stripe/webhook")
+@app.get("/webhook/stripe")
 async def stripe_webhook_verification():
     """GET endpoint for Stripe webhook verification during setup"""
     return {"status": "ok", "message": "Stripe webhook endpoint is ready"}
 
-@app.get("/webhook/stripe")
-async def webhook_stripe_verification():
-    """GET endpoint for Stripe webhook verification at alternative path"""
-    return {"status": "ok", "message": "Stripe webhook endpoint is ready"}
-
+# Both paths have been configured in Stripe dashboards over time; they share one handler
 @app.post("/stripe/webhook")
+@app.post("/webhook/stripe")
 async def stripe_webhook(request: Request, stripe_signature: str = Header(None)):
     """POST endpoint for Stripe webhook events"""
     if not STRIPE_WEBHOOK_SECRET:
@@ -579,10 +3334,13 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
         raise HTTPException(status_code=400, detail="Missing Stripe-Signature header")
 
     try:
-        event = stripe.Webhook.construct_event(payload, stripe_signature, STRIPE_WEBHOOK_SECRET)
+        event = await asyncio.to_thread(construct_stripe_event, payload, stripe_signature)
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Invalid signature: {e}")
 
+    if RECORDER:
+        RECORDER.record("stripe", payload)
+
     if event["type"] == "checkout.session.completed":
         session = event["data"]["object"]
         meta = session.get("metadata") or {}
@@ -591,83 +3349,306 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
 
         if user_id and pack_id in PACKS:
             songs = int(PACKS[pack_id]["songs"])
-            await asyncio.to_thread(add_balance, int(user_id), songs)
-            log.info(f"Added {songs} songs to user {user_id}")
-            
-            # Notify user about successful payment
+            amount = session.get("amount_total")
+            if amount is None:
+                amount = int(PACKS[pack_id]["price"] * 100)
+            credited = await asyncio.to_thread(
+                record_payment, session["id"], int(user_id), pack_id, amount, session.get("currency") or "usd",
+            )
+            if credited is None:
+                log.info("Checkout %s already credited, ignoring redelivery", session["id"])
+                return {"ok": True}
+            log.info("Added %d songs to user %s", songs, user_id)
             if telegram_app and telegram_app.bot:
-                try:
-                    balance = await asyncio.to_thread(get_balance, int(user_id))
-                    msg = tr(int(user_id), "payment_success").format(songs=songs, balance=balance)
-                    await telegram_app.bot.send_message(chat_id=int(user_id), text=msg)
-                except Exception as e:
-                    log.error(f"Failed to notify user {user_id}: {e}")
+                PAYMENT_NOTIFIER.add(int(user_id), songs, credited["balance"], credited["lang"])
 
     return {"ok": True}
 
-@app.post("/webhook/stripe")
-async def webhook_stripe(request: Request, stripe_signature: str = Header(None)):
-    if not STRIPE_WEBHOOK_SECRET:
-        raise HTTPException(status_code=500, detail="STRIPE_WEBHOOK_SECRET not set")
-
-    payload = await request.body()
-    if not stripe_signature:
-        raise HTTPException(status_code=400, detail="Missing Stripe-Signature header")
-
+# -------------------------
+# Admin API (exports and stats)
+# -------------------------
+EXPORT_QUERIES = {
+    "users": "SELECT user_id, lang, balance, demo_used, active, created_at FROM users",
+    "payments": "SELECT session_id, user_id, pack, songs, amount_cents, currency, created_at FROM payments",
+    "generations": "SELECT id, user_id, genre, mood, status, task_id, error, created_at, finished_at FROM generations",
+}
+EXPORT_MEDIA_TYPES = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+EXPORT_CHUNK = 64 * 1024  # COPY yields one row per message; coalesce before writing to the socket
+
+def require_admin(authorization: str = Header(None)):
+    """Bearer-token check for /admin routes"""
+    if not ADMIN_API_TOKEN:
+        raise HTTPException(status_code=503, detail="ADMIN_API_TOKEN not set")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), ADMIN_API_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized", headers={"WWW-Authenticate": "Bearer"})
+
+def export_statement(table: str, fmt: str, since: Optional[str] = None, until: Optional[str] = None) -> sql.Composed:
+    """
+    COPY statement for an export. COPY takes no bind parameters, so the date bounds
+    are validated and composed as literals.
+
+    NDJSON uses row_to_json through CSV mode with quote and delimiter bytes that
+    row_to_json always escapes, so COPY emits each JSON document verbatim (text
+    mode would double every backslash).
+    """
+    where = []
+    for op, value in ((">=", since), ("<", until)):
+        if value:
+            where.append(sql.SQL("created_at {} {}").format(
+                sql.SQL(op), sql.Literal(datetime.date.fromisoformat(value).isoformat())
+            ))
+    query = sql.SQL(EXPORT_QUERIES[table])
+    if where:
+        query = query + sql.SQL(" WHERE ") + sql.SQL(" AND ").join(where)
+    query = query + sql.SQL(" ORDER BY created_at")
+    if fmt == "ndjson":
+        return sql.SQL("COPY (SELECT row_to_json(t) FROM ({}) t) TO STDOUT WITH (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')").format(query)
+    return sql.SQL("COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)").format(query)
+
+async def copy_stream(statement: sql.Composed):
+    """Pipe COPY TO STDOUT to the client on an async connection; memory is bounded by EXPORT_CHUNK"""
+    async with await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True) as conn:
+        async with conn.cursor() as cur:
+            async with cur.copy(statement) as copy:
+                buffer = bytearray()
+                async for data in copy:
+                    buffer += data
+                    if len(buffer) >= EXPORT_CHUNK:
+                        yield bytes(buffer)
+                        buffer.clear()
+                if buffer:
+                    yield bytes(buffer)
+
+@timed(DB_SECONDS, "daily_stats")
+def daily_stats(days: int) -> List[Dict[str, Any]]:
+    with db_conn() as conn:
+        return conn.execute(
+            "SELECT day, metric, dimension, value FROM daily_stats "
+            "WHERE day > (NOW() AT TIME ZONE 'UTC')::date - %s ORDER BY day, metric, dimension",
+            (days,),
+        ).fetchall()
+
+def shape_stats(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """daily_stats rows -> per-day {metric: {dimension: value}} plus totals over the range"""
+    by_day: Dict[str, Dict[str, Dict[str, int]]] = {}
+    totals: Dict[str, Dict[str, int]] = {}
+    for row in rows:
+        day = row["day"].isoformat()
+        by_day.setdefault(day, {}).setdefault(row["metric"], {})[row["dimension"]] = row["value"]
+        bucket = totals.setdefault(row["metric"], {})
+        bucket[row["dimension"]] = bucket.get(row["dimension"], 0) + row["value"]
+    return {"days": [{"day": day, **metrics} for day, metrics in by_day.items()], "totals": totals}
+
+@app.get("/admin/export/{table}", dependencies=[Depends(require_admin)])
+async def admin_export(table: str, format: str = "csv", since: Optional[str] = None, until: Optional[str] = None):
+    """Stream users, payments or generations as CSV or NDJSON; since/until are ISO dates on created_at"""
+    if table not in EXPORT_QUERIES:
+        raise HTTPException(status_code=404, detail=f"Unknown export: {table}")
+    if format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
     try:
-        event = stripe.Webhook.construct_event(payload, stripe_signature, STRIPE_WEBHOOK_SECRET)
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Invalid signature: {e}")
-
-    if event["type"] == "checkout.session.completed":
-        session = event["data"]["object"]
-        meta = session.get("metadata") or {}
-        user_id = meta.get("user_id")
-        pack_id = meta.get("pack")
-
-        if user_id and pack_id in PACKS:
-            songs = int(PACKS[pack_id]["songs"])
-            await asyncio.to_thread(add_balance, int(user_id), songs)
-            log.info(f"Added {songs} songs to user {user_id}")
-            
-            # Notify user about successful payment
-            if telegram_app and telegram_app.bot:
-                try:
-                    balance = await asyncio.to_thread(get_balance, int(user_id))
-                    msg = tr(int(user_id), "payment_success").format(songs=songs, balance=balance)
-                    await telegram_app.bot.send_message(chat_id=int(user_id), text=msg)
-                except Exception as e:
-                    log.error(f"Failed to notify user {user_id}: {e}")
+        statement = export_statement(table, format, since, until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid date: {e}")
+    return StreamingResponse(
+        copy_stream(statement),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
 
-    return {"ok": True}
+@app.get("/admin/stats", dependencies=[Depends(require_admin)])
+async def admin_stats(days: int = 30):
+    """Signups per language, songs generated per genre, packs sold and revenue, per UTC day"""
+    days = min(max(days, 1), 366)
+    return JSON_RESPONSE(shape_stats(await asyncio.to_thread(daily_stats, days)))
 
 # -------------------------
 # Run Telegram bot inside same process
 # -------------------------
 telegram_app: Optional[Application] = None
 
-@app.on_event("startup")
-async def start_telegram_bot():
+def build_telegram_app(token: str, base_url: str = "") -> Application:
+    """Application with all handlers registered; base_url points it at a local Bot API stand-in"""
+    builder = Application.builder().token(token).request(InstrumentedRequest(connection_pool_size=256))
+    if base_url:
+        builder = builder.base_url(f"{base_url}/bot").base_file_url(f"{base_url}/file/bot")
+    application = builder.build()
+
+    if RECORDER:
+        application.add_handler(TypeHandler(Update, capture_update), group=-1)
+    application.add_handler(CommandHandler("start", traced_handler(cmd_start)))
+    application.add_handler(CommandHandler("menu", traced_handler(cmd_menu)))
+    application.add_handler(CommandHandler("songs", traced_handler(cmd_songs)))
+    application.add_handler(CommandHandler("broadcast", traced_handler(cmd_broadcast)))
+    application.add_handler(CallbackQueryHandler(traced_handler(on_callback)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, traced_handler(on_text)))
+    application.add_handler(MessageHandler(filters.VOICE, traced_handler(on_voice)))
+    return application
+
+def start_telegram_bot(db_ready: asyncio.Event):
+    """Initialize the bot in the background; polling waits for db_ready"""
     global telegram_app
     if not BOT_TOKEN:
         log.warning("BOT_TOKEN not set — telegram bot will not start")
         return
 
-    telegram_app = Application.builder().token(BOT_TOKEN).build()
+    telegram_app = build_telegram_app(BOT_TOKEN)
+    QUEUE_DEPTH.set_function(lambda: telegram_app.update_queue.qsize(), "telegram_updates")
 
-    telegram_app.add_handler(CommandHandler("start", cmd_start))
-    telegram_app.add_handler(CommandHandler("menu", cmd_menu))
-    telegram_app.add_handler(CallbackQueryHandler(on_callback))
-    telegram_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, on_text))
+    async def _start_polling():
+        await telegram_app.start()
+        await telegram_app.updater.start_polling(drop_pending_updates=True)
 
     # Start polling as background task
     async def _run():
-        await telegram_app.initialize()
-        await telegram_app.start()
-        await telegram_app.updater.start_polling(drop_pending_updates=True)
-        log.info("Telegram bot started (polling)")
+        await startup_phase("telegram_init", telegram_app.initialize())
+        await db_ready.wait()
+        await startup_phase("telegram_polling", _start_polling())
+        log.info("Telegram bot started (polling); startup phases: %s", STARTUP_TIMINGS)
+        resumed = await resume_interrupted_generations(telegram_app.bot)
+        if resumed:
+            log.info("Resumed %s interrupted generations", resumed)
+
+    global _telegram_start_task
+    _telegram_start_task = asyncio.create_task(_run())
+    _telegram_start_task.add_done_callback(_telegram_start_done)
+
+def _telegram_start_done(task: asyncio.Task):
+    """Surface a failed bot start; nothing else awaits the task"""
+    if task.cancelled() or task.exception() is None:
+        return
+    count_error("telegram_start", task.exception())
+    log.error("Telegram bot failed to start: %r", task.exception(), exc_info=task.exception())
+
+_telegram_start_task: Optional[asyncio.Task] = None
+
+# -------------------------
+# Lifecycle: health, readiness, graceful shutdown
+# -------------------------
+STARTED_AT = time.time()
+SHUTTING_DOWN = threading.Event()
+
+def db_ping():
+    with db_conn() as conn:
+        conn.execute("SELECT 1")
+
+async def readiness() -> Tuple[bool, Dict[str, Any]]:
+    """
+    Ready unless shutting down, the DB is unreachable or Telegram updates are backing up.
+    Benched lyrics models are reported but don't fail readiness: an upstream outage hits
+    every instance alike, and pulling them all out of rotation would not help.
+    """
+    ready = not SHUTTING_DOWN.is_set()
+    db: Dict[str, Any] = {"ok": True}
+    try:
+        await asyncio.wait_for(asyncio.to_thread(db_ping), timeout=2.0)
+    except Exception as e:
+        db = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        ready = False
+    if DB_POOL is not None:
+        stats = DB_POOL.get_stats()
+        db["pool"] = {k: stats.get(k, 0) for k in ("pool_size", "pool_available", "requests_waiting")}
+
+    updates_waiting = telegram_app.update_queue.qsize() if telegram_app else 0
+    if updates_waiting > READY_MAX_QUEUE:
+        ready = False
+    now = time.monotonic()
+    return ready, {
+        "shutting_down": SHUTTING_DOWN.is_set(),
+        "db": db,
+        "lyrics_models": {m: "ok" if st.healthy(now) else "benched" for m, st in MODEL_STATS.items()},
+        "queues": {
+            "telegram_updates": updates_waiting,
+            "updates_inflight": inflight_updates,
+            "generations_inflight": len(INFLIGHT_GENERATIONS),
+            "piapi_inflight": len(_generation_inflight),
+        },
+    }
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the event loop is serving requests"""
+    return {"status": "ok", "uptime": round(time.time() - STARTED_AT, 1)}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness for the load balancer; 503 takes this instance out of rotation"""
+    ready, checks = await readiness()
+    return JSON_RESPONSE({"ready": ready, **checks}, status_code=200 if ready else 503)
+
+async def drain_inflight(deadline: float) -> bool:
+    """Wait until queued and running updates and generations finish; False if the deadline hit first"""
+    while (inflight_updates > 0 or INFLIGHT_GENERATIONS
+           or (telegram_app is not None and telegram_app.update_queue.qsize() > 0)):
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(0.1)
+    return True
 
-    asyncio.create_task(_run())
+async def stop_telegram_app(deadline: float):
+    if telegram_app is None:
+        return
+    if _telegram_start_task is not None and not _telegram_start_task.done():
+        _telegram_start_task.cancel()
+    try:
+        if telegram_app.running:
+            await asyncio.wait_for(telegram_app.stop(), timeout=max(1.0, deadline - time.monotonic()))
+        await telegram_app.shutdown()
+    except Exception as e:
+        log.warning("Telegram application did not stop cleanly: %r", e)
+
+@app.on_event("shutdown")
+async def graceful_shutdown():
+    """
+    SIGTERM: fail readiness and stop polling, give in-flight work SHUTDOWN_GRACE_SECONDS,
+    checkpoint generations still running as 'interrupted' (the next instance resumes
+    them), then flush state and close clients and the DB pool.
+    """
+    SHUTTING_DOWN.set()
+    deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+    log.info("Shutting down: draining for up to %.0fs", SHUTDOWN_GRACE_SECONDS)
+
+    if telegram_app is not None and telegram_app.updater and telegram_app.updater.running:
+        await telegram_app.updater.stop()
+    await stop_broadcasts()
+
+    if await drain_inflight(deadline):
+        log.info("Drained all in-flight work")
+    elif INFLIGHT_GENERATIONS:
+        try:
+            n = await asyncio.to_thread(interrupt_generations, list(INFLIGHT_GENERATIONS), dict(GENERATION_TASK_IDS))
+            log.warning("Checkpointed %s unfinished generations for resume on next start", n)
+        except Exception as e:
+            log.error("Failed to checkpoint generations: %s", e)
+
+    await PAYMENT_NOTIFIER.close()
+    await stop_telegram_app(deadline)
+    await close_recorder()
+    if TRACE_EXPORT:
+        await asyncio.to_thread(TRACE_EXPORT.flush)
+    if PROFILER:
+        await asyncio.to_thread(PROFILER.flush)
+    await close_http_session()
+    await asyncio.to_thread(close_db_pool)
+    log.info("Shutdown complete")
+    await asyncio.to_thread(flush_logs)
+
+async def stop_broadcasts():
+    """Cancelled broadcasts flush their statuses and are left 'paused' for /broadcast resume"""
+    tasks = list(BROADCAST_TASKS.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def close_recorder():
+    if RECORDER:
+        await asyncio.to_thread(RECORDER.close)
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return Response(render_metrics(), media_type=prometheus_client.CONTENT_TYPE_LATEST)
 
 @app.get("/")
 async def root():
@@ -679,4 +3660,4 @@ async def root():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop" if FAST_LOOP else "auto")
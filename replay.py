@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Replay captured production traffic against local upstream stand-ins.
+
+Capture on a running bot with CAPTURE_FILE=capture.ndjson.gz (updates and
+Stripe webhooks are PII-scrubbed as they are written), then replay offline:
+
+    python replay.py capture.ndjson.gz --speedup 10 --out build-a.json
+    python replay.py capture.ndjson.gz --speedup 10 --compare build-a.json
+
+Updates go through the registered handlers (cmd_start, on_callback, on_text)
+and webhooks through the FastAPI Stripe route, re-signed with the harness
+secret. Inter-arrival times are preserved (divided by --speedup; 0 means as
+fast as possible) and each user's updates are processed in their original
+order. Results use the same format and regression check as loadtest.py.
+"""
+
+import sys
+import gzip
+import json
+import time
+import asyncio
+import logging
+import argparse
+from typing import Any, Dict, List, Optional
+
+from telegram import Update
+
+import main
+import loadtest
+
+
+def load_capture(path: str) -> List[Dict[str, Any]]:
+    """Records from a capture file, oldest first; tolerates a truncated tail"""
+    opener = gzip.open if path.endswith(".gz") else open
+    records = []
+    try:
+        with opener(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # writer was killed mid-line
+    except EOFError:
+        pass  # gzip member without trailer: process stopped before closing the capture
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def record_user(record: Dict[str, Any]) -> Optional[int]:
+    """User a record belongs to, used to keep per-user ordering"""
+    data = record["data"]
+    if record["kind"] == "stripe":
+        user_id = (((data.get("data") or {}).get("object") or {}).get("metadata") or {}).get("user_id")
+        return int(user_id) if user_id and str(user_id).isdigit() else None
+    for key in ("message", "edited_message", "callback_query"):
+        sender = (data.get(key) or {}).get("from")
+        if sender:
+            return sender["id"]
+    return None
+
+
+def arrival_offsets(records: List[Dict[str, Any]], speedup: float) -> List[float]:
+    """Seconds after replay start at which each record is dispatched"""
+    if not records or speedup <= 0:
+        return [0.0] * len(records)
+    base = records[0]["ts"]
+    return [(r["ts"] - base) / speedup for r in records]
+
+
+class Replayer(loadtest.Harness):
+    def __init__(self, args: argparse.Namespace, records: List[Dict[str, Any]]):
+        super().__init__(
+            loadtest.parse_profiles(args.latency, args.errors, args.jitter), args.seed, args.database_url,
+        )
+        self.args = args
+        self.records = records
+
+    def step_name(self, record: Dict[str, Any]) -> str:
+        if record["kind"] == "stripe":
+            return f"stripe:{record['data'].get('type', 'event')}"
+        update = Update.de_json(record["data"], self.application.bot)
+        action, _ = main._update_attrs(update)
+        return action
+
+    async def dispatch(self, record: Dict[str, Any]):
+        step = self.step_name(record)
+        if record["kind"] == "stripe":
+            await self.webhook_step(step, json.dumps(record["data"]).encode())
+        else:
+            await self.telegram_step(step, record["data"])
+
+    async def run(self) -> Dict[str, Any]:
+        await self.setup()
+        try:
+            users = {u for u in map(record_user, self.records) if u is not None}
+            if self.args.seed_balance:
+                for user_id in users:
+                    await asyncio.to_thread(main.add_balance, user_id, self.args.seed_balance)
+
+            semaphore = asyncio.Semaphore(self.args.concurrency)
+            previous: Dict[int, asyncio.Task] = {}
+
+            async def ordered(record: Dict[str, Any], before: Optional[asyncio.Task]):
+                if before is not None:
+                    await asyncio.gather(before, return_exceptions=True)
+                async with semaphore:
+                    await self.dispatch(record)
+
+            errors_before = self.error_count()
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            tasks = []
+            for record, offset in zip(self.records, arrival_offsets(self.records, self.args.speedup)):
+                delay = offset - (loop.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                user_id = record_user(record)
+                task = asyncio.create_task(ordered(record, previous.get(user_id)))
+                if user_id is not None:
+                    previous[user_id] = task
+                tasks.append(task)
+            await asyncio.gather(*tasks)
+            duration = loop.time() - started
+            errors = self.error_count() - errors_before
+        finally:
+            await self.teardown()
+
+        config = {
+            "capture": self.args.capture,
+            "records": len(self.records),
+            "users": len(users),
+            "speedup": self.args.speedup,
+            "concurrency": self.args.concurrency,
+            "seed": self.args.seed,
+        }
+        return self.report(duration, len(self.records), errors, config, order=sorted(self.samples))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Replay a traffic capture against local upstream stand-ins")
+    parser.add_argument("capture", help="capture file written with CAPTURE_FILE")
+    parser.add_argument("--speedup", type=float, default=1.0, help="time compression factor; 0 = no waiting")
+    parser.add_argument("--seed-balance", type=int, default=0, help="credit every replayed user this many songs")
+    loadtest.add_common_args(parser)
+    return parser
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    if not args.database_url:
+        print("A scratch Postgres database is required: set DATABASE_URL or pass --database-url", file=sys.stderr)
+        return 2
+    if not args.verbose:
+        logging.getLogger("main").setLevel(logging.WARNING)
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    records = load_capture(args.capture)
+    if not records:
+        print(f"No records in {args.capture}", file=sys.stderr)
+        return 2
+
+    wall = time.perf_counter()
+    main.install_event_loop()
+    result = asyncio.run(Replayer(args, records).run())
+    print(f"replayed {len(records)} records in {time.perf_counter() - wall:.1f}s")
+
+    return loadtest.finish_run(result, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Test the admin export and stats endpoints
+"""
+
+import os
+import csv
+import io
+import json
+import asyncio
+import datetime
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+TOKEN = "admin-test-token"
+AUTH = {"Authorization": f"Bearer {TOKEN}"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_API_TOKEN", TOKEN)
+    # No lifespan: startup would try to reach the DB and Telegram
+    return TestClient(main.app)
+
+
+class TestAuth:
+    """Test bearer-token protection"""
+
+    def test_missing_token(self, client):
+        assert client.get("/admin/stats").status_code == 401
+
+    def test_wrong_token(self, client):
+        assert client.get("/admin/stats", headers={"Authorization": "Bearer nope"}).status_code == 401
+
+    def test_wrong_scheme(self, client):
+        assert client.get("/admin/stats", headers={"Authorization": f"Basic {TOKEN}"}).status_code == 401
+
+    def test_disabled_without_token(self, client, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_API_TOKEN", "")
+        assert client.get("/admin/stats", headers=AUTH).status_code == 503
+
+
+class TestExportValidation:
+    """Test request validation and COPY statement composition"""
+
+    def test_unknown_table(self, client):
+        assert client.get("/admin/export/secrets", headers=AUTH).status_code == 404
+
+    def test_unknown_format(self, client):
+        assert client.get("/admin/export/users?format=xml", headers=AUTH).status_code == 400
+
+    def test_bad_date(self, client):
+        assert client.get("/admin/export/users?since=yesterday'; DROP TABLE users", headers=AUTH).status_code == 400
+
+    def test_csv_statement(self):
+        statement = main.export_statement("payments", "csv", since="2026-01-01", until="2026-02-01").as_string(None)
+        assert statement.startswith("COPY (SELECT session_id")
+        assert "created_at >= '2026-01-01' AND created_at < '2026-02-01'" in statement
+        assert statement.endswith("(FORMAT csv, HEADER)")
+
+    def test_ndjson_statement(self):
+        statement = main.export_statement("users", "ndjson").as_string(None)
+        assert "row_to_json(t)" in statement
+        assert "QUOTE e'\\x01', DELIMITER e'\\x02'" in statement
+
+
+class TestStats:
+    """Test shaping of rollup rows"""
+
+    def test_shape_stats(self):
+        day1, day2 = datetime.date(2026, 10, 1), datetime.date(2026, 10, 2)
+        rows = [
+            {"day": day1, "metric": "signups", "dimension": "en", "value": 3},
+            {"day": day1, "metric": "packs_sold", "dimension": "pack_5", "value": 1},
+            {"day": day2, "metric": "signups", "dimension": "en", "value": 2},
+            {"day": day2, "metric": "signups", "dimension": "uk", "value": 1},
+        ]
+        stats = main.shape_stats(rows)
+        assert stats["days"][0] == {"day": "2026-10-01", "signups": {"en": 3}, "packs_sold": {"pack_5": 1}}
+        assert stats["totals"]["signups"] == {"en": 5, "uk": 1}
+
+    def test_endpoint(self, client, monkeypatch):
+        seen = []
+        monkeypatch.setattr(main, "daily_stats", lambda days: seen.append(days) or [])
+        assert client.get("/admin/stats?days=9999", headers=AUTH).json() == {"days": [], "totals": {}}
+        assert seen == [366]
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestAgainstPostgres:
+    """Rollup triggers, idempotent crediting and streamed exports"""
+
+    USER = 9_100_001
+
+    @pytest.fixture(autouse=True)
+    def db(self, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        main.init_db()
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM payments WHERE user_id=%s", (self.USER,))
+            conn.execute("DELETE FROM generations WHERE user_id=%s", (self.USER,))
+            conn.execute("DELETE FROM users WHERE user_id=%s", (self.USER,))
+            conn.commit()
+
+    def stat(self, metric, dimension):
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        rows = main.daily_stats(1)
+        return sum(r["value"] for r in rows if (r["day"], r["metric"], r["dimension"]) == (today, metric, dimension))
+
+    def test_rollups_and_idempotent_payment(self):
+        signups, sold = self.stat("signups", "pl"), self.stat("packs_sold", "pack_5")
+        main.set_lang(self.USER, "pl")
+        assert self.stat("signups", "pl") == signups + 1
+
+        assert main.record_payment(f"cs_test_{self.USER}", self.USER, "pack_5", 2000, "usd") == {"balance": 5, "lang": "pl"}
+        assert main.record_payment(f"cs_test_{self.USER}", self.USER, "pack_5", 2000, "usd") is None
+        assert main.get_user(self.USER)["balance"] == 5
+        assert self.stat("packs_sold", "pack_5") == sold + 1
+
+        songs = self.stat("songs_generated", "Rock")
+        generation_id = main.start_generation(self.USER, "la la", "Rock", "Happy")
+        main.finish_generation(generation_id, "done")
+        assert self.stat("songs_generated", "Rock") == songs + 1
+
+    def test_streamed_exports(self):
+        main.record_payment(f"cs_test_{self.USER}", self.USER, "pack_1", 600, "usd")
+
+        async def collect(fmt):
+            statement = main.export_statement("payments", fmt)
+            return b"".join([chunk async for chunk in main.copy_stream(statement)]).decode()
+
+        rows = list(csv.DictReader(io.StringIO(asyncio.run(collect("csv")))))
+        assert any(r["session_id"] == f"cs_test_{self.USER}" for r in rows)
+        docs = [json.loads(line) for line in asyncio.run(collect("ndjson")).splitlines()]
+        assert any(d["session_id"] == f"cs_test_{self.USER}" and d["amount_cents"] == 600 for d in docs)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Test the admin broadcast pipeline: rate limiting, delivery outcomes, the command
+and (with a scratch DATABASE_URL) streaming, blocked users and resuming
+"""
+
+import os
+import time
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from telegram.error import BadRequest, Forbidden, RetryAfter, TimedOut
+
+import main
+
+
+class FakeBot:
+    """Records sends; per-chat scripted exceptions are raised once each, in order"""
+
+    def __init__(self, script=None):
+        self.script = {chat: list(errors) for chat, errors in (script or {}).items()}
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        errors = self.script.get(chat_id)
+        if errors:
+            raise errors.pop(0)
+        self.sent.append((chat_id, text))
+
+
+class TestTokenBucket:
+    """Test pacing and flood-control pauses"""
+
+    def test_paces_to_rate(self):
+        bucket = main.TokenBucket(rate=100)
+
+        async def run():
+            start = time.monotonic()
+            await asyncio.gather(*(bucket.acquire() for _ in range(21)))
+            return time.monotonic() - start
+
+        # One token up front, then 20 more at 100/s
+        assert asyncio.run(run()) >= 0.19
+
+    def test_pause_holds_all_acquirers(self):
+        bucket = main.TokenBucket(rate=1000)
+
+        async def run():
+            bucket.pause(0.1)
+            start = time.monotonic()
+            await bucket.acquire()
+            return time.monotonic() - start
+
+        assert asyncio.run(run()) >= 0.09
+
+    def test_one_bucket_serves_successive_loops(self):
+        bucket = main.TokenBucket(rate=1000)
+
+        async def run():
+            await asyncio.gather(*(bucket.acquire() for _ in range(3)))
+
+        asyncio.run(run())
+        asyncio.run(run())  # the lock is rebuilt for the new loop
+
+
+class TestSendBroadcastMessage:
+    """Test how each Telegram outcome is classified"""
+
+    def send(self, bot, user_id=1):
+        return asyncio.run(main.send_broadcast_message(bot, main.TokenBucket(rate=1000), user_id, "hi"))
+
+    def test_sent(self):
+        bot = FakeBot()
+        assert self.send(bot) == ("sent", None)
+        assert bot.sent == [(1, "hi")]
+
+    def test_retry_after_is_honored_then_sent(self):
+        bot = FakeBot({1: [RetryAfter(0)]})
+        assert self.send(bot)[0] == "sent"
+
+    def test_forbidden_means_blocked(self):
+        status, error = self.send(FakeBot({1: [Forbidden("bot was blocked by the user")]}))
+        assert status == "blocked"
+        assert "blocked" in error
+
+    def test_bad_request_is_not_retried(self):
+        bot = FakeBot({1: [BadRequest("Chat not found")]})
+        assert self.send(bot)[0] == "failed"
+        assert bot.sent == []
+
+    def test_network_errors_are_retried(self, monkeypatch):
+        monkeypatch.setattr(main.asyncio, "sleep", AsyncMock())
+        bot = FakeBot({1: [TimedOut(), TimedOut()]})
+        assert self.send(bot)[0] == "sent"
+
+
+class TestBroadcastText:
+    """Test per-language rendering"""
+
+    def test_uses_user_language(self):
+        assert main.broadcast_text("menu", "pl") == main.TRANSLATIONS["pl"]["menu"]
+
+    def test_untranslated_language_falls_back(self):
+        assert main.broadcast_text("menu", "es") == main.TRANSLATIONS["uk"]["menu"]
+
+    def test_unknown_key(self):
+        assert main.broadcast_text("no_such_key", "en") is None
+
+
+class TestBroadcastCommand:
+    """Test access control and argument validation"""
+
+    def make_update(self, user_id):
+        update = MagicMock()
+        update.effective_user.id = user_id
+        update.message.reply_text = AsyncMock()
+        return update
+
+    def run(self, update, *args):
+        context = MagicMock()
+        context.args = list(args)
+        asyncio.run(main.cmd_broadcast(update, context))
+        return update.message.reply_text
+
+    def test_non_admin_is_ignored(self, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_IDS", {42})
+        reply = self.run(self.make_update(7), "menu")
+        reply.assert_not_called()
+
+    def test_usage(self, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_IDS", {42})
+        reply = self.run(self.make_update(42))
+        assert reply.call_args.args[0].startswith("Usage")
+
+    def test_unknown_key_is_refused(self, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_IDS", {42})
+        reply = self.run(self.make_update(42), "no_such_key")
+        assert "Unknown translation key" in reply.call_args.args[0]
+
+    def test_unknown_language_is_refused(self, monkeypatch):
+        monkeypatch.setattr(main, "ADMIN_IDS", {42})
+        reply = self.run(self.make_update(42), "menu", "en,xx")
+        assert "Languages" in reply.call_args.args[0]
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestRunBroadcast:
+    """End to end against Postgres: language filter, blocked users, resume"""
+
+    USERS = {9_000_001: "en", 9_000_002: "pl", 9_000_003: "en", 9_000_004: "uk"}
+
+    @pytest.fixture(autouse=True)
+    def users(self, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        monkeypatch.setattr(main, "BROADCAST_BATCH", 1)
+        main.init_db()
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM users WHERE user_id = ANY(%s)", (list(self.USERS),))
+            for user_id, lang in self.USERS.items():
+                conn.execute("INSERT INTO users (user_id, lang) VALUES (%s, %s)", (user_id, lang))
+            conn.commit()
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM users WHERE user_id = ANY(%s)", (list(self.USERS),))
+            conn.commit()
+
+    def test_filters_blocks_and_resumes(self):
+        broadcast_id = main.create_broadcast("menu", ["en", "pl"], 0)
+        bot = FakeBot({9_000_003: [Forbidden("blocked")], 9_000_002: [BadRequest("Chat not found")]})
+
+        counts = asyncio.run(main.run_broadcast(broadcast_id, bot))
+        assert counts == {"sent": 1, "blocked": 1, "failed": 1}
+        assert bot.sent == [(9_000_001, main.TRANSLATIONS["en"]["menu"])]
+        assert main.get_user(9_000_003)["active"] is False
+
+        # Resuming only retries the failed recipient
+        counts = asyncio.run(main.run_broadcast(broadcast_id, bot))
+        assert counts == {"sent": 1}
+        assert bot.sent[-1] == (9_000_002, main.TRANSLATIONS["pl"]["menu"])
+        assert main.get_broadcast(broadcast_id)["counts"] == {"sent": 2, "blocked": 1}
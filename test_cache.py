@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Test the cache backends: LRU/TTL, bulk get/set, namespace invalidation, single-flight
+get_or_compute, the cached lookups in the bot and hit latency in both modes
+(the Postgres backend needs a scratch DATABASE_URL)
+
+    python -m pytest -q -s test_cache.py -k latency --benchmark    # prints us per hit
+"""
+
+import os
+import time
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+import main
+
+
+HIT_CALLS = 20_000
+
+
+def per_hit_us(cache, calls):
+    cache.set("bench", "k", {"lang": "en", "balance": 5})
+    keys = ["k"] * calls
+    started = time.perf_counter()
+    for key in keys:
+        cache.get("bench", key)
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """A fresh local cache installed as main.CACHE"""
+    local = main.LocalCache(size=100, default_ttl=60)
+    monkeypatch.setattr(main, "CACHE", local)
+    return local
+
+
+class CacheContract:
+    """Behaviour every backend shares; subclasses provide a `backend` fixture"""
+
+    def test_get_set_delete(self, backend):
+        assert backend.get("ns", "a") is None
+        backend.set("ns", "a", {"x": [1, "two"]})
+        assert backend.get("ns", "a") == {"x": [1, "two"]}
+        assert backend.get("other", "a") is None
+        backend.delete("ns", "a")
+        assert backend.get("ns", "a") is None
+
+    def test_none_is_not_stored(self, backend):
+        backend.set("ns", "a", None)
+        backend.set_many("ns", {"b": None, "c": 3})
+        assert backend.get_many("ns", ["a", "b", "c"]) == {"c": 3}
+
+    def test_bulk(self, backend):
+        backend.set_many("ns", {"a": 1, "b": "two", "c": [3]})
+        assert backend.get_many("ns", ["a", "c", "missing"]) == {"a": 1, "c": [3]}
+        assert backend.get_many("ns", []) == {}
+
+    def test_ttl(self, backend):
+        backend.set("ns", "short", "v", ttl=0.05)
+        backend.set("ns", "long", "v")
+        time.sleep(0.1)
+        assert backend.get_many("ns", ["short", "long"]) == {"long": "v"}
+
+    def test_invalidate_namespace(self, backend):
+        backend.set_many("ns", {"a": 1, "b": 2})
+        backend.set("keep", "a", 1)
+        backend.invalidate("ns")
+        assert backend.get_many("ns", ["a", "b"]) == {}
+        assert backend.get("keep", "a") == 1
+        backend.set("ns", "a", 3)
+        assert backend.get("ns", "a") == 3
+
+
+class TestLocalCache(CacheContract):
+
+    @pytest.fixture
+    def backend(self):
+        return main.LocalCache(size=100, default_ttl=60)
+
+    def test_lru_eviction(self):
+        cache = main.LocalCache(size=2)
+        cache.set("ns", "a", 1)
+        cache.set("ns", "b", 2)
+        assert cache.get("ns", "a") == 1  # a is now the most recent
+        cache.set("ns", "c", 3)
+        assert cache.get_many("ns", ["a", "b", "c"]) == {"a": 1, "c": 3}
+
+    def test_ttl_caps(self):
+        cache = main.LocalCache(default_ttl=3600, ttl_caps={"lang": 0.05})
+        cache.set("lang", "1", "ru", ttl=3600)
+        cache.set("transcript", "1", "text")
+        time.sleep(0.06)
+        assert cache.get("lang", "1") is None
+        assert cache.get("transcript", "1") == "text"
+
+    def test_local_backend_caps_what_other_workers_change(self, monkeypatch):
+        monkeypatch.setattr(main, "CACHE_LOCAL_TTL", 15.0)
+        cache = main.make_cache("local")
+        assert cache.ttl_caps == {"lang": 15.0, "checkout": 15.0}
+
+    @pytest.mark.benchmark
+    def test_hit_latency(self):
+        us = per_hit_us(main.LocalCache(), HIT_CALLS)
+        print(f"\nlocal cache hit: {us:.2f}us")
+        assert us < 50
+
+
+class TestGetOrCompute:
+    """Single-flight and what is (not) stored"""
+
+    def test_concurrent_misses_share_one_compute(self, cache):
+        calls = 0
+
+        async def compute():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return ["value"]
+
+        async def run():
+            first = await asyncio.gather(*(cache.get_or_compute("ns", "k", compute) for _ in range(5)))
+            return first, await cache.get_or_compute("ns", "k", compute)
+
+        first, again = asyncio.run(run())
+        assert first == [["value"]] * 5 and again == ["value"]
+        assert calls == 1
+        assert cache._inflight == {}
+
+    def test_failures_and_none_are_not_stored(self, cache):
+        compute = AsyncMock(side_effect=[RuntimeError("upstream"), None, "ok"])
+
+        async def run():
+            with pytest.raises(RuntimeError):
+                await cache.get_or_compute("ns", "k", compute)
+            assert await cache.get_or_compute("ns", "k", compute) is None
+            return await cache.get_or_compute("ns", "k", compute)
+
+        assert asyncio.run(run()) == "ok"
+        assert compute.await_count == 3
+
+    def test_cancelled_caller_does_not_abort_the_others(self, cache):
+        async def compute():
+            await asyncio.sleep(0.05)
+            return "v"
+
+        async def run():
+            impatient = asyncio.create_task(cache.get_or_compute("ns", "k", compute))
+            patient = asyncio.create_task(cache.get_or_compute("ns", "k", compute))
+            await asyncio.sleep(0.01)
+            impatient.cancel()
+            return await patient
+
+        assert asyncio.run(run()) == "v"
+        assert cache.get("ns", "k") == "v"
+
+    def test_blocking_miss_that_raced_a_finished_compute(self, monkeypatch):
+        cache = main.LocalCache()
+        monkeypatch.setattr(cache, "blocking", True)
+        cache.set("ns", "k", "stored")
+        stale = [True]  # this caller's first read ran before the other compute stored
+        real_get = cache.get
+        monkeypatch.setattr(cache, "get", lambda ns, key: None if stale and stale.pop() else real_get(ns, key))
+        compute = AsyncMock(return_value="again")
+
+        assert asyncio.run(cache.get_or_compute("ns", "k", compute)) == "stored"
+        compute.assert_not_awaited()
+
+
+class TestCachedLookups:
+    """Language in tr() and checkout URLs go through main.CACHE; lyrics do not"""
+
+    def test_tr_reads_language_once(self, cache, monkeypatch):
+        reads = []
+        monkeypatch.setattr(main, "get_user", lambda user_id: reads.append(user_id) or {"lang": "en"})
+        assert main.tr(1, "generating") == main.TRANSLATIONS["en"]["generating"]
+        assert main.tr(1, "done") == main.TRANSLATIONS["en"]["done"]
+        assert reads == [1]
+
+    def test_blocking_backend_is_behind_a_local_tier(self, monkeypatch):
+        class Shared(main.LocalCache):
+            blocking = True
+            reads = 0
+
+            def get(self, namespace, key):
+                self.reads += 1
+                return super().get(namespace, key)
+
+        shared = Shared()
+        monkeypatch.setattr(main, "CACHE", shared)
+        monkeypatch.setattr(main, "LANG_LOCAL", main.LocalCache(default_ttl=60))
+        monkeypatch.setattr(main, "get_user", lambda user_id: {"lang": "en"})
+        for _ in range(3):
+            assert main.tr(1, "done") == main.TRANSLATIONS["en"]["done"]
+        assert shared.reads == 1
+
+        monkeypatch.setattr(main, "db_conn", MagicMock())
+        main.set_lang(1, "pl")  # written through to both tiers
+        assert main.tr(1, "done") == main.TRANSLATIONS["pl"]["done"]
+        assert shared.reads == 1
+
+    def test_checkout_session_reused_per_user_and_pack(self, cache, monkeypatch):
+        created = []
+        monkeypatch.setattr(main, "ensure_user", lambda user_id: None)
+        monkeypatch.setattr(main, "create_checkout_session",
+                            lambda user_id, pack_id: created.append(pack_id) or f"https://pay.test/{len(created)}")
+
+        def tap(pack_id):
+            update = MagicMock()
+            update.callback_query.from_user.id = 1
+            update.callback_query.data = f"buypack:{pack_id}"
+            update.callback_query.answer = AsyncMock()
+            update.callback_query.edit_message_text = AsyncMock()
+            asyncio.run(main.on_callback(update, MagicMock()))
+            return update.callback_query.edit_message_text.call_args.args[0]
+
+        assert tap("pack_5").endswith("/1")
+        assert tap("pack_5").endswith("/1")
+        assert tap("pack_1").endswith("/2")
+        cache.delete("checkout", "1:pack_5")  # what record_payment does once it is paid
+        assert tap("pack_5").endswith("/3")
+
+    def test_resent_topic_gets_new_lyrics(self, cache, monkeypatch):
+        lyrics = AsyncMock(return_value=["[Verse 1]\nwaves"])
+        monkeypatch.setattr(main, "openrouter_lyrics_variants", lyrics)
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        monkeypatch.setattr(main, "generate_keyboard", lambda user_id: None)
+
+        def send(user_id, topic):
+            update = MagicMock()
+            update.effective_user.id = user_id
+            update.message.reply_text = AsyncMock()
+            context = MagicMock()
+            context.user_data = {"genre": "Pop", "mood": "Happy", "lang": "en"}
+            asyncio.run(main.lyrics_from_topic(update, context, topic))
+            return context.user_data["lyrics"]
+
+        send(1, "the sea")
+        send(1, "the sea")
+        assert lyrics.await_count == 2
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestPostgresCache(CacheContract):
+
+    USER = 9_500_001
+
+    @pytest.fixture(autouse=True)
+    def db(self, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        main.init_db()
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM kv_cache WHERE namespace IN ('ns', 'other', 'keep', 'bench', 'lang', 'checkout')")
+            conn.execute("DELETE FROM payments WHERE user_id=%s", (self.USER,))
+            conn.execute("DELETE FROM users WHERE user_id=%s", (self.USER,))
+            conn.commit()
+
+    @pytest.fixture
+    def backend(self):
+        return main.PostgresCache(default_ttl=60)
+
+    def test_table_is_unlogged(self):
+        with main.db_conn() as conn:
+            row = conn.execute("SELECT relpersistence FROM pg_class WHERE relname = 'kv_cache'").fetchone()
+        assert row["relpersistence"] == "u"
+
+    def test_shared_between_workers(self):
+        one, two = main.PostgresCache(), main.PostgresCache()
+        one.set("ns", "a", "from one")
+        assert two.get("ns", "a") == "from one"
+        two.invalidate("ns")
+        assert one.get("ns", "a") is None
+
+    def test_sweep(self):
+        cache = main.PostgresCache(sweep_interval=0)
+        cache.set_many("ns", {str(i): i for i in range(5)}, ttl=0.01)
+        time.sleep(0.05)
+        cache.set("ns", "live", 1)  # also sweeps, interval elapsed
+        with main.db_conn() as conn:
+            keys = [r["key"] for r in conn.execute("SELECT key FROM kv_cache WHERE namespace='ns'").fetchall()]
+        assert keys == ["live"]
+
+    def test_get_or_compute(self):
+        cache = main.PostgresCache()
+        compute = AsyncMock(return_value={"url": "https://pay.test/1"})
+
+        async def run():
+            return await asyncio.gather(*(cache.get_or_compute("checkout", "1:pack_5", compute) for _ in range(3)))
+
+        assert asyncio.run(run()) == [{"url": "https://pay.test/1"}] * 3
+        assert compute.await_count == 1
+        assert cache.get("checkout", "1:pack_5") == {"url": "https://pay.test/1"}
+
+    def test_set_lang_and_payment_update_the_cache(self, monkeypatch):
+        cache = main.PostgresCache()
+        monkeypatch.setattr(main, "CACHE", cache)
+        monkeypatch.setattr(main, "LANG_LOCAL", main.LocalCache())
+        main.set_lang(self.USER, "pl")
+        assert cache.get("lang", str(self.USER)) == "pl"
+        assert main.tr(self.USER, "done") == main.TRANSLATIONS["pl"]["done"]
+
+        cache.set("checkout", f"{self.USER}:pack_5", "https://pay.test/1")
+        main.record_payment(f"cs_cache_{self.USER}", self.USER, "pack_5", 2000, "usd")
+        assert cache.get("checkout", f"{self.USER}:pack_5") is None
+
+    @pytest.mark.benchmark
+    def test_hit_latency(self):
+        cache = main.PostgresCache()
+        main.open_db_pool()
+        try:
+            us = per_hit_us(cache, 500)
+        finally:
+            main.close_db_pool()
+        print(f"\npostgres cache hit: {us:.0f}us")
+        assert us < 5000
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Test the demo clip library and demo delivery
+"""
+
+import json
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+import main
+
+
+CLIPS = [
+    {"genre": "Pop", "mood": "Happy", "lang": "en", "url": "https://cdn.test/pop-happy-en.mp3"},
+    {"genre": "Pop", "mood": "Happy", "lang": "uk", "file_id": "AUDIO_POP_HAPPY_UK"},
+    {"genre": "Rock", "mood": "Sad", "lang": "en", "url": "https://cdn.test/rock-sad-en.mp3"},
+    {"genre": "Polka", "mood": "Happy", "lang": "en", "url": "https://cdn.test/polka.mp3"},
+]
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    path = tmp_path / "demo_clips.json"
+    path.write_text(json.dumps(CLIPS), encoding="utf-8")
+    monkeypatch.setattr(main, "DEMO_LIBRARY", {})
+    main.load_demo_library(str(path))
+    return path
+
+
+class TestDemoLibrary:
+    """Test clip indexing and lookup fallbacks"""
+
+    def test_invalid_genres_are_skipped(self, library):
+        assert main.load_demo_library(str(library)) == 3
+
+    def test_missing_library_disables_demo(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "DEMO_LIBRARY", {})
+        assert main.load_demo_library(str(tmp_path / "missing.json")) == 0
+        assert main.find_demo_clip("Pop", "Happy", "en") is None
+
+    def test_exact_match(self, library):
+        assert main.find_demo_clip("Pop", "Happy", "uk").file_id == "AUDIO_POP_HAPPY_UK"
+
+    def test_falls_back_to_other_language(self, library):
+        assert main.find_demo_clip("Rock", "Sad", "pl").url.endswith("rock-sad-en.mp3")
+
+    def test_falls_back_to_other_mood(self, library):
+        assert main.find_demo_clip("Rock", "Party", "en").genre == "Rock"
+
+    def test_falls_back_to_any_clip(self, library):
+        assert main.find_demo_clip("Classical", "Love", "ru") is not None
+
+
+class TestSendDemo:
+    """Test demo delivery and demo_used enforcement"""
+
+    def make_query(self, file_id="NEW_FILE_ID"):
+        query = MagicMock()
+        query.edit_message_text = AsyncMock()
+        sent = MagicMock()
+        sent.audio.file_id = file_id
+        query.message.reply_audio = AsyncMock(return_value=sent)
+        return query
+
+    def patch_db(self, monkeypatch, claimed):
+        released = []
+        monkeypatch.setattr(main, "get_user", lambda user_id: {"user_id": user_id, "lang": "en"})
+        monkeypatch.setattr(main, "claim_demo", lambda user_id: claimed)
+        monkeypatch.setattr(main, "release_demo", lambda user_id: released.append(user_id))
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        return released
+
+    def test_first_demo_uploads_and_caches_file_id(self, library, monkeypatch):
+        self.patch_db(monkeypatch, claimed=True)
+        query = self.make_query()
+
+        asyncio.run(main.send_demo(query, 1, "Pop", "Happy"))
+        asyncio.run(main.send_demo(query, 2, "Pop", "Happy"))
+
+        first, second = query.message.reply_audio.call_args_list
+        assert first.args[0] == "https://cdn.test/pop-happy-en.mp3"
+        assert second.args[0] == "NEW_FILE_ID"
+
+    def test_used_demo_is_refused(self, library, monkeypatch):
+        self.patch_db(monkeypatch, claimed=False)
+        query = self.make_query()
+
+        asyncio.run(main.send_demo(query, 1, "Pop", "Happy"))
+
+        query.message.reply_audio.assert_not_called()
+        assert query.edit_message_text.call_args.args[0] == "demo_used"
+
+    def test_failed_delivery_releases_demo(self, library, monkeypatch):
+        released = self.patch_db(monkeypatch, claimed=True)
+        query = self.make_query()
+        query.message.reply_audio.side_effect = RuntimeError("Telegram down")
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(main.send_demo(query, 7, "Pop", "Happy"))
+        assert released == [7]
+
+
+class TestDemoCallbacks:
+    """The demo flow has its own callbacks and leaves the paid flow alone"""
+
+    @pytest.fixture
+    def tap(self, monkeypatch):
+        demos = []
+        monkeypatch.setattr(main, "ensure_user", lambda user_id: None)
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        monkeypatch.setattr(main, "send_demo", AsyncMock(side_effect=lambda q, u, g, m: demos.append((g, m))))
+        context = MagicMock()
+        context.user_data = {}
+
+        def tap(data):
+            update = MagicMock()
+            update.callback_query.from_user.id = 1
+            update.callback_query.data = data
+            update.callback_query.answer = AsyncMock()
+            update.callback_query.edit_message_text = AsyncMock()
+            asyncio.run(main.on_callback(update, context))
+            edited = update.callback_query.edit_message_text.call_args
+            return edited.kwargs.get("reply_markup") if edited else None
+
+        tap.demos, tap.user_data = demos, context.user_data
+        return tap
+
+    def test_demo_flow(self, tap):
+        genres = tap("demo")
+        assert genres.inline_keyboard[0][0].callback_data.startswith("demo_genre:")
+        moods = tap("demo_genre:Rock")
+        assert moods.inline_keyboard[0][0].callback_data == f"demo_mood:Rock:{main.MOODS[0]}"
+        tap("demo_mood:Rock:Sad")
+        assert tap.demos == [("Rock", "Sad")]
+        assert tap.user_data == {}
+
+    def test_abandoned_demo_does_not_hijack_a_paid_generation(self, tap):
+        tap("demo")
+        tap("demo_genre:Rock")  # walks away
+        tap("genre:Pop")
+        tap("mood:Happy")
+        assert tap.demos == []
+        assert tap.user_data == {"genre": "Pop", "mood": "Happy"}
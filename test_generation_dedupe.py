@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Test in-flight coalescing and result reuse for music generations
+"""
+
+import asyncio
+import pytest
+from collections import OrderedDict
+
+import main
+
+
+@pytest.fixture
+def piapi(monkeypatch):
+    """Fresh generation store with a counting stand-in for the PIAPI call"""
+    submitted = []
+
+    async def fake_submit(payload):
+        submitted.append(payload)
+        await asyncio.sleep(0.05)
+        if payload["lyrics"] == "broken":
+            raise RuntimeError("PIAPI error 500")
+        return {"data": [{"audio_url": f"https://cdn.test/{len(submitted)}.mp3"}]}
+
+    monkeypatch.setattr(main, "PIAPI_API_KEY", "test_piapi_key")
+    monkeypatch.setattr(main, "_piapi_submit", fake_submit)
+    monkeypatch.setattr(main, "_generation_inflight", {})
+    monkeypatch.setattr(main, "_generation_results", OrderedDict())
+    monkeypatch.setattr(main, "_generation_payers", {})
+    monkeypatch.setattr(main, "DEDUPE_STATS", {"submitted": 0, "coalesced": 0, "reused": 0})
+    return submitted
+
+
+class TestGenerationDedupe:
+    """Test single-flight and reuse of identical generations"""
+
+    def test_identical_inflight_requests_share_one_task(self, piapi):
+        async def run():
+            return await asyncio.gather(*(
+                main.piapi_generate_music("la la", "Pop", "Happy", demo=False) for _ in range(3)
+            ))
+
+        results = asyncio.run(run())
+
+        assert len(piapi) == 1
+        assert results[0] == results[1] == results[2]
+        assert main.DEDUPE_STATS["coalesced"] == 2
+
+    def test_completed_result_is_reused(self, piapi):
+        first = asyncio.run(main.piapi_generate_music("la la", "Pop", "Happy", demo=False))
+        second = asyncio.run(main.piapi_generate_music("la la", "Pop", "Happy", demo=False))
+
+        assert first == second
+        assert len(piapi) == 1
+        assert main.DEDUPE_STATS["reused"] == 1
+
+    def test_expired_result_is_regenerated(self, piapi, monkeypatch):
+        monkeypatch.setattr(main, "PIAPI_DEDUPE_TTL", 0)
+        asyncio.run(main.piapi_generate_music("la la", "Pop", "Happy", demo=False))
+        asyncio.run(main.piapi_generate_music("la la", "Pop", "Happy", demo=False))
+        assert len(piapi) == 2
+
+    def test_different_tags_are_not_deduped(self, piapi):
+        asyncio.run(main.piapi_generate_music("la la", "Pop", "Happy", demo=False))
+        asyncio.run(main.piapi_generate_music("la la", "Pop", "Sad", demo=False))
+        assert len(piapi) == 2
+
+    def test_failures_are_not_reused(self, piapi):
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                asyncio.run(main.piapi_generate_music("broken", "Pop", "Happy", demo=False))
+        assert len(piapi) == 2
+        assert not main._generation_results
+
+    def test_callers_get_their_own_copy(self, piapi):
+        async def run():
+            return await asyncio.gather(*(
+                main.piapi_generate_music("la la", "Pop", "Happy", demo=False) for _ in range(2)
+            ))
+
+        first, second = asyncio.run(run())
+        first["data"].clear()
+        assert second["data"]
+        third = asyncio.run(main.piapi_generate_music("la la", "Pop", "Happy", demo=False))
+        assert third["data"]
+
+    def test_double_tap_is_charged_once(self, piapi, monkeypatch):
+        refunds = []
+        monkeypatch.setattr(main, "add_balance", lambda user_id, songs: refunds.append((user_id, songs)))
+
+        async def run():
+            await asyncio.gather(*(
+                main.piapi_generate_music("la la", "Pop", "Happy", demo=False, paid_by=1) for _ in range(2)
+            ))
+            await main.piapi_generate_music("la la", "Pop", "Happy", demo=False, paid_by=1)  # reused
+            await main.piapi_generate_music("la la", "Pop", "Happy", demo=False, paid_by=2)  # another user pays
+
+        asyncio.run(run())
+        assert len(piapi) == 1
+        assert refunds == [(1, 1), (1, 1)]
+
+    def test_failed_generation_forgets_payers(self, piapi, monkeypatch):
+        refunds = []
+        monkeypatch.setattr(main, "add_balance", lambda user_id, songs: refunds.append(user_id))
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                asyncio.run(main.piapi_generate_music("broken", "Pop", "Happy", demo=False, paid_by=1))
+        assert refunds == []
+        assert main._generation_payers == {}
+
+    def test_savings_report(self, piapi, monkeypatch):
+        monkeypatch.setattr(main, "PIAPI_TASK_COST", 0.25)
+        monkeypatch.setattr(main, "DEDUPE_STATS", {"submitted": 4, "coalesced": 3, "reused": 5})
+        savings = main.dedupe_savings()
+        assert savings["requests_saved"] == 8
+        assert savings["money_saved"] == 2.0
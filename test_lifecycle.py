@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Test health endpoints, draining and checkpoint/resume of generations
+"""
+
+import os
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def lifecycle(monkeypatch):
+    """Isolate shutdown state and DB access"""
+    monkeypatch.setattr(main, "INFLIGHT_GENERATIONS", {})
+    monkeypatch.setattr(main, "GENERATION_TASK_IDS", {})
+    monkeypatch.setattr(main, "telegram_app", None)
+    monkeypatch.setattr(main, "db_ping", lambda: None)
+    yield
+    main.SHUTTING_DOWN.clear()
+
+
+@pytest.fixture
+def client(lifecycle):
+    return TestClient(main.app)
+
+
+class TestHealthEndpoints:
+    """Test liveness and readiness"""
+
+    def test_healthz(self, client):
+        assert client.get("/healthz").json()["status"] == "ok"
+
+    def test_ready(self, client):
+        resp = client.get("/readyz")
+        assert resp.status_code == 200
+        assert resp.json()["db"]["ok"] is True
+
+    def test_db_down_is_not_ready(self, client, monkeypatch):
+        def db_ping():
+            raise RuntimeError("connection refused")
+        monkeypatch.setattr(main, "db_ping", db_ping)
+        resp = client.get("/readyz")
+        assert resp.status_code == 503
+        assert "connection refused" in resp.json()["db"]["error"]
+
+    def test_shutting_down_is_not_ready(self, client):
+        main.SHUTTING_DOWN.set()
+        assert client.get("/readyz").status_code == 503
+
+    def test_update_backlog_is_not_ready(self, client, monkeypatch):
+        app = MagicMock()
+        app.update_queue.qsize.return_value = main.READY_MAX_QUEUE + 1
+        monkeypatch.setattr(main, "telegram_app", app)
+        assert client.get("/readyz").status_code == 503
+
+
+class TestGracefulShutdown:
+    """Test draining and checkpointing on shutdown"""
+
+    def patch_resources(self, monkeypatch):
+        monkeypatch.setattr(main, "close_db_pool", lambda timeout=5.0: None)
+        monkeypatch.setattr(main, "BROADCAST_TASKS", {})
+
+    def test_drain_waits_for_generations(self, lifecycle):
+        async def run():
+            main.INFLIGHT_GENERATIONS[1] = 10
+            asyncio.get_running_loop().call_later(0.05, main.INFLIGHT_GENERATIONS.clear)
+            return await main.drain_inflight(asyncio.get_running_loop().time() + 5)
+
+        assert asyncio.run(run()) is True
+
+    def test_unfinished_generations_are_checkpointed(self, lifecycle, monkeypatch):
+        self.patch_resources(monkeypatch)
+        monkeypatch.setattr(main, "SHUTDOWN_GRACE_SECONDS", 0.1)
+        checkpointed, task_ids = [], {}
+        monkeypatch.setattr(main, "interrupt_generations",
+                            lambda ids, tasks: checkpointed.extend(ids) or task_ids.update(tasks) or len(ids))
+        main.INFLIGHT_GENERATIONS.update({7: 70, 8: 80})
+        main.GENERATION_TASK_IDS[8] = "task-8"  # result arrived, still sending
+
+        asyncio.run(main.graceful_shutdown())
+
+        assert sorted(checkpointed) == [7, 8]
+        assert task_ids == {8: "task-8"}
+        assert main.SHUTTING_DOWN.is_set()
+
+    def test_idle_shutdown_stops_polling_without_checkpoint(self, lifecycle, monkeypatch):
+        self.patch_resources(monkeypatch)
+        monkeypatch.setattr(main, "interrupt_generations", lambda ids, tasks: pytest.fail("nothing to checkpoint"))
+        app = MagicMock()
+        app.updater.running = True
+        app.updater.stop = AsyncMock()
+        app.running = True
+        app.stop = AsyncMock()
+        app.shutdown = AsyncMock()
+        app.update_queue.qsize.return_value = 0
+        monkeypatch.setattr(main, "telegram_app", app)
+
+        asyncio.run(main.graceful_shutdown())
+
+        app.updater.stop.assert_awaited_once()
+        app.stop.assert_awaited_once()
+        app.shutdown.assert_awaited_once()
+
+
+class TestDeliverGeneration:
+    """Test generation delivery, bookkeeping and resume"""
+
+    def patch(self, monkeypatch, result):
+        finished, saved = [], []
+        monkeypatch.setattr(main, "piapi_generate_music", AsyncMock(return_value=result))
+        monkeypatch.setattr(main, "finish_generation", lambda gid, status, task_id=None, error=None: finished.append((gid, status)))
+        monkeypatch.setattr(main, "save_songs", lambda user_id, gid, task_id, songs: saved.extend(songs))
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        return finished, saved
+
+    def test_success(self, lifecycle, monkeypatch):
+        finished, saved = self.patch(monkeypatch, {"data": [{"audio_url": "https://cdn.test/1.mp3"}]})
+        sent = MagicMock()
+        sent.audio.file_id = "FILE_1"
+        send_audio, send_text = AsyncMock(return_value=sent), AsyncMock()
+
+        asyncio.run(main.deliver_generation(send_audio, send_text, 1, 42, "la la", "Pop", "Happy"))
+
+        assert finished == [(42, "done")]
+        assert saved[0]["file_id"] == "FILE_1"
+        assert send_text.call_args.args[0] == "done"
+        assert main.INFLIGHT_GENERATIONS == {}
+
+    def test_failed_send_still_saves_the_songs(self, lifecycle, monkeypatch):
+        finished, saved = self.patch(monkeypatch, {"task_id": "t1", "data": [
+            {"audio_url": "https://cdn.test/1.mp3"}, {"audio_url": "https://cdn.test/2.mp3"},
+        ]})
+        sent = MagicMock()
+        sent.audio.file_id = "FILE_1"
+        send_audio, send_text = AsyncMock(side_effect=[sent, RuntimeError("network")]), AsyncMock()
+
+        asyncio.run(main.deliver_generation(send_audio, send_text, 1, 44, "la la", "Pop", "Happy"))
+
+        assert [s["file_id"] for s in saved] == ["FILE_1", None]
+        assert [s["audio_url"] for s in saved] == ["https://cdn.test/1.mp3", "https://cdn.test/2.mp3"]
+        assert finished == [(44, "done")]
+        assert send_text.call_args.args[0] == "error"
+
+    def test_no_audio_is_a_failure(self, lifecycle, monkeypatch):
+        finished, _ = self.patch(monkeypatch, {"data": []})
+        asyncio.run(main.deliver_generation(AsyncMock(), AsyncMock(), 1, 43, "la la", "Pop", "Happy"))
+        assert finished == [(43, "failed")]
+
+    def test_resume_sends_to_user_chat(self, lifecycle, monkeypatch):
+        self.patch(monkeypatch, {"data": [{"audio_url": "https://cdn.test/2.mp3"}]})
+        monkeypatch.setattr(main, "claim_interrupted_generations", lambda: [
+            {"id": 9, "user_id": 555, "lyrics": "la", "genre": "Rock", "mood": "Sad"},
+        ])
+        bot = MagicMock()
+        bot.send_audio = AsyncMock()
+        bot.send_message = AsyncMock()
+
+        async def run():
+            resumed = await main.resume_interrupted_generations(bot)
+            await asyncio.gather(*main._background_tasks)
+            return resumed
+
+        assert asyncio.run(run()) == 1
+        bot.send_audio.assert_awaited_once_with(555, "https://cdn.test/2.mp3")
+
+    def test_resume_fetches_the_checkpointed_task(self, lifecycle, monkeypatch):
+        finished, saved = self.patch(monkeypatch, {"data": []})
+        fetch = AsyncMock(return_value={"task_id": "t9", "data": [{"audio_url": "https://cdn.test/9.mp3"}]})
+        monkeypatch.setattr(main, "piapi_fetch_task", fetch)
+        send_audio = AsyncMock()
+
+        asyncio.run(main.deliver_generation(send_audio, AsyncMock(), 1, 9, "la", "Rock", "Sad", task_id="t9"))
+
+        fetch.assert_awaited_once_with("t9")
+        main.piapi_generate_music.assert_not_awaited()
+        send_audio.assert_awaited_once_with("https://cdn.test/9.mp3")
+        assert finished == [(9, "done")]
+        assert main.GENERATION_TASK_IDS == {}
+
+    def test_unusable_task_is_generated_again(self, lifecycle, monkeypatch):
+        finished, _ = self.patch(monkeypatch, {"data": [{"audio_url": "https://cdn.test/new.mp3"}]})
+        monkeypatch.setattr(main, "piapi_fetch_task", AsyncMock(side_effect=RuntimeError("PIAPI error 404")))
+
+        asyncio.run(main.deliver_generation(AsyncMock(), AsyncMock(), 1, 10, "la", "Rock", "Sad", task_id="gone"))
+
+        main.piapi_generate_music.assert_awaited_once()
+        assert finished == [(10, "done")]
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestGenerationLease:
+    """Interrupted generations are leased to one instance, and taken over once the lease expires"""
+
+    USER = 9_600_001
+
+    @pytest.fixture(autouse=True)
+    def db(self, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        main.init_db()
+        with main.db_conn() as conn:
+            conn.execute("UPDATE generations SET status='failed' WHERE status IN ('interrupted', 'resuming')")
+            conn.commit()
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM generations WHERE user_id=%s", (self.USER,))
+            conn.commit()
+
+    def interrupted(self, n):
+        ids = [main.start_generation(self.USER, f"la {i}", "Pop", "Happy") for i in range(n)]
+        assert main.interrupt_generations(ids, {ids[0]: "task-0"}) == n
+        return ids
+
+    def test_each_row_is_claimed_once(self):
+        ids = self.interrupted(3)
+        first, second = main.claim_interrupted_generations(), main.claim_interrupted_generations()
+        assert sorted(r["id"] for r in first) == ids and second == []
+        assert {r["id"]: r["task_id"] for r in first}[ids[0]] == "task-0"
+        with main.db_conn() as conn:
+            rows = conn.execute("SELECT status, claimed_by FROM generations WHERE id = ANY(%s)", (ids,)).fetchall()
+        assert {(r["status"], r["claimed_by"]) for r in rows} == {("resuming", main.INSTANCE_ID)}
+
+    def test_locked_rows_are_skipped(self):
+        ids = self.interrupted(2)
+        with main.db_conn() as conn:
+            conn.execute("SELECT id FROM generations WHERE id=%s FOR UPDATE", (ids[0],))
+            assert [r["id"] for r in main.claim_interrupted_generations()] == [ids[1]]
+            conn.rollback()
+        assert [r["id"] for r in main.claim_interrupted_generations()] == [ids[0]]
+
+    def test_expired_lease_is_taken_over(self):
+        ids = self.interrupted(1)
+        assert len(main.claim_interrupted_generations()) == 1
+        assert main.claim_interrupted_generations() == []
+        assert [r["id"] for r in main.claim_interrupted_generations(lease=0)] == ids
+
+    def test_shutdown_while_resuming_checkpoints_again(self):
+        ids = self.interrupted(1)
+        main.claim_interrupted_generations()
+        assert main.interrupt_generations(ids) == 1
+        assert [r["id"] for r in main.claim_interrupted_generations()] == ids
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Test the load-test harness: upstream stand-ins, update builders and result comparison
+"""
+
+import asyncio
+import pytest
+import stripe
+from telegram import Update
+
+import main
+import loadtest
+
+
+class TestHelpers:
+    """Test profile parsing, percentiles and regression detection"""
+
+    def test_parse_profiles(self):
+        profiles = loadtest.parse_profiles("openrouter=200", "piapi=0.5", jitter=0.1)
+        assert profiles["openrouter"].latency == 0.2
+        assert profiles["piapi"].error_rate == 0.5
+        assert profiles["telegram"].latency == loadtest.DEFAULT_LATENCY_MS["telegram"] / 1000
+
+    def test_parse_profiles_rejects_unknown_upstream(self):
+        with pytest.raises(ValueError):
+            loadtest.parse_profiles("suno=100")
+
+    def test_percentile(self):
+        values = [i / 100 for i in range(1, 101)]
+        assert loadtest.percentile(values, 50) == 0.5
+        assert loadtest.percentile(values, 99) == 0.99
+        assert loadtest.percentile([], 99) == 0.0
+
+    def test_compare_results_flags_regressions(self):
+        baseline = {"throughput_updates_per_s": 100,
+                    "steps": {"text": {"p99_ms": 100, "db_statements_per_update": 4}}}
+        same = {"throughput_updates_per_s": 95,
+                "steps": {"text": {"p99_ms": 105, "db_statements_per_update": 4}}}
+        worse = {"throughput_updates_per_s": 50,
+                 "steps": {"text": {"p99_ms": 300, "db_statements_per_update": 6}}}
+
+        assert loadtest.compare_results(baseline, same, 0.1) == []
+        assert len(loadtest.compare_results(baseline, worse, 0.1)) == 3
+
+    def test_signed_webhook_payload_verifies(self):
+        payload = loadtest.checkout_completed_event(42)
+        header = loadtest.sign_stripe_payload(payload)
+        event = stripe.Webhook.construct_event(payload, header, loadtest.WEBHOOK_SECRET)
+        assert event["data"]["object"]["metadata"]["user_id"] == "42"
+
+
+class TestFakeUpstreams:
+    """Test main talking to the local stand-ins"""
+
+    def test_lyrics_generation_and_checkout(self, restore_main):
+        async def run():
+            fakes = loadtest.FakeUpstreams(loadtest.parse_profiles("openrouter=0,piapi=0,stripe=0"))
+            base_url = await fakes.start()
+            try:
+                loadtest.point_main_at(base_url)
+                lyrics = await main.openrouter_lyrics("rain", "en", "Pop", "Sad")
+                music = await main.piapi_generate_music(lyrics, "Pop", "Sad", demo=False)
+                url = await asyncio.to_thread(main.create_checkout_session, 7, "pack_5")
+            finally:
+                await fakes.stop()
+            return fakes, lyrics, music, url
+
+        fakes, lyrics, music, url = asyncio.run(run())
+
+        assert "[Verse 1]" in lyrics
+        assert main.extract_audio_urls(music)[0].endswith(".mp3")
+        assert url.startswith("https://checkout.stripe.test/")
+        assert fakes.requests == {"openrouter": 1, "piapi": 1, "stripe": 1}
+
+    def test_upstream_errors_follow_profile(self, restore_main):
+        async def run():
+            fakes = loadtest.FakeUpstreams(loadtest.parse_profiles("openrouter=0", "openrouter=1"))
+            loadtest.point_main_at(await fakes.start())
+            try:
+                with pytest.raises(RuntimeError):
+                    await main.openrouter_lyrics("rain", "en", "Pop", "Sad")
+            finally:
+                await main.close_http_session()
+                await fakes.stop()
+            return fakes
+
+        assert asyncio.run(run()).errors["openrouter"] >= 1
+
+    def test_bot_talks_to_fake_bot_api(self, restore_main, monkeypatch):
+        monkeypatch.setattr(main, "ensure_user", lambda user_id, reactivate=False: None)
+        monkeypatch.setattr(main, "get_user", lambda user_id: {"user_id": user_id, "lang": "en"})
+
+        async def run():
+            fakes = loadtest.FakeUpstreams(loadtest.parse_profiles("telegram=0"))
+            base_url = await fakes.start()
+            application = main.build_telegram_app(loadtest.BOT_TOKEN, base_url=base_url)
+            try:
+                await application.initialize()
+                update = Update.de_json(loadtest.message_update(5, "/start"), application.bot)
+                await application.process_update(update)
+            finally:
+                await application.shutdown()
+                await fakes.stop()
+            return fakes
+
+        fakes = asyncio.run(run())
+        assert fakes.requests["telegram"] == 2  # getMe + sendMessage
+        assert fakes.error_replies == 0
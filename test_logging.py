@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Test queue-based logging: sampling, dropping, correlation ids and JSON output
+"""
+
+import io
+import sys
+import json
+import time
+import logging
+import logging.handlers
+import queue
+import threading
+
+import main
+
+
+def make_record(name="main", level=logging.INFO, msg="hello %s", args=("world",), exc_info=None):
+    return logging.LogRecord(name, level, __file__, 1, msg, args, exc_info)
+
+
+class TestSampling:
+    """Test per-logger sampling"""
+
+    def test_parse(self):
+        assert main.parse_sampling("main.updates=0.1, httpx=0 ,bad,") == {"main.updates": 0.1, "httpx": 0.0}
+
+    def test_most_specific_prefix_wins(self):
+        f = main.SamplingFilter({"main": 1.0, "main.updates": 0.0})
+        assert f.filter(make_record("main.updates.callbacks")) is False
+        assert f.filter(make_record("main")) is True
+        assert f.filter(make_record("telegram")) is True
+
+    def test_warnings_are_never_sampled(self):
+        f = main.SamplingFilter({"main.updates": 0.0})
+        assert f.filter(make_record("main.updates", logging.WARNING)) is True
+
+
+class TestAsyncQueueHandler:
+    """Test the non-blocking handler"""
+
+    def test_drops_when_full(self):
+        handler = main.AsyncQueueHandler(queue.Queue(2))
+        for _ in range(5):
+            handler.handle(make_record())
+        assert handler.queue.qsize() == 2
+        assert handler.dropped == 3
+
+    def test_message_is_interpolated_on_the_caller(self):
+        handler = main.AsyncQueueHandler(queue.Queue())
+        args = ["before"]
+        handler.handle(make_record(args=(args,)))
+        args[0] = "after"
+        record = handler.queue.get_nowait()
+        assert record.getMessage() == "hello ['before']"
+        assert record.args is None
+
+    def test_correlation_ids_from_current_update(self):
+        handler = main.AsyncQueueHandler(queue.Queue())
+        root = main.Span("on_callback", "a" * 32, "b" * 16, attrs={"update.id": 7, "user.id": 42})
+        token = main._current_span.set(root)
+        try:
+            with main.span("db.get_user"):
+                handler.handle(make_record())
+        finally:
+            main._current_span.reset(token)
+        handler.handle(make_record())
+
+        inside, outside = handler.queue.get_nowait(), handler.queue.get_nowait()
+        assert inside.context == {"trace_id": "a" * 32, "update_id": 7, "user_id": 42}
+        assert outside.context == {}
+
+    def test_slow_stream_does_not_block_callers(self):
+        class SlowStream(io.StringIO):
+            writers = set()
+
+            def write(self, s):
+                self.writers.add(threading.current_thread())
+                time.sleep(0.01)
+                return super().write(s)
+
+        stream = SlowStream()
+        writer = logging.StreamHandler(stream)
+        writer.setFormatter(main.JsonFormatter())
+        handler = main.AsyncQueueHandler(queue.Queue(1000))
+        listener = logging.handlers.QueueListener(handler.queue, writer)
+        listener.start()
+        try:
+            for i in range(100):
+                handler.handle(make_record(args=(i,)))
+        finally:
+            listener.stop()
+
+        assert stream.writers and threading.current_thread() not in stream.writers
+        assert len(stream.getvalue().splitlines()) == 100
+
+
+class TestFormatters:
+    """Test JSON and text output"""
+
+    def test_json(self):
+        record = make_record()
+        record.context = {"trace_id": "t1", "update_id": 3}
+        doc = json.loads(main.JsonFormatter().format(record))
+        assert doc["msg"] == "hello world"
+        assert doc["level"] == "INFO" and doc["logger"] == "main"
+        assert doc["trace_id"] == "t1" and doc["update_id"] == 3
+
+    def test_json_exception(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = make_record(level=logging.ERROR, exc_info=sys.exc_info())
+        doc = json.loads(main.JsonFormatter().format(record))
+        assert "ValueError: boom" in doc["exc"]
+
+    def test_text_appends_trace_id(self):
+        formatter = main.TextFormatter(logging.BASIC_FORMAT)
+        record = make_record()
+        assert formatter.format(record) == "INFO:main:hello world"
+        record.context = {"trace_id": "t1"}
+        assert formatter.format(record) == "INFO:main:hello world trace=t1"
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Test multi-model lyrics routing and hedged requests
+"""
+
+import time
+import asyncio
+import pytest
+
+import main
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """Two-model pool with fresh stats"""
+    models = ["model/fast", "model/slow"]
+    monkeypatch.setattr(main, "OPENROUTER_API_KEY", "test_openai_key")
+    monkeypatch.setattr(main, "OPENROUTER_MODELS", models)
+    monkeypatch.setattr(main, "MODEL_STATS", {m: main.ModelStats(m) for m in models})
+    return models
+
+
+def fake_call(delays, failing=()):
+    """Build a stand-in for _openrouter_call with per-model latency"""
+    calls = []
+    cancelled = []
+
+    async def _call(session, model, prompt):
+        calls.append(model)
+        try:
+            await asyncio.sleep(delays[model])
+        except asyncio.CancelledError:
+            cancelled.append(model)
+            raise
+        if model in failing:
+            raise RuntimeError(f"{model} down")
+        return f"lyrics from {model}"
+
+    return _call, calls, cancelled
+
+
+class TestModelRanking:
+    """Test routing preference across the model pool"""
+
+    def test_config_order_without_samples(self, pool):
+        assert main.rank_models() == pool
+
+    def test_prefers_fastest_model(self, pool):
+        for _ in range(5):
+            main.model_stats("model/fast").record_success(2.0)
+            main.model_stats("model/slow").record_success(0.5)
+        assert main.rank_models() == ["model/slow", "model/fast"]
+
+    def test_benched_model_goes_last(self, pool):
+        main.model_stats("model/slow").record_success(0.1)
+        for _ in range(main.MODEL_FAILURE_THRESHOLD):
+            main.model_stats("model/slow").record_failure()
+        assert not main.model_stats("model/slow").healthy()
+        assert main.rank_models() == ["model/fast", "model/slow"]
+
+
+class TestHedging:
+    """Test hedged and failover lyrics requests"""
+
+    def test_backup_wins_when_primary_is_slow(self, pool, monkeypatch):
+        call, calls, cancelled = fake_call({"model/fast": 1.0, "model/slow": 0.01})
+        monkeypatch.setattr(main, "_openrouter_call", call)
+        monkeypatch.setattr(main, "OPENROUTER_HEDGE", True)
+        monkeypatch.setattr(main, "OPENROUTER_HEDGE_DELAY", 0.05)
+
+        result = asyncio.run(main.openrouter_lyrics("topic", "en", "Pop", "Happy"))
+
+        assert result == "lyrics from model/slow"
+        assert calls == ["model/fast", "model/slow"]
+        assert cancelled == ["model/fast"]
+
+    def test_no_hedge_when_primary_is_fast(self, pool, monkeypatch):
+        call, calls, _ = fake_call({"model/fast": 0.01, "model/slow": 0.01})
+        monkeypatch.setattr(main, "_openrouter_call", call)
+        monkeypatch.setattr(main, "OPENROUTER_HEDGE", True)
+        monkeypatch.setattr(main, "OPENROUTER_HEDGE_DELAY", 0.5)
+
+        result = asyncio.run(main.openrouter_lyrics("topic", "en", "Pop", "Happy"))
+
+        assert result == "lyrics from model/fast"
+        assert calls == ["model/fast"]
+
+    def test_failover_without_hedging(self, pool, monkeypatch):
+        call, calls, _ = fake_call({"model/fast": 0, "model/slow": 0}, failing={"model/fast"})
+        monkeypatch.setattr(main, "_openrouter_call", call)
+        monkeypatch.setattr(main, "OPENROUTER_HEDGE", False)
+
+        result = asyncio.run(main.openrouter_lyrics("topic", "en", "Pop", "Happy"))
+
+        assert result == "lyrics from model/slow"
+        assert calls == ["model/fast", "model/slow"]
+
+    def test_cancelled_call_records_no_latency(self, pool):
+        class SlowSession:
+            def post(self, *args, **kwargs):
+                return self
+
+            async def __aenter__(self):
+                await asyncio.sleep(1)
+
+            async def __aexit__(self, *exc):
+                pass
+
+        async def run():
+            task = asyncio.create_task(main._openrouter_call(SlowSession(), "model/fast", "prompt"))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(run())
+        stats = main.model_stats("model/fast")
+        assert list(stats.latencies) == []
+        assert (stats.requests, stats.errors) == (0, 0)
+
+    def test_all_models_failing_raises(self, pool, monkeypatch):
+        call, _, _ = fake_call({"model/fast": 0, "model/slow": 0}, failing=set(pool))
+        monkeypatch.setattr(main, "_openrouter_call", call)
+        monkeypatch.setattr(main, "OPENROUTER_HEDGE", True)
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(main.openrouter_lyrics("topic", "en", "Pop", "Happy"))
+
+
+class TestLyricsVariants:
+    """Test concurrent multi-variant lyrics generation"""
+
+    def test_variants_run_concurrently(self, monkeypatch):
+        spans = []
+
+        async def fake_lyrics(topic, lang_code, genre, mood):
+            started = time.perf_counter()
+            await asyncio.sleep(0.05)
+            spans.append((started, time.perf_counter()))
+            return f"{topic} lyrics"
+
+        monkeypatch.setattr(main, "openrouter_lyrics", fake_lyrics)
+
+        variants = asyncio.run(main.openrouter_lyrics_variants("rain", "en", "Pop", "Sad", 3))
+
+        assert variants == ["rain lyrics"] * 3
+        assert max(start for start, _ in spans) < min(end for _, end in spans)
+
+    def test_failed_variants_are_dropped(self, monkeypatch):
+        calls = []
+
+        async def fake_lyrics(topic, lang_code, genre, mood):
+            calls.append(topic)
+            if len(calls) == 2:
+                raise RuntimeError("OpenRouter error")
+            return "lyrics"
+
+        monkeypatch.setattr(main, "openrouter_lyrics", fake_lyrics)
+
+        variants = asyncio.run(main.openrouter_lyrics_variants("rain", "en", "Pop", "Sad", 3))
+        assert variants == ["lyrics", "lyrics"]
+
+    def test_all_variants_failing_raises(self, monkeypatch):
+        async def fake_lyrics(topic, lang_code, genre, mood):
+            raise RuntimeError("OpenRouter error")
+
+        monkeypatch.setattr(main, "openrouter_lyrics", fake_lyrics)
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(main.openrouter_lyrics_variants("rain", "en", "Pop", "Sad", 2))
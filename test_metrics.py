@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Test the metrics registry, /metrics endpoint and instrumentation overhead
+"""
+
+import time
+import asyncio
+import pytest
+import prometheus_client
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def registry():
+    """Isolated metrics registry"""
+    return prometheus_client.CollectorRegistry()
+
+
+class TestExposition:
+    """Test Prometheus text rendering"""
+
+    def test_histogram_buckets_are_cumulative(self, registry):
+        hist = main.Histogram("test_seconds", "Test latency", ("op",), buckets=(0.1, 1.0), registry=registry)
+        child = hist.labels("get")
+        for value in (0.05, 0.5, 5.0):
+            child.observe(value)
+
+        text = main.render_metrics(registry)
+
+        assert "# TYPE test_seconds histogram" in text
+        assert 'test_seconds_bucket{le="0.1",op="get"} 1' in text
+        assert 'test_seconds_bucket{le="1.0",op="get"} 2' in text
+        assert 'test_seconds_bucket{le="+Inf",op="get"} 3' in text
+        assert 'test_seconds_count{op="get"} 3' in text
+
+    def test_counter_and_label_escaping(self, registry):
+        counter = main.Counter("test_total", "Test counter", ("type",), registry=registry)
+        counter.labels('Bad"Value').inc()
+        counter.labels('Bad"Value').inc(2)
+        assert 'test_total{type="Bad\\"Value"} 3.0' in main.render_metrics(registry)
+
+    def test_gauge_function(self, registry):
+        gauge = main.Gauge("test_depth", "Test gauge", ("queue",), registry=registry)
+        depth = [4]
+        gauge.set_function(lambda: len(depth) * 7, "jobs")
+        gauge.set_function(lambda: None.qsize(), "closed")
+        text = main.render_metrics(registry)
+        assert 'test_depth{queue="jobs"} 7' in text
+        assert 'test_depth{queue="closed"} NaN' in text
+
+    def test_metrics_endpoint(self):
+        main.CALLBACKS.labels("buy").inc()
+        resp = TestClient(main.app).get("/metrics")
+        assert resp.status_code == 200
+        assert resp.headers["content-type"].startswith("text/plain")
+        assert 'musicai_callbacks_total{action="buy"}' in resp.text
+        assert "musicai_db_seconds" in resp.text
+
+
+class TestTimed:
+    """Test the latency decorator"""
+
+    def test_sync_function_is_timed(self, registry):
+        hist = main.Histogram("test_seconds", "Test latency", ("op",), registry=registry)
+
+        @main.timed(hist, "work")
+        def work(x):
+            return x * 2
+
+        assert work(21) == 42
+        assert registry.get_sample_value("test_seconds_count", {"op": "work"}) == 1
+
+    def test_async_errors_are_counted(self, registry):
+        hist = main.Histogram("test_seconds", "Test latency", ("op",), registry=registry)
+
+        @main.timed(hist, "boom")
+        async def boom():
+            raise ValueError("nope")
+
+        def errors():
+            return prometheus_client.REGISTRY.get_sample_value(
+                "musicai_errors_total", {"where": "boom", "type": "ValueError"}) or 0
+
+        before = errors()
+        with pytest.raises(ValueError):
+            asyncio.run(boom())
+        assert registry.get_sample_value("test_seconds_count", {"op": "boom"}) == 1
+        assert errors() == before + 1
+
+
+class TestOverhead:
+    """Microbenchmark: instrumentation must be cheap enough to leave on"""
+
+    CALLS = 50_000
+
+    @pytest.mark.benchmark
+    def test_timed_overhead_per_call(self, registry):
+        hist = main.Histogram("bench_seconds", "Benchmark latency", ("op",), registry=registry)
+
+        def bare():
+            return None
+
+        instrumented = main.timed(hist, "bare")(bare)
+
+        def run(fn):
+            started = time.perf_counter()
+            for _ in range(self.CALLS):
+                fn()
+            return time.perf_counter() - started
+
+        run(instrumented)  # warm up
+        overhead = (min(run(instrumented) for _ in range(3)) - min(run(bare) for _ in range(3))) / self.CALLS
+
+        print(f"\ntimed() overhead: {overhead * 1e6:.2f}us per call")
+        # A DB round trip is ~1ms; a few microseconds is noise
+        assert overhead < 10e-6
+        assert registry.get_sample_value("bench_seconds_count", {"op": "bare"}) == self.CALLS * 4
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Test the schema migration runner
+"""
+
+import os
+import threading
+import pytest
+import psycopg
+from psycopg.conninfo import make_conninfo
+
+import main
+
+
+class TestMigrationList:
+    """Static checks on MIGRATIONS"""
+
+    def test_versions_are_unique_and_ordered(self):
+        versions = [m.version for m in main.MIGRATIONS]
+        assert versions == sorted(set(versions))
+
+    def test_concurrent_builds_are_not_transactional(self):
+        for m in main.MIGRATIONS:
+            if m.transactional:
+                assert "CONCURRENTLY" not in m.sql.upper(), m.name
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestMigrate:
+    """Run migrations against a throwaway database"""
+
+    DB_NAME = "musicai_migrations_test"
+
+    @pytest.fixture(autouse=True)
+    def scratch_db(self, monkeypatch):
+        admin_url = os.environ["DATABASE_URL"]
+        with psycopg.connect(admin_url, autocommit=True) as conn:
+            conn.execute(f"DROP DATABASE IF EXISTS {self.DB_NAME}")
+            conn.execute(f"CREATE DATABASE {self.DB_NAME}")
+        monkeypatch.setattr(main, "DATABASE_URL", make_conninfo(admin_url, dbname=self.DB_NAME))
+        monkeypatch.setattr(main, "DB_POOL", None)
+        yield
+        with psycopg.connect(admin_url, autocommit=True) as conn:
+            conn.execute(f"DROP DATABASE IF EXISTS {self.DB_NAME} WITH (FORCE)")
+
+    def test_applies_once(self):
+        assert main.migrate() == [m.version for m in main.MIGRATIONS]
+        assert main.migrate() == []
+
+    def test_concurrent_runners_serialize(self):
+        results, errors = [], []
+
+        def run():
+            try:
+                results.append(main.migrate())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert errors == []
+        assert sorted(v for r in results for v in r) == [m.version for m in main.MIGRATIONS]
+
+    def test_failed_migration_rolls_back(self):
+        main.migrate()
+        broken = main.MIGRATIONS + [main.Migration(1000, "broken", "CREATE TABLE half_done (id INT); SELECT 1/0")]
+        with pytest.raises(psycopg.errors.DivisionByZero):
+            main.migrate(broken)
+        with main.db_conn() as conn:
+            assert conn.execute("SELECT to_regclass('half_done') AS t").fetchone()["t"] is None
+            assert conn.execute("SELECT 1 FROM schema_migrations WHERE version=1000").fetchone() is None
+
+    @pytest.fixture
+    def table_lock(self, monkeypatch):
+        """Another session holding users in ACCESS EXCLUSIVE mode, and a short lock_timeout"""
+        main.migrate()
+        monkeypatch.setattr(main, "MIGRATION_LOCK_TIMEOUT", "100ms")
+        monkeypatch.setattr(main, "MIGRATION_RETRY_DELAY", 0)
+        with psycopg.connect(main.DATABASE_URL) as blocker:
+            blocker.execute("LOCK TABLE users IN ACCESS EXCLUSIVE MODE")
+            yield blocker
+
+    def test_lock_timeout_is_retried(self, table_lock, monkeypatch):
+        attempts = []
+        apply = main._apply_migration
+
+        def apply_then_release(conn, m, started):
+            attempts.append(m.version)
+            try:
+                apply(conn, m, started)
+            finally:
+                table_lock.rollback()  # the first attempt times out, then the lock is gone
+
+        monkeypatch.setattr(main, "_apply_migration", apply_then_release)
+        added = main.Migration(1000, "users_note", "ALTER TABLE users ADD COLUMN note TEXT")
+
+        assert main.migrate(main.MIGRATIONS + [added]) == [1000]
+        assert attempts == [1000, 1000]
+        with main.db_conn() as conn:
+            conn.execute("SELECT note FROM users LIMIT 0")
+
+    def test_lock_timeout_gives_up_after_the_retries(self, table_lock, monkeypatch):
+        monkeypatch.setattr(main, "MIGRATION_LOCK_RETRIES", 2)
+        added = main.Migration(1000, "users_note", "ALTER TABLE users ADD COLUMN note TEXT")
+        attempts = []
+        apply = main._apply_migration
+        monkeypatch.setattr(main, "_apply_migration", lambda conn, m, started: attempts.append(m) or apply(conn, m, started))
+
+        with pytest.raises(psycopg.errors.LockNotAvailable):
+            main.migrate(main.MIGRATIONS + [added])
+        assert len(attempts) == 3
+
+    def test_invalid_index_is_rebuilt(self):
+        main.migrate()
+        with psycopg.connect(main.DATABASE_URL, autocommit=True) as conn:
+            conn.execute(
+                "UPDATE pg_index SET indisvalid = false WHERE indexrelid = 'users_active_lang_idx'::regclass"
+            )
+        with psycopg.connect(main.DATABASE_URL, autocommit=True, row_factory=psycopg.rows.dict_row) as conn:
+            main.create_index_concurrently(conn, "users_active_lang_idx", "users (lang, user_id) WHERE active")
+            row = conn.execute(
+                "SELECT indisvalid FROM pg_index WHERE indexrelid = 'users_active_lang_idx'::regclass"
+            ).fetchone()
+        assert row["indisvalid"] is True
+
+    def test_signup_backfill_is_batched_and_idempotent(self, monkeypatch):
+        main.migrate()
+        monkeypatch.setattr(main, "BACKFILL_BATCH", 3)
+        with main.db_conn() as conn:
+            for user_id in range(1, 8):
+                conn.execute("INSERT INTO users (user_id, lang) VALUES (%s, %s)", (user_id, "en" if user_id % 2 else "pl"))
+            conn.commit()
+
+        with psycopg.connect(main.DATABASE_URL, autocommit=True, row_factory=psycopg.rows.dict_row) as conn:
+            main._backfill_signups(conn)
+            main._backfill_signups(conn)
+            rows = conn.execute(
+                "SELECT dimension, SUM(value) AS n FROM daily_stats WHERE metric='signups' GROUP BY 1 ORDER BY 1"
+            ).fetchall()
+        assert {r["dimension"]: r["n"] for r in rows} == {"en": 4, "pl": 3}
+
+    def test_prepared_reads_survive_an_added_column(self, monkeypatch):
+        main.migrate()
+        monkeypatch.setattr(main, "FAST_PROFILE", True)  # prepare on first use
+        monkeypatch.setattr(main, "DB_POOL_MIN", 1)
+        monkeypatch.setattr(main, "DB_POOL_MAX", 1)
+        main.open_db_pool()
+        try:
+            main.ensure_user(1)
+            with main.db_conn() as conn:
+                song_id = conn.execute("INSERT INTO songs (user_id) VALUES (1) RETURNING id").fetchone()["id"]
+                broadcast_id = conn.execute("INSERT INTO broadcasts (key) VALUES ('done') RETURNING id").fetchone()["id"]
+                conn.commit()
+            reads = [lambda: main.get_user(1), lambda: main.get_song(1, song_id), lambda: main.get_broadcast(broadcast_id)]
+            for read in reads:
+                assert read()
+            with psycopg.connect(main.DATABASE_URL, autocommit=True) as conn:  # an online migration elsewhere
+                for table in ("users", "songs", "broadcasts"):
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN added_later TEXT")
+            for read in reads:
+                assert "added_later" not in read()
+        finally:
+            main.close_db_pool()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Test payment crediting and batched notifications: coalescing per user, flushing on
+shutdown, both webhook paths and (with a scratch DATABASE_URL) single-statement credits
+"""
+
+import os
+import time
+import asyncio
+import pytest
+from unittest.mock import MagicMock
+from fastapi.testclient import TestClient
+
+from telegram.error import Forbidden
+
+import main
+import loadtest
+from test_broadcast import FakeBot
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    fake = FakeBot()
+    monkeypatch.setattr(main, "telegram_app", MagicMock(bot=fake))
+    monkeypatch.setattr(main, "BROADCAST_BUCKET", main.TokenBucket(1000.0))
+    return fake
+
+
+class TestPaymentNotifier:
+    """Test batching of "payment successful" messages"""
+
+    def test_burst_for_one_user_is_one_message(self, bot):
+        notifier = main.PaymentNotifier(delay=0.05)
+
+        async def run():
+            notifier.add(1, 5, 5, "en")
+            notifier.add(1, 1, 6, "en")
+            notifier.add(2, 1, 1, "uk")
+            notifier.add(1, 10, 16, "en")
+            await asyncio.sleep(0.15)
+
+        asyncio.run(run())
+        assert sorted(chat for chat, _ in bot.sent) == [1, 2]
+        text = dict(bot.sent)[1]
+        assert "+16 songs" in text and "balance: 16 songs" in text
+        assert (notifier.sent, notifier.coalesced) == (2, 2)
+        assert notifier.pending == {}
+
+    def test_out_of_order_balance_keeps_the_highest(self, bot):
+        notifier = main.PaymentNotifier(delay=10)
+
+        async def run():
+            notifier.add(1, 5, 11, "en")
+            notifier.add(1, 5, 6, "pl")  # committed first, read back later
+            await notifier.close()
+
+        asyncio.run(run())
+        [(chat, text)] = bot.sent
+        assert "+10 piosenek" in text and "saldo: 11 piosenek" in text
+
+    def test_close_sends_without_waiting_for_the_timer(self, bot):
+        notifier = main.PaymentNotifier(delay=60)
+
+        async def run():
+            notifier.add(1, 5, 5, "en")
+            await asyncio.wait_for(notifier.close(), 1)
+
+        asyncio.run(run())
+        assert [chat for chat, _ in bot.sent] == [1]
+
+    def test_payments_during_a_flush_are_not_lost(self, monkeypatch):
+        bot = FakeBot()
+        monkeypatch.setattr(main, "telegram_app", MagicMock(bot=bot))
+        notifier = main.PaymentNotifier(delay=0.01)
+
+        async def slow_send(chat_id, text):
+            await asyncio.sleep(0.05)
+            bot.sent.append((chat_id, text))
+
+        bot.send_message = slow_send
+
+        async def run():
+            notifier.add(1, 5, 5, "en")
+            await asyncio.sleep(0.03)  # first flush is mid-send
+            notifier.add(2, 1, 1, "en")
+            await notifier.close()
+
+        asyncio.run(run())
+        assert sorted(chat for chat, _ in bot.sent) == [1, 2]
+
+    def test_waits_for_broadcast_flood_control(self, bot):
+        notifier = main.PaymentNotifier(delay=60)
+
+        async def run():
+            main.BROADCAST_BUCKET.pause(0.1)  # a broadcast just hit RetryAfter
+            notifier.add(1, 5, 5, "en")
+            started = time.monotonic()
+            await notifier.close()
+            return time.monotonic() - started
+
+        assert asyncio.run(run()) >= 0.09
+        assert [chat for chat, _ in bot.sent] == [1]
+
+    def test_failed_send_is_logged_not_raised(self, monkeypatch, caplog):
+        bot = FakeBot({1: [Forbidden("bot was blocked by the user")]})
+        monkeypatch.setattr(main, "telegram_app", MagicMock(bot=bot))
+        notifier = main.PaymentNotifier(delay=60)
+
+        async def run():
+            notifier.add(1, 5, 5, "en")
+            notifier.add(2, 5, 5, "en")
+            await notifier.close()
+
+        asyncio.run(run())
+        assert [chat for chat, _ in bot.sent] == [2]
+        assert notifier.sent == 1
+        assert "Failed to notify user 1" in caplog.text
+
+
+class TestWebhook:
+    """Both configured paths credit once and queue one notification"""
+
+    @pytest.fixture
+    def client(self, bot, monkeypatch):
+        credits = []
+        monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", loadtest.WEBHOOK_SECRET)
+        monkeypatch.setattr(main, "PAYMENT_NOTIFIER", main.PaymentNotifier(delay=60))
+
+        def record_payment(session_id, user_id, pack_id, amount, currency):
+            if session_id in [c[0] for c in credits]:
+                return None
+            credits.append((session_id, user_id, pack_id))
+            return {"balance": 5 * len(credits), "lang": "en"}
+
+        monkeypatch.setattr(main, "record_payment", record_payment)
+        client = TestClient(main.app)
+        client.credits = credits
+        return client
+
+    def post(self, client, path, payload):
+        return client.post(path, content=payload, headers={"Stripe-Signature": loadtest.sign_stripe_payload(payload)})
+
+    @pytest.mark.parametrize("path", ["/stripe/webhook", "/webhook/stripe"])
+    def test_credit_and_queue(self, client, path):
+        payload = loadtest.checkout_completed_event(7, "pack_5")
+        assert self.post(client, path, payload).json() == {"ok": True}
+        assert [c[1:] for c in client.credits] == [(7, "pack_5")]
+        assert main.PAYMENT_NOTIFIER.pending == {7: {"songs": 5, "balance": 5, "lang": "en"}}
+
+    def test_redelivery_is_not_notified_twice(self, client):
+        payload = loadtest.checkout_completed_event(7, "pack_5")
+        self.post(client, "/stripe/webhook", payload)
+        self.post(client, "/webhook/stripe", payload)
+        assert len(client.credits) == 1
+        assert main.PAYMENT_NOTIFIER.pending[7]["songs"] == 5
+
+    @pytest.mark.parametrize("path", ["/stripe/webhook", "/webhook/stripe"])
+    def test_verification_get(self, client, path):
+        assert client.get(path).json()["status"] == "ok"
+
+    def test_bad_signature(self, client):
+        payload = loadtest.checkout_completed_event(7)
+        resp = client.post("/webhook/stripe", content=payload,
+                           headers={"Stripe-Signature": loadtest.sign_stripe_payload(payload, secret="whsec_other")})
+        assert resp.status_code == 400
+        assert client.credits == []
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestRecordPayment:
+    """The credit, the new balance and the language come from one statement"""
+
+    USER = 9_400_001
+
+    @pytest.fixture(autouse=True)
+    def db(self, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        main.init_db()
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM payments WHERE user_id=%s", (self.USER,))
+            conn.execute("DELETE FROM users WHERE user_id=%s", (self.USER,))
+            conn.commit()
+
+    def test_new_user(self):
+        assert main.record_payment(f"cs_new_{self.USER}", self.USER, "pack_1", 600, "usd") == {"balance": 1, "lang": "uk"}
+
+    def test_existing_user_and_redelivery(self):
+        main.set_lang(self.USER, "ru")
+        main.add_balance(self.USER, 2)
+        assert main.record_payment(f"cs_a_{self.USER}", self.USER, "pack_5", 2000, "usd") == {"balance": 7, "lang": "ru"}
+        assert main.record_payment(f"cs_a_{self.USER}", self.USER, "pack_5", 2000, "usd") is None
+        assert main.record_payment(f"cs_b_{self.USER}", self.USER, "pack_1", 600, "usd") == {"balance": 8, "lang": "ru"}
+        assert main.get_user(self.USER)["balance"] == 8
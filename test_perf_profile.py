@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Test PERF_PROFILE=fast: codec parity, pipelined DB helpers, and a default-vs-fast benchmark
+
+The benchmark runs each profile in its own interpreter (the profile is fixed at import):
+
+    python test_perf_profile.py            # prints both profiles side by side
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import datetime
+import subprocess
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+import loadtest
+
+
+WEBHOOK_CALLS = 300
+STATS_CALLS = 100
+PIAPI_CALLS = 300
+
+
+def stats_rows(days=366):
+    today = datetime.date(2026, 10, 1)
+    rows = []
+    for d in range(days):
+        day = today - datetime.timedelta(days=d)
+        for lang in ("uk", "en", "ru", "pl"):
+            rows.append({"day": day, "metric": "signups", "dimension": lang, "value": d % 7})
+        for genre in main.GENRES:
+            rows.append({"day": day, "metric": "songs_generated", "dimension": genre, "value": d % 5})
+    return rows
+
+
+def per_call_us(fn, calls):
+    fn()  # warm up
+    started = time.perf_counter()
+    for _ in range(calls):
+        fn()
+    return (time.perf_counter() - started) / calls * 1e6
+
+
+def benchmark() -> dict:
+    """Drive the real handlers (webhook, /admin/stats, PIAPI client) under the current profile"""
+    main.install_event_loop()
+    main.ADMIN_API_TOKEN = "bench"
+    main.record_payment = lambda *args: None  # redelivery path: parse, verify, answer
+    rows = stats_rows()
+    main.daily_stats = lambda days: rows
+    client = TestClient(main.app)
+
+    async def piapi():
+        fakes = loadtest.FakeUpstreams()
+        loadtest.point_main_at(await fakes.start())
+        try:
+            await main.piapi_generate_music("warm up", "Pop", "Happy", False)
+            started = time.perf_counter()
+            for i in range(PIAPI_CALLS):
+                await main.piapi_generate_music(f"line {i}", "Pop", "Happy", False)
+            return (time.perf_counter() - started) / PIAPI_CALLS * 1e6
+        finally:
+            await main.close_http_session()
+            await fakes.stop()
+
+    piapi_us = asyncio.run(piapi())  # also points Stripe at the stand-in secret
+
+    def webhook():
+        payload = loadtest.checkout_completed_event(1)
+        resp = client.post("/stripe/webhook", content=payload,
+                           headers={"Stripe-Signature": loadtest.sign_stripe_payload(payload)})
+        assert resp.status_code == 200, resp.text
+
+    def stats():
+        assert client.get("/admin/stats?days=366", headers={"Authorization": "Bearer bench"}).status_code == 200
+
+    return {
+        "profile": main.perf_profile(),
+        "webhook_us": per_call_us(webhook, WEBHOOK_CALLS),
+        "stats_us": per_call_us(stats, STATS_CALLS),
+        "piapi_us": piapi_us,
+    }
+
+
+def run_profile(profile: str) -> dict:
+    env = {**os.environ, "PERF_PROFILE": profile, "TRACE_EXPORTER": "", "CAPTURE_FILE": "", "LOG_LEVEL": "WARNING"}
+    out = subprocess.run(
+        [sys.executable, os.path.abspath(__file__)], cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True, text=True, check=True, env=env,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+class TestCodec:
+    """orjson and stdlib json must be interchangeable"""
+
+    @pytest.fixture(params=[False, True], ids=["json", "orjson"])
+    def codec(self, request, monkeypatch):
+        if request.param and main.orjson is None:
+            pytest.skip("orjson not installed")
+        monkeypatch.setattr(main, "FAST_JSON", request.param)
+
+    def test_round_trip(self, codec):
+        doc = {"text": "Привіт 🎵", "n": 3, "f": 1.5, "items": [None, True, {"k": "v"}]}
+        encoded = main.json_dumps(doc)
+        assert isinstance(encoded, str)
+        assert json.loads(encoded) == doc
+        assert main.json_loads(encoded) == doc
+        assert main.json_loads(encoded.encode()) == doc
+
+    def test_stripe_event(self, codec, monkeypatch):
+        monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", loadtest.WEBHOOK_SECRET)
+        payload = loadtest.checkout_completed_event(42, "pack_5")
+        event = main.construct_stripe_event(payload, loadtest.sign_stripe_payload(payload))
+        assert event["type"] == "checkout.session.completed"
+        assert event["data"]["object"]["metadata"]["user_id"] == "42"
+
+    def test_stripe_signature_still_checked(self, codec, monkeypatch):
+        monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", loadtest.WEBHOOK_SECRET)
+        payload = loadtest.checkout_completed_event(42)
+        with pytest.raises(Exception, match="signature"):
+            main.construct_stripe_event(payload, loadtest.sign_stripe_payload(payload, secret="whsec_other"))
+
+    @pytest.mark.benchmark
+    @pytest.mark.skipif(main.orjson is None, reason="orjson not installed")
+    def test_orjson_parses_faster(self, monkeypatch):
+        payload = json.dumps({"data": [{"audio_url": f"https://cdn.test/{i}.mp3", "title": "t" * 40} for i in range(200)]})
+
+        def parse_us(fast):
+            monkeypatch.setattr(main, "FAST_JSON", fast)
+            return per_call_us(lambda: main.json_loads(payload), 500)
+
+        default, fast = parse_us(False), parse_us(True)
+        print(f"\nparse 200-item response: json {default:.0f}us, orjson {fast:.0f}us")
+        assert fast < default
+
+
+class TestBenchmark:
+    """Default vs fast profile on the existing handlers"""
+
+    def test_profiles(self):
+        default, fast = run_profile("default"), run_profile("fast")
+        assert default["profile"]["json"] == "json" and default["profile"]["db_pipeline"] is False
+        assert fast["profile"]["json"] == ("orjson" if main.orjson else "json")
+        assert fast["profile"]["loop"] == ("uvloop" if main.uvloop else "asyncio")
+        print()
+        for key in ("webhook_us", "stats_us", "piapi_us"):
+            print(f"{key:<11} default {default[key]:8.0f}us  fast {fast[key]:8.0f}us  ({default[key] / fast[key]:.2f}x)")
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestPipelinedHelpers:
+    """The user helpers behave the same with and without pipeline mode"""
+
+    USER = 9_300_001
+
+    @pytest.fixture(autouse=True, params=[False, True], ids=["direct", "pipeline"])
+    def db(self, request, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        monkeypatch.setattr(main, "DB_PIPELINE", request.param)
+        main.init_db()
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM payments WHERE user_id=%s", (self.USER,))
+            conn.execute("DELETE FROM users WHERE user_id=%s", (self.USER,))
+            conn.commit()
+
+    def test_user_helpers(self):
+        assert main.get_user(self.USER)["balance"] == 0
+        assert main.consume_song(self.USER) is False
+        main.add_balance(self.USER, 2)
+        main.set_lang(self.USER, "en")
+        assert main.consume_song(self.USER) is True
+        assert main.claim_demo(self.USER) is True
+        assert main.claim_demo(self.USER) is False
+        user = main.get_user(self.USER)
+        assert (user["balance"], user["lang"], user["demo_used"]) == (1, "en", 1)
+
+    def test_record_payment(self):
+        assert main.record_payment(f"cs_pipe_{self.USER}", self.USER, "pack_5", 2000, "usd") == {"balance": 5, "lang": "uk"}
+        assert main.record_payment(f"cs_pipe_{self.USER}", self.USER, "pack_5", 2000, "usd") is None
+        assert main.get_user(self.USER)["balance"] == 5
+
+
+if __name__ == "__main__":
+    print(json.dumps(benchmark()))
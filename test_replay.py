@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Test traffic capture scrubbing, capture files and the replay runner
+"""
+
+import os
+import gzip
+import json
+import time
+import asyncio
+import datetime
+import argparse
+import pytest
+
+import main
+import loadtest
+import replay
+
+
+def captured_update():
+    return {
+        "update_id": 10,
+        "message": {
+            "message_id": 3,
+            "date": 1700000000,
+            "chat": {"id": 555, "type": "private", "first_name": "Olena", "username": "olena_k"},
+            "from": {"id": 555, "is_bot": False, "first_name": "Olena", "last_name": "K", "username": "olena_k"},
+            "text": "/start ref_olena",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+class TestScrub:
+    """Test PII removal in captured traffic"""
+
+    def test_update_is_scrubbed(self):
+        scrubbed = main.scrub(captured_update())
+        message = scrubbed["message"]
+
+        assert message["from"]["first_name"] == message["chat"]["first_name"] == "User"
+        assert "last_name" not in message["from"] and "username" not in message["chat"]
+        assert message["from"]["id"] == message["chat"]["id"] == main.pseudo_id(555) != 555
+        assert message["text"].startswith("/start ") and "olena" not in message["text"]
+        assert len(message["text"]) == len("/start ref_olena")
+        assert message["entities"] == captured_update()["message"]["entities"]
+
+    def test_group_titles_and_file_ids_are_scrubbed(self):
+        update = {"update_id": 2, "message": {
+            "message_id": 4, "date": 1700000000,
+            "chat": {"id": -100123, "type": "supergroup", "title": "Olena's family"},
+            "from": {"id": 555, "is_bot": False, "first_name": "Olena"},
+            "voice": {"file_id": "AwACAgIAAxkBAAIBvoice", "file_unique_id": "AgADvoice", "duration": 3},
+        }}
+        message = main.scrub(update)["message"]
+
+        assert "olena" not in message["chat"]["title"].lower()
+        assert len(message["chat"]["title"]) == len("Olena's family")
+        voice = message["voice"]
+        assert voice["file_id"] != "AwACAgIAAxkBAAIBvoice" and len(voice["file_id"]) == len("AwACAgIAAxkBAAIBvoice")
+        assert voice["file_unique_id"] == main.pseudo_file_id("AgADvoice") != "AgADvoice"
+        assert voice["duration"] == 3
+
+    @pytest.mark.skipif(bool(os.getenv("CAPTURE_SALT")), reason="CAPTURE_SALT is set")
+    def test_default_salt_is_random_per_process(self):
+        assert main.CAPTURE_SALT != "musicai-capture" and len(main.CAPTURE_SALT) >= 32
+
+    def test_callback_data_user_id_is_pseudonymised(self):
+        update = {"update_id": 1, "callback_query": {"id": "1", "from": {"id": 555}, "data": "generate:555"}}
+        assert main.scrub(update)["callback_query"]["data"] == f"generate:{main.pseudo_id(555)}"
+
+    def test_real_forwarded_update_is_scrubbed(self):
+        from telegram import (Chat, Location, Message, MessageOriginHiddenUser, MessageOriginUser, Update,
+                              User, Venue)
+        when = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        group = Chat(-100777, Chat.SUPERGROUP, title="Smith family")
+        bob = User(777123456, "Bob", False, last_name="Smith", username="bobsmith")
+        alice = User(777654321, "Alice", False)
+        messages = [
+            Message(1, when, group, from_user=alice, text="hi", forward_origin=MessageOriginUser(when, bob)),
+            Message(2, when, group, from_user=alice, text="hi", forward_origin=MessageOriginHiddenUser(when, "Bob Smith")),
+            Message(3, when, group, from_user=alice, location=Location(30.5234, 50.4501)),
+            Message(4, when, group, from_user=alice, venue=Venue(Location(30.5234, 50.4501), "Home", "Khreshchatyk 1")),
+            Message(5, when, group, from_user=alice, new_chat_members=(bob,)),
+            Message(6, when, group, from_user=alice, left_chat_member=bob),
+        ]
+        for i, message in enumerate(messages):
+            dumped = json.dumps(main.scrub(Update(i, message=message).to_dict()))
+            for original in ("777123456", "777654321", "100777", "Bob", "Smith", "bobsmith", "30.5234", "50.4501",
+                             "Khreshchatyk"):
+                assert original not in dumped, (i, original)
+        forwarded = main.scrub(Update(0, message=messages[0]).to_dict())["message"]["forward_origin"]
+        assert forwarded["sender_user"]["id"] == main.pseudo_id(777123456)
+
+    def test_stripe_event_is_scrubbed(self):
+        event = json.loads(loadtest.checkout_completed_event(555))
+        event["data"]["object"]["customer_details"] = {"email": "olena@example.com", "name": "Olena K"}
+
+        scrubbed = main.scrub(event)
+        session = scrubbed["data"]["object"]
+
+        assert "customer_details" not in session
+        assert session["metadata"] == {"user_id": str(main.pseudo_id(555)), "pack": "pack_1"}
+        assert "olena" not in json.dumps(scrubbed).lower()
+
+
+class TestCaptureFile:
+    """Test recording and loading captures"""
+
+    def test_recorder_round_trip(self, tmp_path):
+        path = str(tmp_path / "capture.ndjson.gz")
+        recorder = main.TrafficRecorder(path)
+        recorder.record("update", captured_update())
+        recorder.record("stripe", loadtest.checkout_completed_event(555))
+        recorder.close()
+
+        records = replay.load_capture(path)
+
+        assert [r["kind"] for r in records] == ["update", "stripe"]
+        assert "olena" not in json.dumps(records).lower()
+        assert replay.record_user(records[0]) == replay.record_user(records[1]) == main.pseudo_id(555)
+
+    def test_truncated_capture_is_readable(self, tmp_path):
+        path = tmp_path / "capture.ndjson.gz"
+        full = gzip.compress(b'{"ts": 1, "kind": "update", "data": {}}\n{"ts": 2, "kind": "upd')
+        path.write_bytes(full[:-8])  # drop the gzip trailer, as after a kill -9
+        assert [r["ts"] for r in replay.load_capture(str(path))] == [1]
+
+    def test_arrival_offsets(self):
+        records = [{"ts": 100.0}, {"ts": 101.0}, {"ts": 110.0}]
+        assert replay.arrival_offsets(records, 10) == [0.0, 0.1, 1.0]
+        assert replay.arrival_offsets(records, 0) == [0.0, 0.0, 0.0]
+
+
+class TestReplayer:
+    """Test replaying through the real handlers with stand-in upstreams and DB helpers"""
+
+    def test_replay_run(self, restore_main, monkeypatch):
+        monkeypatch.setattr(main, "init_db", lambda: None)
+        monkeypatch.setattr(main, "open_db_pool", lambda: False)
+        monkeypatch.setattr(main, "ensure_user", lambda user_id, reactivate=False: None)
+        monkeypatch.setattr(main, "get_user", lambda user_id: {"user_id": user_id, "lang": "en", "balance": 0})
+        credited = []
+        monkeypatch.setattr(main, "record_payment",
+                            lambda session_id, user_id, pack_id, amount, currency:
+                            credited.append((user_id, pack_id)) or {"balance": 1, "lang": "en"})
+
+        now = time.time()
+        records = [
+            {"ts": now, "kind": "update", "data": main.scrub(loadtest.message_update(555, "/start"))},
+            {"ts": now + 0.05, "kind": "update", "data": main.scrub(loadtest.callback_update(555, "balance"))},
+            {"ts": now + 0.1, "kind": "stripe", "data": main.scrub(json.loads(loadtest.checkout_completed_event(555)))},
+        ]
+        args = argparse.Namespace(
+            capture="memory", speedup=1.0, seed_balance=0, concurrency=4, database_url="postgresql://unused",
+            latency="telegram=0", errors="", jitter=0.0, seed=1,
+        )
+
+        result = asyncio.run(replay.Replayer(args, records).run())
+
+        assert set(result["steps"]) == {"/start", "balance", "stripe:checkout.session.completed"}
+        assert result["upstream_requests"]["telegram"] >= 3
+        assert credited == [(main.pseudo_id(555), "pack_1")]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Test the song history: paging callbacks, keyboards and re-delivery
+"""
+
+import os
+import asyncio
+import datetime
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from telegram.error import BadRequest
+
+import main
+
+
+def make_songs(*ids):
+    day = datetime.datetime(2026, 10, 1, tzinfo=datetime.timezone.utc)
+    return [{"id": i, "title": f"Song {i}", "tags": "Pop, Happy", "created_at": day} for i in ids]
+
+
+class TestSongsKeyboard:
+    """Test song buttons and keyset navigation"""
+
+    def callbacks(self, markup):
+        return [[b.callback_data for b in row] for row in markup.inline_keyboard]
+
+    def test_first_page(self):
+        markup = main.songs_keyboard(make_songs(9, 8), has_newer=False, has_older=True)
+        assert self.callbacks(markup) == [["song:9"], ["song:8"], ["songs:n:8"]]
+
+    def test_middle_page(self):
+        markup = main.songs_keyboard(make_songs(7, 6), has_newer=True, has_older=True)
+        assert self.callbacks(markup)[-1] == ["songs:p:7", "songs:n:6"]
+
+    def test_single_page_has_no_navigation(self):
+        markup = main.songs_keyboard(make_songs(1), has_newer=False, has_older=False)
+        assert self.callbacks(markup) == [["song:1"]]
+
+
+class TestSongsCallback:
+    """Test that paging callbacks reach song_page with the right cursor"""
+
+    def run(self, monkeypatch, data):
+        calls = []
+
+        def song_page(user_id, older_than, newer_than, limit):
+            calls.append((older_than, newer_than))
+            return make_songs(3), False, False
+
+        monkeypatch.setattr(main, "song_page", song_page)
+        monkeypatch.setattr(main, "ensure_user", lambda user_id: None)
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        update = MagicMock()
+        update.callback_query.from_user.id = 1
+        update.callback_query.data = data
+        update.callback_query.answer = AsyncMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        asyncio.run(main.on_callback(update, MagicMock()))
+        return calls, update.callback_query.edit_message_text
+
+    def test_first_page(self, monkeypatch):
+        calls, edit = self.run(monkeypatch, "songs")
+        assert calls == [(None, None)]
+        assert edit.call_args.args[0] == "songs_title"
+
+    def test_older(self, monkeypatch):
+        assert self.run(monkeypatch, "songs:n:42")[0] == [(42, None)]
+
+    def test_newer(self, monkeypatch):
+        assert self.run(monkeypatch, "songs:p:42")[0] == [(None, 42)]
+
+
+class TestSendSong:
+    """Test re-delivery from Telegram's cache"""
+
+    def make_message(self, file_id="FRESH_FILE_ID"):
+        message = MagicMock()
+        sent = MagicMock()
+        sent.audio.file_id = file_id
+        message.reply_audio = AsyncMock(return_value=sent)
+        message.reply_text = AsyncMock()
+        return message
+
+    def patch_db(self, monkeypatch, song):
+        saved = []
+        monkeypatch.setattr(main, "get_song", lambda user_id, song_id: dict(song) if song else {})
+        monkeypatch.setattr(main, "set_song_file_id", lambda song_id, file_id: saved.append((song_id, file_id)))
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        return saved
+
+    def test_uses_cached_file_id(self, monkeypatch):
+        saved = self.patch_db(monkeypatch, {"title": "A", "file_id": "CACHED", "audio_url": "https://cdn.test/a.mp3"})
+        message = self.make_message()
+        asyncio.run(main.send_song(message, 1, 5))
+        assert message.reply_audio.call_args.args[0] == "CACHED"
+        assert saved == []
+
+    def test_url_send_caches_file_id(self, monkeypatch):
+        saved = self.patch_db(monkeypatch, {"title": "A", "file_id": None, "audio_url": "https://cdn.test/a.mp3"})
+        asyncio.run(main.send_song(self.make_message(), 1, 5))
+        assert saved == [(5, "FRESH_FILE_ID")]
+
+    def test_rejected_file_id_falls_back_to_url(self, monkeypatch):
+        saved = self.patch_db(monkeypatch, {"title": "A", "file_id": "STALE", "audio_url": "https://cdn.test/a.mp3"})
+        message = self.make_message()
+        message.reply_audio.side_effect = [BadRequest("Wrong file identifier"), message.reply_audio.return_value]
+        asyncio.run(main.send_song(message, 1, 5))
+        assert message.reply_audio.call_args.args[0] == "https://cdn.test/a.mp3"
+        assert saved == [(5, "FRESH_FILE_ID")]
+
+    def test_other_users_song_is_not_found(self, monkeypatch):
+        self.patch_db(monkeypatch, None)
+        message = self.make_message()
+        asyncio.run(main.send_song(message, 1, 5))
+        message.reply_audio.assert_not_called()
+        assert message.reply_text.call_args.args[0] == "song_missing"
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a scratch Postgres in DATABASE_URL")
+class TestSongPage:
+    """Keyset pagination against Postgres"""
+
+    USER = 9_200_001
+
+    @pytest.fixture(autouse=True)
+    def songs(self, monkeypatch):
+        monkeypatch.setattr(main, "DATABASE_URL", os.environ["DATABASE_URL"])
+        main.init_db()
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM songs WHERE user_id=%s", (self.USER,))
+            conn.commit()
+        main.save_songs(self.USER, None, None, [{"title": f"Song {i}"} for i in range(7)])
+        yield
+        with main.db_conn() as conn:
+            conn.execute("DELETE FROM songs WHERE user_id=%s", (self.USER,))
+            conn.commit()
+
+    def titles(self, songs):
+        return [s["title"] for s in songs]
+
+    def test_walk_forward_and_back(self):
+        # Same created_at for all (one transaction): id breaks ties, newest first
+        page1, has_newer, has_older = main.song_page(self.USER, limit=3)
+        assert self.titles(page1) == ["Song 6", "Song 5", "Song 4"] and not has_newer and has_older
+
+        page2, has_newer, has_older = main.song_page(self.USER, older_than=page1[-1]["id"], limit=3)
+        assert self.titles(page2) == ["Song 3", "Song 2", "Song 1"] and has_newer and has_older
+
+        page3, _, has_older = main.song_page(self.USER, older_than=page2[-1]["id"], limit=3)
+        assert self.titles(page3) == ["Song 0"] and not has_older
+
+        back, has_newer, _ = main.song_page(self.USER, newer_than=page2[0]["id"], limit=3)
+        assert self.titles(back) == self.titles(page1) and not has_newer
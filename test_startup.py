@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Test cold start: what importing main pulls in, and concurrent startup phases
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import main
+
+
+IMPORT_BUDGET_SECONDS = 3.0  # generous: CI machines vary; the point is catching a heavy import creeping back
+
+
+def import_main_in_fresh_interpreter():
+    code = (
+        "import sys, time; started = time.perf_counter(); import main; "
+        "print(__import__('json').dumps({'seconds': time.perf_counter() - started, "
+        "'stripe': 'stripe' in sys.modules}))"
+    )
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(main.__file__)),
+        capture_output=True, text=True, check=True, env={**os.environ, "TRACE_EXPORTER": "", "CAPTURE_FILE": ""},
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+class TestImportTime:
+    """Benchmark `import main` in a fresh interpreter"""
+
+    def test_import_is_lean(self):
+        assert not import_main_in_fresh_interpreter()["stripe"], "stripe must only be imported on checkout/webhook"
+
+    @pytest.mark.benchmark
+    def test_import_budget(self):
+        result = import_main_in_fresh_interpreter()
+        print(f"\nimport main: {result['seconds'] * 1000:.0f}ms")
+        assert result["seconds"] < IMPORT_BUDGET_SECONDS
+
+    def test_stripe_loads_on_first_use(self, monkeypatch):
+        import stripe
+        monkeypatch.setattr(stripe, "api_key", stripe.api_key)
+        monkeypatch.setattr(main, "_stripe_module", None)
+        monkeypatch.setattr(main, "STRIPE_SECRET_KEY", "sk_test_lazy")
+        assert main._stripe() is stripe
+        assert stripe.api_key == "sk_test_lazy"
+
+
+class TestStartupPhases:
+    """Test that startup phases overlap and are timed"""
+
+    def test_phases_run_concurrently(self, monkeypatch):
+        monkeypatch.setattr(main, "BOT_TOKEN", "")
+        monkeypatch.setattr(main, "open_db_pool", lambda: time.sleep(0.2) or False)
+        monkeypatch.setattr(main, "init_db", lambda: None)
+        monkeypatch.setattr(main, "load_demo_library", lambda: time.sleep(0.2) or 0)
+        monkeypatch.setattr(main, "STARTUP_TIMINGS", {})
+        monkeypatch.setattr(main, "STARTUP_SPANS", {})
+
+        async def run():
+            await main.startup_event()
+            await main.close_http_session()
+
+        asyncio.run(run())
+        spans = [main.STARTUP_SPANS[phase] for phase in ("db", "demo_library")]
+        assert max(start for start, _ in spans) < min(end for _, end in spans)
+        assert set(main.STARTUP_TIMINGS) == {"db", "demo_library", "http_client", "ready"}
+        assert main.STARTUP_TIMINGS["db"] >= 0.2
+
+    def test_stripe_is_warmed_in_a_thread(self, monkeypatch):
+        import stripe
+        monkeypatch.setattr(stripe, "api_key", stripe.api_key)
+        monkeypatch.setattr(main, "BOT_TOKEN", "")
+        monkeypatch.setattr(main, "open_db_pool", lambda: False)
+        monkeypatch.setattr(main, "init_db", lambda: None)
+        monkeypatch.setattr(main, "load_demo_library", lambda: 0)
+        monkeypatch.setattr(main, "STRIPE_WEBHOOK_SECRET", "whsec_test")
+        monkeypatch.setattr(main, "_stripe_module", None)
+
+        async def run():
+            await main.startup_event()
+            assert main._stripe_module is None  # not imported on the loop
+            await asyncio.gather(*main._background_tasks)
+            await main.close_http_session()
+
+        asyncio.run(run())
+        assert main._stripe_module is stripe
+
+    @pytest.mark.parametrize("backend,warned", [("local", True), ("postgres", False)])
+    def test_multiple_workers_warn_on_local_cache(self, monkeypatch, caplog, backend, warned):
+        monkeypatch.setattr(main, "BOT_TOKEN", "")
+        monkeypatch.setattr(main, "open_db_pool", lambda: False)
+        monkeypatch.setattr(main, "init_db", lambda: None)
+        monkeypatch.setattr(main, "load_demo_library", lambda: 0)
+        monkeypatch.setattr(main, "WEB_CONCURRENCY", 4)
+        monkeypatch.setattr(main.CACHE, "name", backend)
+
+        async def run():
+            await main.startup_event()
+            await main.close_http_session()
+
+        asyncio.run(run())
+        assert ("set CACHE_BACKEND=postgres" in caplog.text) == warned
+
+    def test_db_failure_stops_the_waiting_bot(self, monkeypatch):
+        app = MagicMock()
+        app.initialize = AsyncMock()
+        monkeypatch.setattr(main, "BOT_TOKEN", "123:test")
+        monkeypatch.setattr(main, "build_telegram_app", lambda token: app)
+        monkeypatch.setattr(main, "telegram_app", None)
+        monkeypatch.setattr(main, "_telegram_start_task", None)
+        monkeypatch.setattr(main, "open_db_pool", lambda: False)
+        monkeypatch.setattr(main, "init_db", MagicMock(side_effect=RuntimeError("db down")))
+        monkeypatch.setattr(main, "load_demo_library", lambda: 0)
+
+        async def run():
+            with pytest.raises(RuntimeError, match="db down"):
+                await main.startup_event()
+            await asyncio.sleep(0)
+            await main.close_http_session()
+            return main._telegram_start_task
+
+        task = asyncio.run(run())
+        assert task.cancelled()
+        app.start.assert_not_called()
+
+    def test_bot_start_failure_is_logged(self, monkeypatch, caplog):
+        app = MagicMock()
+        app.initialize = AsyncMock(side_effect=RuntimeError("bad token"))
+        monkeypatch.setattr(main, "BOT_TOKEN", "123:test")
+        monkeypatch.setattr(main, "build_telegram_app", lambda token: app)
+        monkeypatch.setattr(main, "telegram_app", None)
+        monkeypatch.setattr(main, "_telegram_start_task", None)
+
+        async def run():
+            main.start_telegram_bot(asyncio.Event())
+            await asyncio.wait([main._telegram_start_task])
+
+        asyncio.run(run())
+        assert "Telegram bot failed to start" in caplog.text and "bad token" in caplog.text
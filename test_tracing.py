@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Test per-update tracing, trace export and the slow-update stack sampler
+"""
+
+import json
+import time
+import asyncio
+import pytest
+import prometheus_client
+from unittest.mock import MagicMock
+
+import main
+
+
+@pytest.fixture
+def finished(monkeypatch):
+    """Capture root spans instead of exporting them"""
+    roots = []
+    monkeypatch.setattr(main, "finish_trace", roots.append)
+    return roots
+
+
+@pytest.fixture
+def registry_hist():
+    """Histogram in an isolated registry"""
+    return main.Histogram("test_seconds", "Test latency", ("op",), registry=prometheus_client.CollectorRegistry())
+
+
+def make_update(data="buy"):
+    update = MagicMock()
+    update.update_id = 42
+    update.effective_user.id = 1001
+    update.callback_query.data = data
+    return update
+
+
+class TestTracedHandler:
+    """Test root and child span collection"""
+
+    def test_child_spans_for_db_and_http_calls(self, finished, registry_hist):
+        @main.timed(registry_hist, "db_lookup")
+        def db_lookup():
+            return "row"
+
+        @main.timed(registry_hist, "http_call")
+        async def http_call():
+            await asyncio.sleep(0)
+
+        @main.traced_handler
+        async def handler(update, context):
+            await asyncio.to_thread(db_lookup)
+            await http_call()
+
+        asyncio.run(handler(make_update("buypack:pack_5"), None))
+
+        root = finished[0]
+        assert root.name == "handler"
+        assert root.attrs == {"update.id": 42, "user.id": 1001, "action": "buypack"}
+        assert [s.name for s in root.spans] == ["db_lookup", "http_call"]
+        assert all(s.parent_id == root.span_id and s.trace_id == root.trace_id for s in root.spans)
+
+    def test_nested_spans_and_errors(self, finished):
+        @main.traced_handler
+        async def handler(update, context):
+            with main.span("outer"):
+                with pytest.raises(ValueError):
+                    with main.span("inner", step=1):
+                        raise ValueError("bad input")
+
+        asyncio.run(handler(make_update(), None))
+
+        inner, outer = finished[0].spans
+        assert inner.parent_id == outer.span_id
+        assert inner.error == "ValueError: bad input"
+        assert inner.attrs == {"step": 1}
+
+    def test_no_spans_outside_updates(self):
+        with main.span("orphan") as s:
+            assert s is None
+        assert main.current_trace_id() == ""
+
+
+class TestExport:
+    """Test OTLP payloads and slow-update handling"""
+
+    def test_otlp_payload(self):
+        root = main.Span("on_callback", "a" * 32, "b" * 16, attrs={"update.id": 7, "action": "buy"})
+        root.duration = 0.25
+        child = main.Span("get_user", root.trace_id, "c" * 16, root.span_id, error="RuntimeError: x")
+        root.spans.append(child)
+
+        spans = main.otlp_payload(root)["resourceSpans"][0]["scopeSpans"][0]["spans"]
+
+        assert spans[0]["attributes"][0] == {"key": "update.id", "value": {"intValue": "7"}}
+        assert int(spans[0]["endTimeUnixNano"]) - int(spans[0]["startTimeUnixNano"]) == 250_000_000
+        assert spans[1]["parentSpanId"] == "b" * 16
+        assert spans[1]["status"]["code"] == 2
+        json.dumps(spans)
+
+    def test_slow_updates_are_always_exported(self, monkeypatch):
+        exported = []
+        exporter = MagicMock()
+        exporter.submit.side_effect = exported.append
+        monkeypatch.setattr(main, "TRACE_EXPORT", exporter)
+        monkeypatch.setattr(main, "TRACE_SAMPLE_RATE", 0.0)
+        monkeypatch.setattr(main, "PROFILER", None)
+
+        fast = main.Span("fast", "1" * 32, "2" * 16)
+        fast.duration = 0.01
+        slow = main.Span("slow", "3" * 32, "4" * 16)
+        slow.duration = main.TRACE_SLOW_MS / 1000 + 1
+
+        main.finish_trace(fast)
+        main.finish_trace(slow)
+
+        assert exported == [slow]
+
+    def test_file_exporter_writes_json_lines(self, monkeypatch, tmp_path):
+        path = tmp_path / "traces.jsonl"
+        monkeypatch.setattr(main, "TRACE_FILE", str(path))
+        exporter = main.TraceExporter("file")
+        exporter.submit(main.Span("on_text", "5" * 32, "6" * 16))
+
+        deadline = time.time() + 2
+        while not path.exists() and time.time() < deadline:
+            time.sleep(0.01)
+
+        line = json.loads(path.read_text().splitlines()[0])
+        assert line["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["name"] == "on_text"
+
+
+class TestStackSampler:
+    """Test the sampling profiler"""
+
+    def test_profile_captures_busy_frames(self):
+        sampler = main.StackSampler(interval=0.002)
+        start = time.time_ns()
+        sampler.enter()
+
+        def busy_spin():
+            until = time.perf_counter() + 0.15
+            while time.perf_counter() < until:
+                pass
+
+        busy_spin()
+        sampler.exit()
+
+        folded = sampler.profile(start, time.time_ns())
+        assert any("busy_spin" in stack for stack, _ in folded)
+
+    def test_slow_update_profile_is_written_off_the_loop(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(main, "TRACE_PROFILE_DIR", str(tmp_path))
+        monkeypatch.setattr(main, "TRACE_EXPORT", None)
+        sampler = main.StackSampler(interval=0.002)
+        monkeypatch.setattr(main, "PROFILER", sampler)
+        writes = []
+        dump = sampler.dump
+        monkeypatch.setattr(sampler, "dump", lambda root: writes.append(main.threading.current_thread().name) or dump(root))
+
+        root = main.Span("slow", "7" * 32, "8" * 16)
+        sampler.enter()
+        until = time.perf_counter() + 0.05
+        while time.perf_counter() < until:
+            pass
+        sampler.exit()
+        root.duration = main.TRACE_SLOW_MS / 1000 + 1
+        main.finish_trace(root)
+        sampler.flush()
+
+        assert writes == ["profile-writer"]
+        assert (tmp_path / f"{'7' * 32}.process.folded").exists()
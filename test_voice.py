@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Test voice-note topics: chunked streaming, transcript cache, concurrency limit and the handler
+"""
+
+import os
+import asyncio
+import tempfile
+import pytest
+import prometheus_client
+from unittest.mock import AsyncMock, MagicMock
+from aiohttp import web
+
+import main
+
+
+AUDIO = bytes(range(256)) * 4096  # 1 MiB
+
+
+@pytest.fixture
+def voice_state(monkeypatch):
+    """Fresh cache and semaphore for each test"""
+    monkeypatch.setattr(main, "CACHE", main.LocalCache(size=100))
+    monkeypatch.setattr(main, "_transcribe_slots", None)
+
+
+def transcript_lookups(outcome):
+    value = prometheus_client.REGISTRY.get_sample_value(
+        "musicai_cache_requests_total", {"namespace": "transcript", "outcome": outcome},
+    )
+    return value or 0
+
+
+@pytest.fixture
+def audio_file():
+    f = tempfile.NamedTemporaryFile(delete=False, suffix=".oga")
+    f.write(AUDIO)
+    f.close()
+    yield f.name
+    os.remove(f.name)
+
+
+class StandIn:
+    """aiohttp server playing the Telegram file host and a transcription API"""
+
+    def __init__(self):
+        self.uploads = []
+        self.app = web.Application()
+        self.app.router.add_get("/file/bot{token}/voice/{name}", self.file)
+        self.app.router.add_post("/v1/audio/transcriptions", self.transcriptions)
+        self.runner = None
+        self.base_url = ""
+
+    async def __aenter__(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await main.close_http_session()
+        await self.runner.cleanup()
+
+    async def file(self, request):
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        for i in range(0, len(AUDIO), 100_000):
+            await resp.write(AUDIO[i:i + 100_000])
+        return resp
+
+    async def transcriptions(self, request):
+        fields = {}
+        reader = await request.multipart()
+        async for part in reader:
+            fields[part.name] = (part.filename, await part.read())
+        self.uploads.append({"chunked": request.headers.get("Transfer-Encoding") == "chunked",
+                             "auth": request.headers.get("Authorization"), **fields})
+        return web.json_response({"text": " a song about the sea "})
+
+
+class TestStreaming:
+    """Audio is read and forwarded in bounded chunks"""
+
+    def test_local_file_in_chunks(self, voice_state, audio_file):
+        transcriber = main.LocalTranscriber()
+        text = asyncio.run(main.voice_to_text(audio_file, transcriber=transcriber))
+        assert text == f"voice note {os.path.basename(audio_file)} ({len(AUDIO)} bytes)"
+        assert transcriber.largest_chunk <= main.VOICE_CHUNK
+
+    def test_telegram_url_to_openai_compatible_api(self, voice_state):
+        async def run():
+            async with StandIn() as stand_in:
+                transcriber = main.OpenAITranscriber(f"{stand_in.base_url}/v1/audio/transcriptions", "sk-voice", "whisper-1")
+                telegram_file = MagicMock(file_path=f"{stand_in.base_url}/file/bot123:ABC/voice/file_7.oga")
+                text = await main.voice_to_text(telegram_file, "uniq-7", transcriber=transcriber)
+                return text, stand_in.uploads
+
+        text, uploads = asyncio.run(run())
+        assert text == "a song about the sea"
+        [upload] = uploads
+        assert upload["chunked"] is True
+        assert upload["auth"] == "Bearer sk-voice"
+        assert upload["model"] == (None, b"whisper-1")
+        assert upload["file"] == ("file_7.oga", AUDIO)
+
+    def test_upstream_error(self, voice_state, audio_file):
+        async def run():
+            async with StandIn() as stand_in:
+                transcriber = main.OpenAITranscriber(f"{stand_in.base_url}/missing", "", "whisper-1")
+                return await main.voice_to_text(audio_file, transcriber=transcriber)
+
+        with pytest.raises(RuntimeError, match="Transcription error 404"):
+            asyncio.run(run())
+
+
+class TestCacheAndLimits:
+    """Transcripts by file_unique_id, single-flight and TRANSCRIBE_CONCURRENCY"""
+
+    def test_duplicate_is_served_from_cache(self, voice_state, audio_file):
+        transcriber = main.LocalTranscriber("the sea")
+        hits = transcript_lookups("hit")
+
+        async def run():
+            first = await main.voice_to_text(audio_file, "uniq-1", transcriber=transcriber)
+            second = await main.voice_to_text(audio_file, "uniq-1", transcriber=transcriber)
+            return first, second
+
+        assert asyncio.run(run()) == ("the sea", "the sea")
+        assert transcriber.calls == 1
+        assert transcript_lookups("hit") - hits == 1
+        assert main.CACHE.get("transcript", "uniq-1") == "the sea"
+
+    def test_concurrent_duplicates_share_one_transcription(self, voice_state, audio_file):
+        transcriber = main.LocalTranscriber("the sea", delay=0.05)
+        coalesced = transcript_lookups("coalesced")
+
+        async def run():
+            return await asyncio.gather(*(main.voice_to_text(audio_file, "uniq-2", transcriber=transcriber)
+                                          for _ in range(5)))
+
+        assert asyncio.run(run()) == ["the sea"] * 5
+        assert transcriber.calls == 1
+        assert transcript_lookups("coalesced") - coalesced == 4
+
+    def test_failures_are_not_cached(self, voice_state, audio_file):
+        transcriber = main.LocalTranscriber("the sea")
+        transcriber.transcribe = AsyncMock(side_effect=[RuntimeError("busy"), "the sea"])
+
+        async def run():
+            with pytest.raises(RuntimeError):
+                await main.voice_to_text(audio_file, "uniq-3", transcriber=transcriber)
+            return await main.voice_to_text(audio_file, "uniq-3", transcriber=transcriber)
+
+        assert asyncio.run(run()) == "the sea"
+
+    def test_concurrency_limit(self, voice_state, audio_file, monkeypatch):
+        monkeypatch.setattr(main, "TRANSCRIBE_CONCURRENCY", 2)
+        running, peak = 0, 0
+
+        class Slow(main.Transcriber):
+            async def transcribe(self, chunks, filename, mime_type):
+                nonlocal running, peak
+                running += 1
+                peak = max(peak, running)
+                async for _ in chunks:
+                    pass
+                await asyncio.sleep(0.02)
+                running -= 1
+                return "ok"
+
+        async def run():
+            await asyncio.gather(*(main.voice_to_text(audio_file, f"uniq-{i}", transcriber=Slow())
+                                   for i in range(6)))
+
+        asyncio.run(run())
+        assert peak == 2
+
+
+class TestOnVoice:
+    """Test the voice handler"""
+
+    def make_update(self, duration=5):
+        update = MagicMock()
+        update.effective_user.id = 1
+        update.message.voice.duration = duration
+        update.message.voice.file_unique_id = "uniq-h"
+        update.message.voice.mime_type = "audio/ogg"
+        update.message.voice.get_file = AsyncMock(return_value=MagicMock(file_path="/tmp/voice.oga"))
+        update.message.reply_text = AsyncMock()
+        return update
+
+    def run(self, monkeypatch, update, user_data, transcript="the sea"):
+        context = MagicMock()
+        context.user_data = user_data
+        lyrics = AsyncMock(return_value=["[Verse 1]\nwaves"])
+        monkeypatch.setattr(main, "TRANSCRIBER", main.LocalTranscriber())
+        monkeypatch.setattr(main, "voice_to_text", AsyncMock(return_value=transcript))
+        monkeypatch.setattr(main, "openrouter_lyrics_variants", lyrics)
+        monkeypatch.setattr(main, "tr", lambda user_id, key: key)
+        monkeypatch.setattr(main, "generate_keyboard", lambda user_id: None)
+        asyncio.run(main.on_voice(update, context))
+        return lyrics, [c.args[0] for c in update.message.reply_text.call_args_list]
+
+    def test_transcript_becomes_the_topic(self, monkeypatch):
+        update = self.make_update()
+        lyrics, replies = self.run(monkeypatch, update, {"genre": "Pop", "mood": "Happy", "lang": "en"})
+        assert lyrics.call_args.args[:4] == ("the sea", "en", "Pop", "Happy")
+        assert replies[:2] == ["transcribing", "🎙 the sea"]
+        assert main.voice_to_text.call_args.args[1] == "uniq-h"
+
+    def test_needs_genre_first(self, monkeypatch):
+        lyrics, replies = self.run(monkeypatch, self.make_update(), {})
+        lyrics.assert_not_called()
+        main.voice_to_text.assert_not_called()
+        assert replies == ["Choose genre first:"]
+
+    def test_too_long_is_refused_before_download(self, monkeypatch):
+        update = self.make_update(duration=main.VOICE_MAX_SECONDS + 1)
+        _, replies = self.run(monkeypatch, update, {"genre": "Pop", "mood": "Happy"})
+        update.message.voice.get_file.assert_not_called()
+        assert replies == ["voice_too_long"]
+
+    def test_empty_transcript(self, monkeypatch):
+        lyrics, replies = self.run(monkeypatch, self.make_update(), {"genre": "Pop", "mood": "Happy"}, transcript="")
+        lyrics.assert_not_called()
+        assert replies[-1] == "voice_empty"